@@ -0,0 +1,244 @@
+import asyncio
+import csv
+import datetime
+import json
+import logging
+import os
+import tempfile
+import time
+from collections import Counter, defaultdict
+
+import config
+from fileio import read_file, rewrite_file
+from templates import tariff_name
+
+logger = logging.getLogger(__name__)
+
+MOSCOW_TZ = datetime.timezone(datetime.timedelta(hours=3))
+GB = 1024 ** 3
+
+
+def label_day(label: str, fallback: float) -> str:
+    """День покупки по метке платежа {user_id}_{время}_{случайное}; для старых меток — fallback."""
+    parts = label.split('_')
+    timestamp = int(parts[1]) if len(parts) >= 3 and parts[1].isdigit() else fallback
+    return datetime.datetime.fromtimestamp(timestamp, MOSCOW_TZ).strftime('%Y-%m-%d')
+
+
+def parse_purchase(line: str):
+    """Строка buyers.txt: user_id|цена|{ГБ}GB|метка. Возвращает (user_id, цена, ГБ, метка) или None."""
+    parts = line.split('|')
+    if len(parts) != 4:
+        return None
+    try:
+        return parts[0], float(parts[1]), int(parts[2].rstrip('GB')), parts[3]
+    except ValueError:
+        return None
+
+
+class FileTail:
+    """Чтение новых полных строк файла начиная с сохраненного смещения в байтах."""
+
+    def __init__(self, path: str, offset: int = 0, inode: int = None):
+        self.path = path
+        self.offset = offset
+        self.inode = inode
+
+    def read(self):
+        """Возвращает (новые строки, сброшен ли файл). Файл считается сброшенным, если он заменен
+        другим или стал короче прочитанного — тогда чтение начинается сначала."""
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return [], False
+        reset = (self.inode is not None and stat.st_ino != self.inode) or stat.st_size < self.offset
+        if reset:
+            self.offset = 0
+        self.inode = stat.st_ino
+        if stat.st_size == self.offset:
+            return [], reset
+        with open(self.path, 'rb') as f:
+            f.seek(self.offset)
+            data = f.read(stat.st_size - self.offset)
+        end = data.rfind(b'\n') + 1 # недописанная последняя строка будет прочитана в следующий раз
+        self.offset += end
+        return data[:end].decode('utf-8', errors='replace').splitlines(), reset
+
+    def state(self) -> dict:
+        return {'offset': self.offset, 'inode': self.inode}
+
+
+class Analytics:
+    """Выручка, конверсия пробных ключей в покупки и активные ключи по тарифам.
+
+    Журналы покупок (TRANSACTION_LOGS_FILE) и регистраций (USERS_USERNAME_FILE) дочитываются
+    с сохраненного смещения: каждая строка разбирается один раз, в памяти держатся только
+    накопленные итоги. Итоги вместе со смещениями сохраняются в ANALYTICS_STATE_FILE, поэтому
+    после перезапуска читаются только новые строки. Если журнал заменен или укорочен, итоги
+    пересчитываются с начала. Активные ключи считаются по снимкам серверов Outline из кэша,
+    без запросов к API.
+    """
+
+    def __init__(self, store, pool):
+        self.store = store
+        self.pool = pool
+        self._reset()
+        self._lock = asyncio.Lock()
+        self.updated_at = None
+
+    def _reset(self):
+        self.revenue = defaultdict(Counter)    # день -> {ГБ: сумма}
+        self.purchases = defaultdict(Counter)  # день -> {ГБ: покупок}
+        self.buyers = set()
+        self.trial_users = set()
+        self.tails = {'purchases': FileTail(config.TRANSACTION_LOGS_FILE), 'users': FileTail(config.USERS_USERNAME_FILE)}
+
+    # Накопление
+
+    def load(self):
+        if not os.path.exists(config.ANALYTICS_STATE_FILE):
+            return
+        try:
+            state = json.loads(read_file(config.ANALYTICS_STATE_FILE))
+            for name, tail in state['tails'].items():
+                self.tails[name] = FileTail(self.tails[name].path, tail['offset'], tail['inode'])
+            for day, values in state['revenue'].items():
+                self.revenue[day] = Counter({int(gb): amount for gb, amount in values.items()})
+            for day, values in state['purchases'].items():
+                self.purchases[day] = Counter({int(gb): count for gb, count in values.items()})
+            self.buyers = set(state['buyers'])
+            self.trial_users = set(state['trial_users'])
+        except (ValueError, KeyError, TypeError) as e:
+            logger.error(f"Некорректный файл аналитики {config.ANALYTICS_STATE_FILE}, итоги будут пересчитаны: {e}")
+            self._reset()
+
+    def _save(self):
+        rewrite_file(config.ANALYTICS_STATE_FILE, [json.dumps({
+            'tails': {name: tail.state() for name, tail in self.tails.items()},
+            'revenue': self.revenue, 'purchases': self.purchases,
+            'buyers': sorted(self.buyers), 'trial_users': sorted(self.trial_users),
+        }, ensure_ascii=False)])
+
+    def _consume(self) -> int:
+        """Дочитывает журналы (выполняется в потоке). Возвращает число новых строк."""
+        purchases, reset = self.tails['purchases'].read()
+        users, users_reset = self.tails['users'].read()
+        if reset or users_reset:
+            logger.warning("Журнал покупок или регистраций заменен, итоги аналитики пересчитываются")
+            self._reset()
+            purchases, _ = self.tails['purchases'].read()
+            users, _ = self.tails['users'].read()
+
+        now = time.time()
+        for line in purchases:
+            purchase = parse_purchase(line)
+            if purchase is None:
+                continue
+            user_id, price, gb_limit, label = purchase
+            day = label_day(label, now)
+            self.revenue[day][gb_limit] += price
+            self.purchases[day][gb_limit] += 1
+            self.buyers.add(user_id)
+        for line in users:
+            parts = line.split('|')
+            if len(parts) == 5 and parts[4] == 'Free':
+                self.trial_users.add(parts[0])
+        if purchases or users:
+            self._save()
+        return len(purchases) + len(users)
+
+    async def update(self) -> int:
+        async with self._lock:
+            count = await asyncio.get_running_loop().run_in_executor(None, self._consume)
+            self.updated_at = time.time()
+            return count
+
+    async def run(self):
+        while True:
+            try:
+                await self.update()
+            except Exception as e:
+                logger.error(f"Ошибка обновления аналитики: {e}")
+            await asyncio.sleep(config.ANALYTICS_INTERVAL)
+
+    # Отчеты
+
+    def active_keys(self) -> Counter:
+        """Активные ключи пользователей по купленному тарифу по последним снимкам серверов.
+
+        Тариф берется из записи ключа в хранилище: лимит на сервере мог быть увеличен промокодом.
+        Для ключей, выданных до записи тарифа, он оценивается по лимиту трафика (0 — безлимит).
+        """
+        counts = Counter()
+        for name, server in self.pool.servers.items():
+            for key_id, key in server.cache.snapshot.items():
+                record = self.store.get_key(name, key_id)
+                if record is None: # ключи запаса и чужие ключи не считаем
+                    continue
+                if record.gb_limit is not None:
+                    counts[record.gb_limit] += 1
+                else:
+                    counts[round(key.data_limit / GB) if key.data_limit else 0] += 1
+        return counts
+
+    def report(self, days: int = 7) -> str:
+        today = datetime.datetime.now(MOSCOW_TZ).date()
+        lines = [f"📊 Отчет за {days} дн."]
+        period_revenue, period_purchases = Counter(), Counter()
+        for offset in range(days - 1, -1, -1):
+            day = (today - datetime.timedelta(days=offset)).isoformat()
+            revenue, purchases = self.revenue.get(day, Counter()), self.purchases.get(day, Counter())
+            period_revenue.update(revenue)
+            period_purchases.update(purchases)
+            lines.append(f"{day}: {sum(revenue.values()):.0f} ₽, покупок {sum(purchases.values())}")
+
+        lines.append("\nПо тарифам за период:")
+        for gb_limit in sorted(period_purchases):
+            lines.append(f"  {tariff_name(gb_limit)}: {period_purchases[gb_limit]} шт., {period_revenue[gb_limit]:.0f} ₽")
+        if not period_purchases:
+            lines.append("  покупок нет")
+
+        total_revenue = sum(sum(revenue.values()) for revenue in self.revenue.values())
+        total_purchases = sum(sum(purchases.values()) for purchases in self.purchases.values())
+        converted = len(self.trial_users & self.buyers)
+        conversion = converted / len(self.trial_users) * 100 if self.trial_users else 0.0
+        lines.append(f"\nЗа все время: {total_revenue:.0f} ₽, покупок {total_purchases}, покупателей {len(self.buyers)}")
+        lines.append(f"Пробный ключ → покупка: {converted} из {len(self.trial_users)} ({conversion:.1f}%)")
+
+        active = self.active_keys()
+        lines.append(f"\nАктивные ключи: {sum(active.values())}")
+        for gb_limit in sorted(active, key=lambda gb: (gb == 0, gb)):
+            lines.append(f"  {'Безлимит' if gb_limit == 0 else tariff_name(gb_limit)}: {active[gb_limit]}")
+        if self.updated_at:
+            lines.append(f"\nОбновлено: {datetime.datetime.fromtimestamp(self.updated_at, MOSCOW_TZ).strftime('%H:%M:%S')}")
+        return "\n".join(lines)
+
+    # Выгрузка
+
+    def _write_csv(self, daily: bool) -> str:
+        """Пишет CSV во временный файл построчно (выполняется в потоке). Возвращает путь к файлу."""
+        f = tempfile.NamedTemporaryFile('w', encoding='utf-8', newline='', suffix='.csv', delete=False)
+        with f:
+            writer = csv.writer(f)
+            if daily:
+                writer.writerow(['day', 'tariff_gb', 'purchases', 'revenue'])
+                for day in sorted(self.purchases):
+                    for gb_limit in sorted(self.purchases[day]):
+                        writer.writerow([day, gb_limit, self.purchases[day][gb_limit], f"{self.revenue[day][gb_limit]:.2f}"])
+            else: # все покупки: журнал читается потоком, а не целиком
+                writer.writerow(['day', 'user_id', 'tariff_gb', 'price', 'label'])
+                now = time.time()
+                try:
+                    with open(config.TRANSACTION_LOGS_FILE, encoding='utf-8') as log:
+                        for line in log:
+                            purchase = parse_purchase(line.rstrip('\n'))
+                            if purchase is not None:
+                                user_id, price, gb_limit, label = purchase
+                                writer.writerow([label_day(label, now), user_id, gb_limit, f"{price:.2f}", label])
+                except FileNotFoundError:
+                    pass
+        return f.name
+
+    async def export_csv(self, daily: bool = False) -> str:
+        """Путь к временному CSV-файлу; удалить после отправки."""
+        return await asyncio.get_running_loop().run_in_executor(None, self._write_csv, daily)
@@ -0,0 +1,194 @@
+"""Локальные заглушки Telegram Bot API, Outline Management API и истории операций ЮMoney.
+
+Все три сервиса поднимаются в одном aiohttp-приложении в отдельном потоке со своим циклом
+событий, чтобы их обработка не искажала задержки обработчиков бота.
+"""
+import asyncio
+import random
+import threading
+import time
+from collections import Counter
+
+from aiohttp import web
+
+
+class FakeTelegram:
+    """Bot API: отвечает на любой метод успешным результатом правдоподобной формы."""
+
+    MESSAGE_METHODS = {'sendMessage', 'editMessageText', 'forwardMessage', 'editMessageReplyMarkup'}
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.calls = Counter()
+        self._message_id = 0
+
+    async def handle(self, request: web.Request):
+        method = request.match_info['method']
+        self.calls[method] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        data = await request.post()
+        if method == 'getMe':
+            return web.json_response({'ok': True, 'result': {'id': 1, 'is_bot': True, 'first_name': 'bench', 'username': 'bench_bot'}})
+        if method in self.MESSAGE_METHODS:
+            self._message_id += 1
+            chat_id = int(data.get('chat_id') or 1)
+            return web.json_response({'ok': True, 'result': {
+                'message_id': self._message_id, 'date': int(time.time()),
+                'chat': {'id': chat_id, 'type': 'private'}, 'text': data.get('text', '')}})
+        if method == 'copyMessage':
+            self._message_id += 1
+            return web.json_response({'ok': True, 'result': {'message_id': self._message_id}})
+        return web.json_response({'ok': True, 'result': True})
+
+    def routes(self):
+        return [web.post('/bot{token}/{method}', self.handle)]
+
+
+class FakeOutline:
+    """Management API одного сервера Outline с задержкой latency и долей ошибок error_rate."""
+
+    def __init__(self, prefix: str, latency: float = 0.0, error_rate: float = 0.0):
+        self.prefix = prefix
+        self.latency = latency
+        self.error_rate = error_rate
+        self.keys = {}
+        self.usage = {}
+        self.calls = Counter()
+        self._next_id = 1
+
+    def add_key(self, key_id: str = None, name: str = '', data_limit: int = None, used_bytes: int = 0) -> dict:
+        key_id = key_id or str(self._next_id)
+        self._next_id = max(self._next_id, int(key_id) + 1)
+        key = {'id': key_id, 'name': name, 'password': 'bench', 'port': 443, 'method': 'chacha20-ietf-poly1305',
+               'accessUrl': f'ss://bench@{self.prefix}.example:443/?outline=1#{key_id}'}
+        if data_limit:
+            key['dataLimit'] = {'bytes': data_limit}
+        self.keys[key_id] = key
+        self.usage[key_id] = used_bytes
+        return key
+
+    def _wrap(self, name, handler):
+        async def wrapper(request):
+            self.calls[name] += 1
+            if self.latency:
+                await asyncio.sleep(self.latency)
+            if self.error_rate and random.random() < self.error_rate:
+                return web.Response(status=500)
+            return await handler(request)
+        return wrapper
+
+    async def list_keys(self, request):
+        return web.json_response({'accessKeys': list(self.keys.values())})
+
+    async def metrics(self, request):
+        return web.json_response({'bytesTransferredByUserId': dict(self.usage)})
+
+    async def create_key(self, request):
+        payload = await request.json() if request.can_read_body else {}
+        key = self.add_key(name=payload.get('name', ''), data_limit=(payload.get('limit') or {}).get('bytes'))
+        return web.json_response(key, status=201)
+
+    async def get_key(self, request):
+        key = self.keys.get(request.match_info['id'])
+        return web.json_response(key) if key else web.Response(status=404)
+
+    async def rename_key(self, request):
+        key = self.keys.get(request.match_info['id'])
+        if key is None:
+            return web.Response(status=404)
+        key['name'] = (await request.post()).get('name', '')
+        return web.Response(status=204)
+
+    async def set_data_limit(self, request):
+        key = self.keys.get(request.match_info['id'])
+        if key is None:
+            return web.Response(status=404)
+        key['dataLimit'] = (await request.json())['limit']
+        return web.Response(status=204)
+
+    async def delete_key(self, request):
+        self.usage.pop(request.match_info['id'], None)
+        return web.Response(status=204 if self.keys.pop(request.match_info['id'], None) else 404)
+
+    async def server_info(self, request):
+        return web.json_response({'name': self.prefix, 'serverId': self.prefix, 'portForNewAccessKeys': 443})
+
+    def routes(self, base: str):
+        return [method(base + path, self._wrap(f"{method.__name__.upper()} {path}", handler)) for method, path, handler in (
+            (web.get, '/access-keys/', self.list_keys),
+            (web.get, '/access-keys/{id}', self.get_key),
+            (web.post, '/access-keys', self.create_key),
+            (web.put, '/access-keys/{id}/name', self.rename_key),
+            (web.put, '/access-keys/{id}/data-limit', self.set_data_limit),
+            (web.delete, '/access-keys/{id}', self.delete_key),
+            (web.get, '/metrics/transfer', self.metrics),
+            (web.get, '/server', self.server_info),
+        )]
+
+
+class FakeYooMoney:
+    """operation-history: возвращает успешные входящие переводы по меткам из paid."""
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.paid = {}  # label -> сумма
+        self.calls = 0
+
+    async def operation_history(self, request):
+        self.calls += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        records = int((await request.post()).get('records') or 30)
+        operations = [{'operation_id': str(i), 'status': 'success', 'direction': 'in', 'type': 'deposition',
+                       'amount': amount, 'label': label, 'datetime': '2024-01-01T00:00:00Z'}
+                      for i, (label, amount) in enumerate(list(self.paid.items())[-records:])]
+        return web.json_response({'operations': operations})
+
+    def routes(self):
+        return [web.post('/api/operation-history', self.operation_history)]
+
+
+class FakeStack:
+    """Поднимает все заглушки на 127.0.0.1:port в фоновом потоке."""
+
+    def __init__(self, port: int, outline_servers: int = 1, telegram_latency: float = 0.0,
+                 outline_latency: float = 0.0, outline_error_rate: float = 0.0, yoomoney_latency: float = 0.0):
+        self.port = port
+        self.telegram = FakeTelegram(telegram_latency)
+        self.outlines = [FakeOutline(f"s{i}", outline_latency, outline_error_rate) for i in range(outline_servers)]
+        self.yoomoney = FakeYooMoney(yoomoney_latency)
+        self._loop = None
+        self._runner = None
+        self._ready = threading.Event()
+
+    @property
+    def base_url(self) -> str:
+        return f"http://127.0.0.1:{self.port}"
+
+    def outline_url(self, outline: FakeOutline) -> str:
+        return f"{self.base_url}/outline/{outline.prefix}"
+
+    def _app(self) -> web.Application:
+        app = web.Application()
+        app.add_routes(self.telegram.routes() + self.yoomoney.routes())
+        for outline in self.outlines:
+            app.add_routes(outline.routes(f"/outline/{outline.prefix}"))
+        return app
+
+    def _serve(self):
+        self._loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self._loop)
+        self._runner = web.AppRunner(self._app(), access_log=None)
+        self._loop.run_until_complete(self._runner.setup())
+        self._loop.run_until_complete(web.TCPSite(self._runner, '127.0.0.1', self.port).start())
+        self._ready.set()
+        self._loop.run_forever()
+
+    def start(self):
+        threading.Thread(target=self._serve, daemon=True).start()
+        self._ready.wait()
+
+    def stop(self):
+        asyncio.run_coroutine_threadsafe(self._runner.cleanup(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
@@ -0,0 +1,309 @@
+"""Нагрузочный тест бота на локальных заглушках Telegram, Outline и ЮMoney.
+
+Генерирует каталог data/ на заданное число пользователей и ключей, поднимает заглушки
+(bench/fakes.py), импортирует настоящий main.dp и прогоняет через него синтетические
+обновления. Для каждого сценария выводит число обновлений, ошибки, пропускную способность,
+p50/p99 задержки обработчика и пиковую память процесса.
+
+Запуск из корня репозитория:
+    python -m bench.run --users 50000 --workloads start,my_keys,payments,sweep
+"""
+import argparse
+import asyncio
+import logging
+import os
+import random
+import resource
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+from collections import Counter
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import config  # noqa: E402
+from bench.fakes import FakeStack  # noqa: E402
+
+WORKLOADS = ('start', 'my_keys', 'payments', 'sweep')
+FIRST_USER_ID = 100000
+GB = 1024 ** 3
+
+
+# Подготовка данных
+
+def generate_data(workdir: str, stack: FakeStack, users: int, expired_share: float):
+    """data/ с users пользователями, у каждого по ключу на одном из серверов; expired_share ключей уже истекли."""
+    data = os.path.join(workdir, 'data')
+    for directory in ('texts', 'notifications'):
+        shutil.copytree(os.path.join(ROOT, 'data', directory), os.path.join(data, directory))
+    for directory in ('promocodes/discounts', 'transaction_logs'):
+        os.makedirs(os.path.join(data, directory), exist_ok=True)
+
+    now = int(time.time())
+    user_lines, key_lines, expiration_lines = [], [], []
+    for i in range(users):
+        user_id = str(FIRST_USER_ID + i)
+        outline = stack.outlines[i % len(stack.outlines)]
+        key = outline.add_key(name=f"Paid_{user_id}", data_limit=10 * GB, used_bytes=random.randint(0, 10 * GB))
+        expired = random.random() < expired_share
+        expiration = now - 3600 if expired else now + random.randint(4, 30) * 86400
+        user_lines.append(user_id)
+        key_lines.append(f"{user_id}||{key['accessUrl']}||{key['id']}||{outline.prefix}")
+        expiration_lines.append(f"{user_id}||{expiration}||{key['id']}||{outline.prefix}")
+
+    empty = (config.USERS_USERNAME_FILE, config.NOTIFIED_KEYS_FILE, config.UNREACHABLE_USERS_FILE, config.PROMOCODES_FILE,
+             config.PROMO_ACTIVATION_LOGS, config.TRANSACTION_LOGS_FILE, config.PAYMENTS_LEDGER_FILE)
+    for path, lines in ((config.USERS_FILE, user_lines), (config.KEYS_IDS_FILE, key_lines),
+                        (config.USERS_KEYS_EXPIRATIONS_FILE, expiration_lines), *((path, []) for path in empty)):
+        with open(os.path.join(workdir, path), 'w', encoding='utf-8') as f:
+            f.write(''.join(f"{line}\n" for line in lines))
+
+
+def configure(stack: FakeStack, args):
+    """Направляет бота на заглушки. Вызывается до импорта main."""
+    config.telegram_token = '123456:BENCHMARKBENCHMARKBENCHMARKBENCHMARK'
+    config.TELEGRAM_API_SERVER = stack.base_url
+    config.yoomoney_token = 'bench'
+    config.YOOMONEY_API_URL = f"{stack.base_url}/api/"
+    config.OUTLINE_SERVERS = [{'name': outline.prefix, 'api_url': stack.outline_url(outline),
+                               'cert_sha256': 'bench', 'weight': 1.0} for outline in stack.outlines]
+    config.STORAGE_BACKEND = args.storage
+    config.FSM_STORAGE_BACKEND = args.fsm_storage
+    config.PAYMENT_CHECK_CACHE_TTL = 1
+    config.TELEGRAM_RATE_LIMIT = 10000
+    config.THROTTLE_DEFAULT_RATE = (10 ** 9, 1)  # синтетические пользователи жмут кнопки чаще живых
+    config.THROTTLE_RATES = {}
+    config.KEY_POOL_ENABLED = args.key_pool > 0
+    config.KEY_POOL_MIN_SIZE = args.key_pool
+    config.KEY_POOL_MAX_SIZE = max(args.key_pool, config.KEY_POOL_MAX_SIZE)
+    config.KEY_POOL_REFILL_CONCURRENCY = 8
+
+
+# Обновления Telegram
+
+def user_payload(user_id: int) -> dict:
+    return {'id': user_id, 'is_bot': False, 'first_name': f"User{user_id}", 'username': f"user{user_id}"}
+
+
+def message_update(update_id: int, user_id: int, text: str) -> dict:
+    message = {'message_id': update_id, 'date': int(time.time()), 'text': text,
+               'chat': {'id': user_id, 'type': 'private'}, 'from': user_payload(user_id)}
+    if text.startswith('/'):
+        message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+    return {'update_id': update_id, 'message': message}
+
+
+def callback_update(update_id: int, user_id: int, data: str) -> dict:
+    message = {'message_id': update_id, 'date': int(time.time()), 'text': 'menu',
+               'chat': {'id': user_id, 'type': 'private'}, 'from': {'id': 1, 'is_bot': True, 'first_name': 'bench'}}
+    return {'update_id': update_id, 'callback_query': {
+        'id': str(update_id), 'from': user_payload(user_id), 'chat_instance': '1', 'data': data, 'message': message}}
+
+
+# Измерения
+
+class Result:
+    def __init__(self, name: str):
+        self.name = name
+        self.latencies = []
+        self.errors = 0
+        self.elapsed = 0.0
+        self.extra = {}
+
+    def summary(self) -> str:
+        count = len(self.latencies)
+        line = f"{self.name:<10} обновлений {count:>7}  ошибок {self.errors:>5}  {self.elapsed:7.2f} с"
+        if count:
+            ordered = sorted(self.latencies)
+            p50 = statistics.median(ordered)
+            p99 = ordered[min(count - 1, int(count * 0.99))]
+            line += (f"  {count / self.elapsed:8.1f} обн/с  p50 {p50 * 1000:7.1f} мс  "
+                     f"p99 {p99 * 1000:7.1f} мс  max {ordered[-1] * 1000:7.1f} мс")
+        line += f"  RSS {peak_rss_mb():.0f} МБ"
+        if self.extra:
+            line += "\n           " + ", ".join(f"{key}: {value}" for key, value in self.extra.items())
+        return line
+
+
+def peak_rss_mb() -> float:
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024  # в Linux ru_maxrss в КБ
+
+
+async def replay(main, name: str, updates: list, concurrency: int) -> Result:
+    from aiogram import Bot, Dispatcher, types
+
+    result = Result(name)
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def process(payload):
+        async with semaphore:
+            Bot.set_current(main.bot)
+            Dispatcher.set_current(main.dp)
+            started_at = time.perf_counter()
+            try:
+                await main.dp.process_update(types.Update(**payload))
+            except Exception:
+                result.errors += 1
+            result.latencies.append(time.perf_counter() - started_at)
+
+    started_at = time.perf_counter()
+    await asyncio.gather(*(process(payload) for payload in updates))
+    result.elapsed = time.perf_counter() - started_at
+    return result
+
+
+# Сценарии
+
+async def run_start(main, stack, args, update_ids) -> Result:
+    """Наплыв новых пользователей: /start с выдачей пробного ключа."""
+    first = FIRST_USER_ID + args.users
+    updates = [message_update(next(update_ids), first + i, '/start') for i in range(args.requests)]
+    result = await replay(main, 'start', updates, args.concurrency)
+    result.extra['ключей создано'] = sum(outline.calls['POST /access-keys'] for outline in stack.outlines)
+    return result
+
+
+async def run_my_keys(main, stack, args, update_ids) -> Result:
+    """Всплеск нажатий "Мои ключи" у существующих пользователей."""
+    users = [FIRST_USER_ID + random.randrange(args.users) for _ in range(args.requests)]
+    updates = [callback_update(next(update_ids), user_id, 'my_keys') for user_id in users]
+    result = await replay(main, 'my_keys', updates, args.concurrency)
+    result.extra['запросов списка ключей к Outline'] = sum(outline.calls['GET /access-keys/'] for outline in stack.outlines)
+    return result
+
+
+async def run_payments(main, stack, args, update_ids) -> Result:
+    """Проверки оплаты: по каждому счету несколько нажатий "Я оплатил", половина счетов оплачена."""
+    labels = []
+    for i in range(max(1, args.requests // 4)):
+        user_id = FIRST_USER_ID + random.randrange(args.users)
+        label = f"{user_id}_{int(time.time())}_{i}"
+        price = config.PRICE_NEW[5]
+        await main.payment_engine.register(label, user_id, price, 5)
+        if i % 2 == 0:
+            stack.yoomoney.paid[label] = float(price)
+        labels.append((user_id, label))
+
+    updates = [callback_update(next(update_ids), user_id, f"check_payment_:{label}")
+               for _ in range(4) for user_id, label in labels]
+    random.shuffle(updates)
+    result = await replay(main, 'payments', updates, args.concurrency)
+    for _ in range(300): # выдача ключей по найденным оплатам идет в фоне
+        states = [main.payment_engine.status(label) for _, label in labels]
+        if 'paid' not in states:
+            break
+        await asyncio.sleep(0.1)
+    result.extra['запросов истории ЮMoney'] = stack.yoomoney.calls
+    result.extra['счетов'] = len(labels)
+    result.extra['выдано'] = states.count('fulfilled')
+    return result
+
+
+async def run_sweep(main, stack, args, update_ids) -> Result:
+    """Плановая проверка всех ключей с массовым истечением сроков."""
+    result = Result('sweep')
+    started_at = time.perf_counter()
+    report = await main.sweeper.sweep()
+    result.elapsed = time.perf_counter() - started_at
+    result.latencies.append(result.elapsed)
+    result.errors = report.delete_failed + report.notify_failed
+    result.extra.update(проверено=report.checked, удалено=report.deleted, уведомлений=report.notified,
+                        пропущены_серверы=report.skipped_servers or 'нет')
+    return result
+
+
+SCENARIOS = {'start': run_start, 'my_keys': run_my_keys, 'payments': run_payments, 'sweep': run_sweep}
+
+
+async def run(args):
+    stack = FakeStack(args.port, args.outline_servers, args.telegram_latency, args.outline_latency,
+                      args.outline_error_rate, args.yoomoney_latency)
+    workdir = tempfile.mkdtemp(prefix='vpn_bot_bench_')
+    generate_data(workdir, stack, args.users, args.expired_share)
+    stack.start()
+    configure(stack, args)
+    os.chdir(workdir)
+    if args.storage == 'sqlite':
+        from storage import import_flat_files
+        import_flat_files()
+
+    import main  # импортируется после настройки config и перехода в каталог с данными
+    logging.getLogger().setLevel(logging.WARNING)
+
+    main.ensure_dirs_exist()
+    loaded_at = time.perf_counter()
+    main.store.load()
+    print(f"Хранилище ({args.storage}) загружено за {time.perf_counter() - loaded_at:.2f} с, "
+          f"пользователей {args.users}, RSS {peak_rss_mb():.0f} МБ")
+    main.log_writer.start()
+    main.expiration_scheduler.load()
+    main.payment_engine.load()
+    main.startup.mark_ready('store')
+    startup_task = asyncio.create_task(main.startup.run())
+    if not await main.startup.wait(timeout=30):
+        print(f"Зависимости не готовы: {main.startup.errors}")
+    pool_task = asyncio.create_task(main.outline_pool.run())
+    engine_task = asyncio.create_task(main.payment_engine.run())
+    key_pool_task = None
+    if config.KEY_POOL_ENABLED:
+        main.key_pool.load()
+        await main.key_pool.refill()
+        print(f"Запас ключей: {len(main.key_pool)}")
+        key_pool_task = asyncio.create_task(main.key_pool.run())
+
+    update_ids = iter(range(1, 10 ** 9))
+    try:
+        for name in args.workloads:
+            print((await SCENARIOS[name](main, stack, args, update_ids)).summary(), flush=True)
+        print(f"Вызовы Bot API: {dict(stack.telegram.calls.most_common())}")
+        outline_calls = sum((outline.calls for outline in stack.outlines), Counter())
+        print(f"Вызовы Outline API: {dict(outline_calls.most_common())}")
+    finally:
+        background = [task for task in (startup_task, pool_task, engine_task, key_pool_task) if task]
+        # и фоновые задачи бота: обновления снимков ключей, переименования ключей запаса
+        background += [task for task in asyncio.all_tasks() if task is not asyncio.current_task() and task not in background]
+        for task in background:
+            task.cancel()
+        # дожидаемся отмены, чтобы поздние записи не попали в data/ репозитория после смены каталога
+        await asyncio.gather(*background, return_exceptions=True)
+        await main.log_writer.close()
+        await main.dp.storage.close()
+        await (await main.bot.get_session()).close()
+        stack.stop()
+        os.chdir(ROOT)
+        if not args.keep_data:
+            shutil.rmtree(workdir, ignore_errors=True)
+        else:
+            print(f"Данные оставлены в {workdir}")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=10000, help="пользователей (и ключей) в сгенерированном data/")
+    parser.add_argument('--requests', type=int, default=2000, help="обновлений в каждом сценарии")
+    parser.add_argument('--concurrency', type=int, default=200, help="одновременно обрабатываемых обновлений")
+    parser.add_argument('--workloads', default=','.join(WORKLOADS), help=f"сценарии через запятую: {', '.join(WORKLOADS)}")
+    parser.add_argument('--expired-share', type=float, default=0.1, help="доля ключей с истекшим сроком")
+    parser.add_argument('--outline-servers', type=int, default=2)
+    parser.add_argument('--outline-latency', type=float, default=0.02, help="секунд на запрос к Outline")
+    parser.add_argument('--outline-error-rate', type=float, default=0.0, help="доля запросов к Outline с ошибкой 500")
+    parser.add_argument('--telegram-latency', type=float, default=0.01)
+    parser.add_argument('--yoomoney-latency', type=float, default=0.1)
+    parser.add_argument('--storage', choices=('files', 'sqlite'), default='files')
+    parser.add_argument('--fsm-storage', choices=('memory', 'sqlite'), default='memory')
+    parser.add_argument('--key-pool', type=int, default=0, help="ключей каждого тарифа в запасе до начала сценариев (0 — без запаса)")
+    parser.add_argument('--port', type=int, default=18555)
+    parser.add_argument('--keep-data', action='store_true', help="не удалять сгенерированный каталог")
+    args = parser.parse_args(argv)
+    args.workloads = [name.strip() for name in args.workloads.split(',') if name.strip()]
+    unknown = set(args.workloads) - set(WORKLOADS)
+    if unknown:
+        parser.error(f"неизвестные сценарии: {', '.join(sorted(unknown))}")
+    return args
+
+
+if __name__ == '__main__':
+    asyncio.run(run(parse_args()))
@@ -0,0 +1,182 @@
+import asyncio
+import json
+import logging
+import os
+import time
+from dataclasses import asdict, dataclass
+
+import config
+from fileio import read_file, rewrite_file
+from ratelimit import SENT, UNREACHABLE, TelegramRateLimiter
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class BroadcastState:
+    from_chat_id: int
+    message_id: int
+    total: int
+    cursor: str = None  # последний обработанный пользователь (в порядке storage.user_order)
+    sent: int = 0
+    unreachable: int = 0
+    failed: int = 0
+    skipped: int = 0
+    started_at: float = 0.0
+
+    @property
+    def processed(self) -> int:
+        return self.sent + self.unreachable + self.failed + self.skipped
+
+
+class Broadcaster:
+    """Рассылка сообщения администратора всем пользователям.
+
+    Получатели читаются из хранилища потоком, сообщение копируется (copy_message) пачками
+    по BROADCAST_BATCH_SIZE. Отправка идет через общий лимитер бота, причем рассылке достается
+    не больше BROADCAST_RATE_LIMIT сообщений в секунду, чтобы она не забирала весь лимит у ответов
+    бота. После каждой пачки прогресс сохраняется в BROADCAST_CHECKPOINT_FILE, и после перезапуска
+    рассылка продолжается со следующей пачки (получатели незавершенной пачки могут получить
+    сообщение повторно). Прогресс удаляется только по /mailing_stop, а не при остановке бота.
+    Заблокировавшие бота отмечаются в хранилище и больше не получают рассылок.
+    """
+
+    def __init__(self, bot, store, limiter: TelegramRateLimiter):
+        self.bot = bot
+        self.store = store
+        self.limiter = TelegramRateLimiter(config.BROADCAST_RATE_LIMIT, parent=limiter)
+        self.state = None
+        self._task = None
+        self._stopping = False  # остановка по команде администратора, а не вместе с ботом
+        self._report_message_id = None
+        self._run_started_at = 0.0
+        self._run_processed = 0
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    def start(self, from_chat_id: int, message_id: int) -> bool:
+        if self.running:
+            return False
+        self.state = BroadcastState(from_chat_id, message_id, self.store.count_users(), started_at=time.time())
+        self._launch()
+        return True
+
+    def resume(self) -> bool:
+        """Продолжает рассылку, прерванную остановкой бота."""
+        if self.running or not os.path.exists(config.BROADCAST_CHECKPOINT_FILE):
+            return False
+        data = read_file(config.BROADCAST_CHECKPOINT_FILE)
+        try:
+            self.state = BroadcastState(**json.loads(data))
+        except (ValueError, TypeError) as e:
+            logger.error(f"Некорректный файл прогресса рассылки {config.BROADCAST_CHECKPOINT_FILE}: {e}")
+            return False
+        logger.info(f"Возобновление рассылки: обработано {self.state.processed} из {self.state.total}")
+        self._launch()
+        return True
+
+    def stop(self) -> bool:
+        if not self.running:
+            return False
+        self._stopping = True
+        self._task.cancel()
+        return True
+
+    def _launch(self):
+        self._stopping = False
+        self._report_message_id = None
+        self._run_started_at = time.monotonic()
+        self._run_processed = 0
+        self._task = asyncio.create_task(self._run())
+
+    # Отправка
+
+    async def _send(self, user_id: str):
+        state = self.state
+        if self.store.is_unreachable(user_id):
+            state.skipped += 1
+            return
+        result = await self.limiter.deliver(
+            user_id, lambda: self.bot.copy_message(user_id, state.from_chat_id, state.message_id))
+        if result == SENT:
+            state.sent += 1
+        elif result == UNREACHABLE:
+            state.unreachable += 1
+            await self.store.mark_unreachable(user_id)
+        else:
+            state.failed += 1
+
+    async def _send_batch(self, batch):
+        await asyncio.gather(*(self._send(user_id) for user_id in batch))
+        self.state.cursor = batch[-1]
+        self._run_processed += len(batch)
+        await self._save_checkpoint()
+
+    async def _run(self):
+        state = self.state
+        last_report_at = time.monotonic()
+        try:
+            await self._save_checkpoint()
+            await self._report("запущена" if state.cursor is None else "возобновлена")
+            batch = []
+            for user_id in self.store.iter_users(after=state.cursor):
+                batch.append(user_id)
+                if len(batch) < config.BROADCAST_BATCH_SIZE:
+                    continue
+                await self._send_batch(batch)
+                batch = []
+                if time.monotonic() - last_report_at >= config.BROADCAST_REPORT_INTERVAL:
+                    last_report_at = time.monotonic()
+                    await self._report("идет")
+            if batch:
+                await self._send_batch(batch)
+        except asyncio.CancelledError:
+            if self._stopping:
+                self._remove_checkpoint()
+                await self._report("остановлена", final=True)
+            else: # бот останавливается: прогресс сохранен, рассылка возобновится после перезапуска
+                logger.info(f"Рассылка прервана остановкой бота на {state.processed} из {state.total}, "
+                            f"продолжится после перезапуска")
+            raise
+        except Exception as e: # прогресс сохранен, рассылка продолжится после перезапуска
+            logger.error(f"Рассылка прервана ошибкой: {e}")
+            await self._report(f"прервана ошибкой ({e})", final=True)
+            return
+        self._remove_checkpoint()
+        await self._report("завершена", final=True)
+
+    # Прогресс
+
+    async def _save_checkpoint(self):
+        lines = [json.dumps(asdict(self.state))]
+        await asyncio.get_running_loop().run_in_executor(None, rewrite_file, config.BROADCAST_CHECKPOINT_FILE, lines)
+
+    def _remove_checkpoint(self):
+        try:
+            os.remove(config.BROADCAST_CHECKPOINT_FILE)
+        except FileNotFoundError:
+            pass
+
+    def progress_text(self, status: str) -> str:
+        state = self.state
+        elapsed = time.monotonic() - self._run_started_at
+        rate = self._run_processed / elapsed if elapsed > 0 else 0.0
+        percent = state.processed * 100 // state.total if state.total else 100
+        return (f"📣 Рассылка {status}: обработано {state.processed} из {state.total} ({percent}%)\n"
+                f"Доставлено: {state.sent}, заблокировали бота: {state.unreachable}, ошибок: {state.failed}, "
+                f"пропущено: {state.skipped}\nСкорость: {rate:.1f} сообщений/с")
+
+    async def _report(self, status: str, final: bool = False):
+        """Промежуточный прогресс обновляется в одном сообщении поддержке, итог приходит отдельным."""
+        text = self.progress_text(status)
+        logger.info(text.replace('\n', '; '))
+        try:
+            if self._report_message_id and not final:
+                await self.bot.edit_message_text(text, config.support_account, self._report_message_id)
+            else:
+                message = await self.bot.send_message(config.support_account, text)
+                self._report_message_id = message.message_id
+        except Exception as e:
+            logger.error(f"Не удалось отправить отчет о рассылке: {e}")
@@ -3,10 +3,51 @@ support_account = 123456789  # Telegram ID аккаунта поддержки
 
 yoomoney_token = 'ВАШ_YOOMONEY_TOKEN'
 yoomoney_wallet = 'ВАШ_НОМЕР_КОШЕЛЬКА'
+yoomoney_notification_secret = ''  # секрет для проверки HTTP-уведомлений (настройки уведомлений кошелька ЮMoney)
+
+# Адреса API: None — официальные серверы. Можно указать локальный Bot API сервер
+# (например 'http://localhost:8081') или заглушки нагрузочного теста из bench/
+TELEGRAM_API_SERVER = None
+YOOMONEY_API_URL = None  # базовый адрес вида 'https://yoomoney.ru/api/'
 
 outline_api_url = "https://your.outline.server:12345/XXXXXXXXXXXX"
 outline_cert_sha256 = "XXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXX"
 
+# Серверы Outline; name записывается в data/keys_ids.txt, weight — относительная емкость сервера
+OUTLINE_SERVERS = [
+    {'name': 'main', 'api_url': outline_api_url, 'cert_sha256': outline_cert_sha256, 'weight': 1.0},
+]
+OUTLINE_API_TIMEOUT = 15  # секунд на один запрос к Outline API
+OUTLINE_API_MAX_WORKERS = 8  # одновременных запросов к Outline API
+OUTLINE_KEYS_CACHE_TTL = 30  # секунд между обновлениями общего снимка ключей и трафика
+
+# Фоновая проверка ключей. Сроки действия обрабатывает планировщик точно в срок, трафик — наблюдатель
+# за расходом; полная сверка с Outline (пропавшие ключи и все, что пропущено) — раз в SWEEP_INTERVAL
+SWEEP_INTERVAL = 6 * 3600  # секунд между полными проверками
+USAGE_POLL_MIN_INTERVAL = 15  # секунд: частый опрос трафика, когда ключ близок к порогу
+USAGE_POLL_MAX_INTERVAL = 300  # секунд: редкий опрос, когда до порогов далеко
+LOW_TRAFFIC_THRESHOLD = 0.1  # доля оставшегося трафика для предупреждения
+SWEEP_DELETE_CONCURRENCY = 4  # одновременных удалений ключей на один сервер Outline
+SWEEP_SEND_CONCURRENCY = 20  # одновременных отправок уведомлений
+TELEGRAM_RATE_LIMIT = 25  # исходящих сообщений в секунду на весь бот (лимит Telegram — около 30)
+
+# Сверка записей о ключах с серверами Outline (/reconcile — пробный запуск, /reconcile apply — применить)
+RECONCILE_INTERVAL = 24 * 3600  # секунд между фоновыми сверками
+RECONCILE_AUTO_APPLY = False  # False — фоновая сверка только присылает отчет поддержке; True — сама чистит файлы и возвращает/удаляет потерянные ключи
+RECONCILE_GRACE = 600  # секунд: более молодые ключи без записи не трогаем, их создание может еще идти
+
+FREE_TRIAL_GB = 3  # пробный ключ при первом /start
+
+# Запас заранее созданных ключей: выдача без обращений к Outline. Размер запаса каждого тарифа —
+# спрос за KEY_POOL_DEMAND_WINDOW секунд, пересчитанный на KEY_POOL_HORIZON секунд вперед
+KEY_POOL_ENABLED = True
+KEY_POOL_MIN_SIZE = 1  # ключей каждого тарифа даже без спроса
+KEY_POOL_MAX_SIZE = 20
+KEY_POOL_DEMAND_WINDOW = 3600
+KEY_POOL_HORIZON = 900
+KEY_POOL_REFILL_INTERVAL = 60  # секунд между проверками запаса (после выдачи — сразу)
+KEY_POOL_REFILL_CONCURRENCY = 2  # одновременно создаваемых ключей
+
 # Стоимость для создания новых ключей
 PRICE_NEW = {
     5: 35,
@@ -27,11 +68,103 @@ PRICE_UPGRADE = {
     999: 530   # 3 месяца безлимит
 }
 
+# Вебхук вместо long polling. WEBHOOK_HOST — внешний https-адрес, на который Telegram шлет обновления
+WEBHOOK_ENABLED = False
+WEBHOOK_HOST = 'https://your.domain'
+WEBHOOK_PATH = '/telegram/webhook'
+WEBHOOK_SECRET = ''  # значение заголовка X-Telegram-Bot-Api-Secret-Token; пусто — генерируется при запуске
+WEBHOOK_MAX_CONNECTIONS = 40
+WEBHOOK_DRAIN_TIMEOUT = 30  # секунд на завершение обработчиков при остановке
+WEBAPP_HOST = '0.0.0.0'
+WEBAPP_PORT = 8080
+
+# Запуск: данные загружаются в фоне, Outline и ЮMoney проверяются пробами параллельно. Пока нужное
+# обновлению не готово, пользователь получает ответ "бот запускается" (см. READINESS_REQUIREMENTS)
+STARTUP_PROCESS_BACKLOG = False  # True — обработать обновления, накопившиеся за перезапуск, а не пропускать (с вебхуком они доставляются всегда)
+STARTUP_BACKLOG_WAIT = 120  # секунд, сколько накопившееся обновление ждет готовности при запуске
+READINESS_WAIT = 3  # секунд, сколько новое обновление ждет готовности, прежде чем получить ответ "бот запускается"
+READINESS_PROBE_INTERVAL = 30  # секунд между пробами готовой зависимости
+READINESS_PROBE_TIMEOUT = 20  # секунд на одну пробу
+READINESS_RETRY_MIN = 1  # секунд до повтора неудачной пробы, удваивается с каждой неудачей
+READINESS_RETRY_MAX = 60
+# Что нужно обработчику: ключ — команда без "/" или начало callback_data, '*' — всем обновлениям.
+# store — данные с диска, outline — хотя бы один сервер Outline, yoomoney — API ЮMoney
+READINESS_REQUIREMENTS = {
+    '*': ('store',),  # /start тоже: Outline нужен только для пробного ключа нового пользователя, его проверяет обработчик
+    'my_keys': ('outline',),
+    'buy_new_': ('yoomoney',),
+    'check_payment_': ('yoomoney',),
+}
+
+# Подтверждение оплат: HTTP-уведомления ЮMoney и фоновый опрос истории операций
+YOOMONEY_NOTIFICATIONS_ENABLED = False
+YOOMONEY_NOTIFY_PATH = '/yoomoney/notify'
+PAYMENTS_WEBAPP_HOST = '0.0.0.0'  # без вебхука уведомления принимает отдельный сервер
+PAYMENTS_WEBAPP_PORT = 8081
+YOOMONEY_API_TIMEOUT = 15  # секунд на запрос истории операций
+PAYMENT_POLL_INTERVAL = 20  # секунд между опросами истории, пока есть ожидающие оплаты
+PAYMENT_CHECK_CACHE_TTL = 10  # повторное "Я оплатил" раньше этого срока отвечается из кэша
+PAYMENT_HISTORY_RECORDS = 100  # операций на одной странице истории
+PAYMENT_HISTORY_MAX_PAGES = 20  # страниц истории за один опрос
+PAYMENT_PENDING_TTL = 24 * 3600  # сколько ждать оплату по выставленному счету
+
+# Промокоды (/promo_gen): строка promocodes.txt — код||бонус ГБ||лимит использований||срок (ГГГГ-ММ-ДД)
+PROMO_DEFAULT_MAX_USES = 1  # лимит для строк без него, в том числе старых из одного кода; 0 — без ограничения
+PROMO_CODE_LENGTH = 8
+PROMO_GENERATE_MAX = 10000  # кодов за одну команду
+
+# Аналитика (/report [дней], /report_csv [daily]): журналы дочитываются с сохраненного смещения
+ANALYTICS_INTERVAL = 60  # секунд между фоновыми дочитываниями журналов покупок и регистраций
+ANALYTICS_REPORT_DAYS = 7  # дней в /report по умолчанию
+
+# Рассылка (/mailing)
+BROADCAST_RATE_LIMIT = 15  # сообщений в секунду из общего TELEGRAM_RATE_LIMIT; остаток — ответам бота
+BROADCAST_BATCH_SIZE = 100  # получателей между сохранениями прогресса
+BROADCAST_REPORT_INTERVAL = 60  # секунд между отчетами о ходе рассылки в поддержку
+
+# Защита от флуда: (число действий, окно в секундах) на одного пользователя. Ключ THROTTLE_RATES —
+# команда без "/" или начало callback_data; лишние обновления отбрасываются до обработчиков
+THROTTLE_DEFAULT_RATE = (30, 60)  # все действия пользователя вместе
+THROTTLE_RATES = {
+    'start': (5, 60),
+    'check_payment_': (6, 60),
+    'buy_new_': (10, 60),
+    'my_keys': (10, 60),
+}
+THROTTLE_MAX_BUCKETS = 50000  # окон в памяти; самые давние вытесняются
+BANNED_USERS_RELOAD_INTERVAL = 5  # секунд между проверками изменения data/banned_users.txt
+
+# Метрики в формате Prometheus: http://METRICS_HOST:METRICS_PORT/metrics
+METRICS_ENABLED = True
+METRICS_HOST = '127.0.0.1'  # только локальный доступ
+METRICS_PORT = 9101
+
+# Хранилище данных: 'files' — текстовые файлы из data/, 'sqlite' — база SQLite (перенос: python migrate_to_sqlite.py)
+STORAGE_BACKEND = 'files'
+SQLITE_DB_FILE = 'data/bot.sqlite3'
+
+# Состояния диалогов (FSM): 'sqlite' — переживают перезапуск и общие для нескольких процессов бота,
+# 'redis' — через Redis (нужен пакет redis), 'memory' — теряются при перезапуске
+FSM_STORAGE_BACKEND = 'sqlite'
+FSM_SQLITE_FILE = 'data/fsm.sqlite3'
+FSM_REDIS_HOST = 'localhost'
+FSM_REDIS_PORT = 6379
+FSM_REDIS_DB = 0
+FSM_STATE_TTL = 7 * 24 * 3600  # незавершенный диалог сбрасывается через столько секунд без изменений
+FSM_FLUSH_INTERVAL = 0.2  # секунд накопления изменений перед записью в SQLite (0 — писать сразу)
+
+# Фоновая запись журналов (data/*.txt)
+LOG_FLUSH_INTERVAL = 1.0  # секунд между сбросами буферов на диск
+LOG_FLUSH_SIZE = 64 * 1024  # сброс раньше срока, если накопилось столько байт
+LOG_FSYNC = True  # fsync после каждого сброса
+
 # Пути к файлам
 USERS_FILE = 'data/users.txt'
 USERS_USERNAME_FILE = 'data/users_username.txt'
 KEYS_IDS_FILE = 'data/keys_ids.txt'
 USERS_KEYS_EXPIRATIONS_FILE = 'data/users_keys_expirations.txt'
+UNREACHABLE_USERS_FILE = 'data/unreachable_users.txt'  # заблокировали бота, рассылка их пропускает
+BROADCAST_CHECKPOINT_FILE = 'data/broadcast_checkpoint.json'
 BANNED_USERS_FILE = 'data/banned_users.txt'
 CHAT_LOG_FILE = 'data/chatlog.txt'
 PROMOCODES_FILE = 'data/promocodes/promocodes.txt'
@@ -39,7 +172,14 @@ PROMO_ACTIVATION_LOGS = 'data/promocodes/activation_logs.txt'
 PROMO_DISCOUNT_DIR = 'data/promocodes/discounts/'
 TRANSACTION_LOGS_FILE = 'data/transaction_logs/buyers.txt'
 UNLIMITED_BUYERS_LOGS = 'data/transaction_logs/unlimited_buyers.txt'
+PAYMENTS_LEDGER_FILE = 'data/transaction_logs/payments_ledger.txt'
 NOTIFIED_KEYS_FILE = 'data/notified_keys_ids.txt'
+KEY_POOL_FILE = 'data/key_pool.txt'
+ANALYTICS_STATE_FILE = 'data/analytics_state.json'  # смещения в журналах и накопленные итоги
+
+# Тексты из этих папок перечитываются без перезапуска, если изменился файл
+TEMPLATE_DIRS = ['data/texts', 'data/notifications']
+TEMPLATES_RELOAD_INTERVAL = 5  # секунд между проверками времени изменения файлов
 
 # Текста
 START_MESSAGE_FILE = 'data/texts/start_message.txt'
@@ -0,0 +1,141 @@
+import asyncio
+import logging
+import os
+
+import config
+from metrics import track_call
+
+logger = logging.getLogger(__name__)
+
+
+def read_file(path, default=""):
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return f.read().strip()
+    except FileNotFoundError:
+        logger.warning(f"Файл не найден: {path}. Возвращено значение по умолчанию.")
+        return default
+
+def read_file_lines(path):
+    content = read_file(path)
+    return content.splitlines() if content else []
+
+async def append_to_file(path, content):
+    if log_writer.running: # запись уйдет в файл пачкой из фоновой задачи
+        log_writer.write(path, str(content))
+        return
+    try:
+        with open(path, 'a', encoding='utf-8') as f:
+            f.write(str(content) + '\n')
+    except IOError as e:
+        logger.error(f"Ошибка записи в файл {path}: {e}")
+
+def rewrite_file(path, lines): # атомарная перезапись: пишем во временный файл и подменяем им исходный
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        f.write(''.join(f"{line}\n" for line in lines))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+class LogWriter:
+    """Фоновая запись строк во все журналы.
+
+    append_to_file только ставит строку в буфер своего файла. Буферы сбрасываются пачкой
+    в потоке раз в LOG_FLUSH_INTERVAL секунд или при накоплении LOG_FLUSH_SIZE байт;
+    файлы держатся открытыми, после записи вызывается fsync. Порядок строк внутри файла
+    сохраняется. При остановке все буферы дописываются и файлы закрываются.
+    """
+
+    def __init__(self):
+        self.running = False
+        self._buffers = {}  # path -> [строки]
+        self._buffered_bytes = 0
+        self._handles = {}
+        self._lock = asyncio.Lock()
+        self._wakeup = asyncio.Event()
+        self._task = None
+
+    @property
+    def queue_size(self) -> int:
+        return sum(len(lines) for lines in self._buffers.values())
+
+    def write(self, path, line):
+        self._buffers.setdefault(path, []).append(line + '\n')
+        self._buffered_bytes += len(line) + 1
+        if self._buffered_bytes >= config.LOG_FLUSH_SIZE:
+            self._wakeup.set()
+
+    def _write_batches(self, batches): # выполняется в потоке
+        for path, lines in batches.items():
+            try:
+                f = self._handles.get(path)
+                if f is None:
+                    f = self._handles[path] = open(path, 'a', encoding='utf-8')
+                f.write(''.join(lines))
+                f.flush()
+                if config.LOG_FSYNC:
+                    os.fsync(f.fileno())
+            except (IOError, OSError) as e:
+                logger.error(f"Ошибка записи в файл {path}: {e}")
+
+    def _close_handle(self, path):
+        f = self._handles.pop(path, None)
+        if f is not None:
+            f.close()
+
+    async def flush(self):
+        async with self._lock:
+            batches, self._buffers, self._buffered_bytes = self._buffers, {}, 0
+            if batches:
+                with track_call('disk', 'logs', 'flush'):
+                    await asyncio.get_running_loop().run_in_executor(None, self._write_batches, batches)
+
+    async def rewrite(self, path, make_lines):
+        """Атомарно перезаписывает файл строками make_lines().
+
+        Используется для файлов, чье содержимое целиком восстанавливается из индекса в памяти:
+        еще не записанные строки этого файла уже отражены в индексе, поэтому буфер отбрасывается,
+        а make_lines() вызывается под блокировкой, чтобы не потерять строки, добавленные позже.
+        """
+        if not self.running:
+            rewrite_file(path, make_lines())
+            return
+        async with self._lock:
+            pending = self._buffers.pop(path, [])
+            self._buffered_bytes -= sum(len(line) for line in pending)
+            lines = make_lines()
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(None, self._close_handle, path)
+            await loop.run_in_executor(None, rewrite_file, path, lines)
+
+    def start(self):
+        self.running = True
+        self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), config.LOG_FLUSH_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"Ошибка фоновой записи журналов: {e}")
+
+    async def close(self):
+        if not self.running:
+            return
+        self.running = False
+        if self._task:
+            self._task.cancel()
+        await self.flush()
+        for path in list(self._handles):
+            self._close_handle(path)
+        logger.info("Журналы дописаны и закрыты.")
+
+
+log_writer = LogWriter()
@@ -0,0 +1,178 @@
+import asyncio
+import copy
+import json
+import logging
+import sqlite3
+import time
+
+from aiogram.contrib.fsm_storage.memory import MemoryStorage
+from aiogram.dispatcher.storage import BaseStorage
+
+import config
+
+logger = logging.getLogger(__name__)
+
+FSM_SCHEMA = """
+CREATE TABLE IF NOT EXISTS fsm (
+    chat TEXT NOT NULL,
+    user TEXT NOT NULL,
+    state TEXT,
+    data TEXT NOT NULL,
+    bucket TEXT NOT NULL,
+    updated_at INTEGER NOT NULL,
+    PRIMARY KEY (chat, user)
+);
+CREATE INDEX IF NOT EXISTS fsm_updated_at ON fsm (updated_at);
+"""
+PURGE_INTERVAL = 3600  # секунд между удалениями устаревших состояний из базы
+
+
+def empty_record() -> dict:
+    return {'state': None, 'data': {}, 'bucket': {}}
+
+
+class SQLiteStorage(BaseStorage):
+    """Состояния диалогов (FSM) в SQLite вместо MemoryStorage.
+
+    Переживает перезапуск и может использоваться несколькими процессами бота с одной базой
+    (режим WAL). Изменения копятся в памяти и записываются одной транзакцией не реже раза
+    в FSM_FLUSH_INTERVAL секунд; до записи процесс читает собственные изменения из буфера.
+    Состояние, не менявшееся дольше FSM_STATE_TTL секунд, считается сброшенным.
+    """
+
+    def __init__(self, path: str = None, state_ttl: int = None, flush_interval: float = None):
+        self.path = path or config.FSM_SQLITE_FILE
+        self.state_ttl = config.FSM_STATE_TTL if state_ttl is None else state_ttl
+        self.flush_interval = config.FSM_FLUSH_INTERVAL if flush_interval is None else flush_interval
+        self._conn = None
+        self._pending = {}  # (chat, user) -> запись, ожидающая сохранения
+        self._flush_task = None
+        self._purged_at = 0.0
+
+    @property
+    def conn(self) -> sqlite3.Connection:
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path, isolation_level=None, timeout=5, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.executescript(FSM_SCHEMA)
+        return self._conn
+
+    # Чтение и запись записей
+
+    def _load(self, chat: str, user: str) -> dict:
+        key = (chat, user)
+        if key in self._pending:
+            return copy.deepcopy(self._pending[key])
+        row = self.conn.execute("SELECT state, data, bucket, updated_at FROM fsm WHERE chat = ? AND user = ?",
+                                (chat, user)).fetchone()
+        if row is None or (self.state_ttl and row[3] < time.time() - self.state_ttl):
+            return empty_record()
+        return {'state': row[0], 'data': json.loads(row[1]), 'bucket': json.loads(row[2])}
+
+    async def _save(self, chat: str, user: str, record: dict):
+        self._pending[(chat, user)] = record
+        if self.flush_interval <= 0:
+            self.flush()
+        elif self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.flush_interval)
+        try:
+            self.flush()
+        except sqlite3.Error as e:
+            logger.error(f"Ошибка записи состояний FSM в {self.path}: {e}")
+
+    def flush(self):
+        if not self._pending:
+            return
+        pending, self._pending = self._pending, {}
+        now = int(time.time())
+        rows = [(chat, user, r['state'], json.dumps(r['data'], ensure_ascii=False),
+                 json.dumps(r['bucket'], ensure_ascii=False), now)
+                for (chat, user), r in pending.items() if r != empty_record()]
+        removed = [key for key, r in pending.items() if r == empty_record()]
+        try:
+            with self.conn:
+                self.conn.execute("BEGIN")
+                self.conn.executemany("INSERT OR REPLACE INTO fsm VALUES (?, ?, ?, ?, ?, ?)", rows)
+                self.conn.executemany("DELETE FROM fsm WHERE chat = ? AND user = ?", removed)
+                if self.state_ttl and time.monotonic() - self._purged_at > PURGE_INTERVAL:
+                    self._purged_at = time.monotonic()
+                    self.conn.execute("DELETE FROM fsm WHERE updated_at < ?", (now - self.state_ttl,))
+        except sqlite3.Error:
+            for key, record in pending.items(): # не теряем изменения, повторим при следующей записи
+                self._pending.setdefault(key, record)
+            raise
+
+    def _address(self, chat, user):
+        chat, user = self.check_address(chat=chat, user=user)
+        return str(chat), str(user)
+
+    # Интерфейс BaseStorage
+
+    async def get_state(self, *, chat=None, user=None, default=None):
+        record = self._load(*self._address(chat, user))
+        return record['state'] if record['state'] is not None else self.resolve_state(default)
+
+    async def get_data(self, *, chat=None, user=None, default=None):
+        return self._load(*self._address(chat, user))['data'] or (default or {})
+
+    async def set_state(self, *, chat=None, user=None, state=None):
+        chat, user = self._address(chat, user)
+        record = self._load(chat, user)
+        record['state'] = self.resolve_state(state)
+        await self._save(chat, user, record)
+
+    async def set_data(self, *, chat=None, user=None, data=None):
+        chat, user = self._address(chat, user)
+        record = self._load(chat, user)
+        record['data'] = copy.deepcopy(data or {})
+        await self._save(chat, user, record)
+
+    async def update_data(self, *, chat=None, user=None, data=None, **kwargs):
+        chat, user = self._address(chat, user)
+        record = self._load(chat, user)
+        record['data'].update(data or {}, **kwargs)
+        await self._save(chat, user, record)
+
+    def has_bucket(self):
+        return True
+
+    async def get_bucket(self, *, chat=None, user=None, default=None):
+        return self._load(*self._address(chat, user))['bucket'] or (default or {})
+
+    async def set_bucket(self, *, chat=None, user=None, bucket=None):
+        chat, user = self._address(chat, user)
+        record = self._load(chat, user)
+        record['bucket'] = copy.deepcopy(bucket or {})
+        await self._save(chat, user, record)
+
+    async def update_bucket(self, *, chat=None, user=None, bucket=None, **kwargs):
+        chat, user = self._address(chat, user)
+        record = self._load(chat, user)
+        record['bucket'].update(bucket or {}, **kwargs)
+        await self._save(chat, user, record)
+
+    async def close(self):
+        if self._flush_task is not None and not self._flush_task.done():
+            self._flush_task.cancel()
+        self.flush()
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    async def wait_closed(self):
+        pass
+
+
+def create_fsm_storage():
+    if config.FSM_STORAGE_BACKEND == 'sqlite':
+        return SQLiteStorage()
+    if config.FSM_STORAGE_BACKEND == 'redis':
+        from aiogram.contrib.fsm_storage.redis import RedisStorage2 # нужен пакет redis
+        return RedisStorage2(config.FSM_REDIS_HOST, config.FSM_REDIS_PORT, db=config.FSM_REDIS_DB,
+                             prefix='vpn_bot_fsm', state_ttl=config.FSM_STATE_TTL, data_ttl=config.FSM_STATE_TTL,
+                             bucket_ttl=config.FSM_STATE_TTL)
+    return MemoryStorage()
@@ -0,0 +1,232 @@
+import asyncio
+import logging
+import math
+import time
+from collections import defaultdict, deque
+from dataclasses import dataclass
+
+import config
+from fileio import append_to_file, log_writer, read_file_lines, rewrite_file
+from metrics import REGISTRY
+from ratelimit import retry_with_backoff
+
+logger = logging.getLogger(__name__)
+
+pool_takes = REGISTRY.counter('bot_key_pool_takes_total', "Запросов ключа из запаса: hit — выдан, miss — запас пуст", ('result',))
+
+POOL_NAME_PREFIX = 'Pool'
+UNLIMITED = 0  # класс безлимитных ключей: тарифы 998 и 999 отличаются только сроком
+
+
+@dataclass
+class PooledKey:
+    server: str
+    key_id: str
+    gb_class: int
+    access_url: str
+    created_at: int
+
+
+def key_class(gb_limit: int) -> int:
+    """Класс ключа в запасе — лимит трафика в ГБ, у безлимитных тарифов один общий класс."""
+    return gb_limit if 0 < gb_limit < 998 else UNLIMITED
+
+
+def tariff_classes() -> set:
+    return {key_class(gb_limit) for gb_limit in config.PRICE_NEW} | {key_class(config.FREE_TRIAL_GB)}
+
+
+class KeyPool:
+    """Запас заранее созданных ключей Outline для каждого класса тарифа.
+
+    Ключ в запасе уже создан на наименее загруженном сервере, назван Pool_{ГБ}_{время} и имеет
+    лимит трафика своего класса, поэтому при выдаче остается только записать его пользователю;
+    переименование в {префикс}_{user_id}_{время} выполняется в фоне. Запас пополняется фоновой
+    задачей; размер каждого класса — спрос за последние KEY_POOL_DEMAND_WINDOW секунд, пересчитанный
+    на KEY_POOL_HORIZON секунд вперед, в пределах KEY_POOL_MIN_SIZE..KEY_POOL_MAX_SIZE.
+    Ключи классов, которых больше нет в тарифах, удаляются с серверов.
+
+    KEY_POOL_FILE — журнал: строка с ключом при добавлении в запас и строка server||key_id при
+    выдаче; при загрузке журнал проигрывается и сжимается. Выдача записывается на диск до того,
+    как ключ уйдет пользователю, а при загрузке дополнительно отбрасываются ключи, уже записанные
+    пользователям, поэтому один ключ не выдается дважды.
+    """
+
+    def __init__(self, store, pool):
+        self.store = store
+        self.pool = pool
+        self.keys = defaultdict(deque)  # класс -> очередь PooledKey, старые выдаются первыми
+        self._demand = defaultdict(deque)  # класс -> моменты запросов ключа за окно спроса
+        self._creating = defaultdict(int)  # класс -> ключей в процессе создания
+        self._wakeup = asyncio.Event()
+        self._semaphore = asyncio.Semaphore(config.KEY_POOL_REFILL_CONCURRENCY)
+        self._renames = set()
+
+    def __len__(self):
+        return sum(len(keys) for keys in self.keys.values())
+
+    def refs(self) -> set:
+        return {(key.server, key.key_id) for keys in self.keys.values() for key in keys}
+
+    # Состав запаса
+
+    @staticmethod
+    def _line(key: PooledKey) -> str:
+        return f"{key.server}||{key.key_id}||{key.gb_class}||{key.access_url}||{key.created_at}"
+
+    def _lines(self) -> list:
+        return [self._line(key) for keys in self.keys.values() for key in keys]
+
+    def load(self):
+        entries = {}  # (server, key_id) -> PooledKey в порядке добавления
+        for line in read_file_lines(config.KEY_POOL_FILE):
+            parts = line.split('||')
+            try:
+                if len(parts) == 2: # ключ выдан
+                    entries.pop(tuple(parts), None)
+                else:
+                    server, key_id, gb_class, access_url, created_at = parts
+                    entries[(server, key_id)] = PooledKey(server, key_id, int(gb_class), access_url, int(created_at))
+            except ValueError:
+                logger.error(f"Некорректная строка в {config.KEY_POOL_FILE}: '{line}'")
+        dropped = 0
+        for (server, key_id), key in entries.items():
+            if self.store.get_key(server, key_id) is not None or self.pool.get(server) is None:
+                dropped += 1 # уже выдан пользователю или сервер убран из конфигурации
+                continue
+            self.keys[key.gb_class].append(key)
+        rewrite_file(config.KEY_POOL_FILE, self._lines())
+        logger.info(f"Запас ключей загружен: {len(self)} ключей"
+                    + (f", отброшено {dropped} выданных или с удаленных серверов" if dropped else ""))
+
+    async def _save(self):
+        await log_writer.rewrite(config.KEY_POOL_FILE, self._lines)
+
+    async def discard(self, refs):
+        """Убирает из запаса ключи, которых больше нет на серверах (вызывается сверкой)."""
+        refs = set(refs)
+        removed = 0
+        for gb_class, keys in self.keys.items():
+            kept = deque(key for key in keys if (key.server, key.key_id) not in refs)
+            removed += len(keys) - len(kept)
+            self.keys[gb_class] = kept
+        if removed:
+            await self._save()
+            self._wakeup.set()
+        return removed
+
+    # Выдача
+
+    def _note_demand(self, gb_class: int, now: float):
+        demand = self._demand[gb_class]
+        demand.append(now)
+        while demand and demand[0] < now - config.KEY_POOL_DEMAND_WINDOW:
+            demand.popleft()
+
+    def target_size(self, gb_class: int) -> int:
+        demand = self._demand[gb_class]
+        cutoff = time.monotonic() - config.KEY_POOL_DEMAND_WINDOW
+        recent = sum(1 for moment in demand if moment >= cutoff)
+        expected = math.ceil(recent * config.KEY_POOL_HORIZON / config.KEY_POOL_DEMAND_WINDOW)
+        return max(config.KEY_POOL_MIN_SIZE, min(config.KEY_POOL_MAX_SIZE, expected))
+
+    async def take(self, gb_limit: int):
+        """Ключ из запаса для тарифа gb_limit или None, если запас этого класса пуст."""
+        gb_class = key_class(gb_limit)
+        self._note_demand(gb_class, time.monotonic())
+        keys = self.keys.get(gb_class)
+        key = None
+        while keys and key is None:
+            candidate = keys.popleft()
+            if self.pool.get(candidate.server) is not None:
+                key = candidate
+        self._wakeup.set()
+        if key is None:
+            pool_takes.inc('miss')
+            return None
+        pool_takes.inc('hit')
+        await append_to_file(config.KEY_POOL_FILE, f"{key.server}||{key.key_id}")
+        if log_writer.running: # выдача должна попасть на диск раньше, чем ключ уйдет пользователю
+            await log_writer.flush()
+        return key
+
+    def rename_later(self, key: PooledKey, name: str):
+        """Переименовывает выданный ключ в фоне; имя нужно только для сверки и поиска на сервере."""
+        task = asyncio.create_task(self._rename(key, name))
+        self._renames.add(task)
+        task.add_done_callback(self._renames.discard)
+
+    async def _rename(self, key: PooledKey, name: str):
+        try:
+            await retry_with_backoff(self.pool.get(key.server).client.rename_key, key.key_id, name)
+        except Exception as e:
+            logger.error(f"Не удалось переименовать выданный ключ {key.key_id} на сервере {key.server} в {name}: {e}")
+
+    # Пополнение
+
+    async def _create(self, gb_class: int):
+        async with self._semaphore:
+            server = await self.pool.pick_server()
+            created_at = int(time.time())
+            name = f"{POOL_NAME_PREFIX}_{gb_class}_{created_at}"
+            limit = gb_class * 1024 * 1024 * 1024 if gb_class != UNLIMITED else None
+            new_key = await server.client.create_key(name=name, data_limit=limit)
+            try: # старые серверы Outline не принимают имя и лимит при создании, а rename_key и add_data_limit возвращают False при ошибке
+                if new_key.name != name and not await server.client.rename_key(new_key.key_id, name):
+                    raise RuntimeError(f"не удалось назвать ключ {new_key.key_id}")
+                if limit and new_key.data_limit != limit and not await server.client.add_data_limit(new_key.key_id, limit):
+                    raise RuntimeError(f"не удалось установить лимит ключу {new_key.key_id}")
+            except Exception:
+                await retry_with_backoff(server.client.delete_key, new_key.key_id) # не оставляем ключ без лимита
+                raise
+            server.note_placed(refresh=False)
+        key = PooledKey(server.name, new_key.key_id, gb_class, new_key.access_url, created_at)
+        self.keys[gb_class].append(key)
+        await append_to_file(config.KEY_POOL_FILE, self._line(key))
+
+    async def _reclaim(self):
+        """Удаляет с серверов ключи классов, которых больше нет в тарифах."""
+        classes = tariff_classes()
+        stale = [key for gb_class in list(self.keys) if gb_class not in classes for key in self.keys.pop(gb_class)]
+        if not stale:
+            return
+        await self._save()
+        for key in stale:
+            try:
+                await retry_with_backoff(self.pool.get(key.server).client.delete_key, key.key_id)
+            except Exception as e:
+                logger.error(f"Не удалось удалить ключ {key.key_id} из запаса на сервере {key.server}: {e}")
+        logger.info(f"Из запаса удалено {len(stale)} ключей тарифов, которых больше нет")
+
+    async def refill(self):
+        await self._reclaim()
+        jobs = []
+        for gb_class in sorted(tariff_classes()):
+            missing = self.target_size(gb_class) - len(self.keys[gb_class]) - self._creating[gb_class]
+            jobs.extend([gb_class] * max(missing, 0))
+        if not jobs:
+            return
+        for gb_class in jobs:
+            self._creating[gb_class] += 1
+        try:
+            results = await asyncio.gather(*(self._create(gb_class) for gb_class in jobs), return_exceptions=True)
+        finally:
+            for gb_class in jobs:
+                self._creating[gb_class] -= 1
+            for server in self.pool.servers.values():
+                server.cache.refresh_soon()
+        errors = [result for result in results if isinstance(result, Exception)]
+        for error in errors[:1]:
+            logger.error(f"Не удалось пополнить запас ключей ({len(errors)} из {len(jobs)}): {error}")
+
+    async def run(self):
+        while True:
+            try:
+                await self.refill()
+            except Exception as e:
+                logger.error(f"Ошибка пополнения запаса ключей: {e}")
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), config.KEY_POOL_REFILL_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
@@ -1,5 +1,6 @@
 import asyncio
 import datetime
+import io
 import logging
 import os
 import random
@@ -7,18 +8,39 @@ import time
 import urllib3
 
 import aiogram.utils.markdown as md
-from aiogram import Bot, Dispatcher, types
-from aiogram.contrib.fsm_storage.memory import MemoryStorage
+from aiogram import Dispatcher, types
+from aiogram.bot.api import TELEGRAM_PRODUCTION, TelegramAPIServer
 from aiogram.dispatcher import FSMContext
 from aiogram.dispatcher.filters import Text
 from aiogram.dispatcher.filters.state import State, StatesGroup
-from aiogram.types import (InlineKeyboardButton, InlineKeyboardMarkup, ParseMode, ReplyKeyboardMarkup, ReplyKeyboardRemove)
+from aiogram.types import (InlineKeyboardButton, InlineKeyboardMarkup, ParseMode, ReplyKeyboardRemove)
 from aiogram.utils import executor
-from outline_vpn.outline_vpn import OutlineVPN
 
-from yoomoney import Client, Quickpay
+from yoomoney import Client
 
+from analytics import Analytics
 import config
+from broadcast import Broadcaster
+from fileio import log_writer
+from fsm_storage import create_fsm_storage
+from keypool import KeyPool
+import metrics
+from metrics import HandlerMetricsMiddleware, InstrumentedBot
+from outline_api import OutlinePool
+from payments import EXPIRED, FAILED, FULFILLED, PAID, PaymentEngine
+import promo
+from promo import PromoEngine
+from ratelimit import TelegramRateLimiter
+import readiness
+from readiness import LazyClient, Readiness, ReadinessMiddleware
+from reconcile import Reconciler
+from scheduler import ExpirationScheduler
+from storage import create_store
+from sweeper import KeySweeper
+from templates import TemplateRegistry, tariff_name
+from throttle import BanList, ThrottlingMiddleware
+from usage import UsageWatcher
+from webhook import WebhookServer
 
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
@@ -26,15 +48,23 @@ urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
-bot = Bot(token=config.telegram_token)
-storage = MemoryStorage()
+bot = InstrumentedBot(token=config.telegram_token,
+                      server=TelegramAPIServer.from_base(config.TELEGRAM_API_SERVER) if config.TELEGRAM_API_SERVER else TELEGRAM_PRODUCTION)
+storage = create_fsm_storage() # состояния диалогов переживают перезапуск, см. FSM_STORAGE_BACKEND
 dp = Dispatcher(bot, storage=storage)
-
-try:
-    outline_client = OutlineVPN(api_url=config.outline_api_url, cert_sha256=config.outline_cert_sha256)
-    yoomoney_client = Client(config.yoomoney_token)
-except Exception as e:
-    logger.critical(f"Не удалось инициализировать клиенты API: {e}")
+bans = BanList()
+dp.middleware.setup(ThrottlingMiddleware(bans)) # бан и флуд отсекаются до обработчиков
+startup = Readiness((readiness.STORE, readiness.OUTLINE, readiness.YOOMONEY))
+# накопившиеся за перезапуск обновления ждут готовности, а не получают ответ "бот запускается"
+dp.middleware.setup(ReadinessMiddleware(startup, hold_backlog=config.STARTUP_PROCESS_BACKLOG or config.WEBHOOK_ENABLED))
+dp.middleware.setup(HandlerMetricsMiddleware())
+dp.errors_handler()(HandlerMetricsMiddleware.on_error)
+store = create_store()
+telegram_limiter = TelegramRateLimiter(config.TELEGRAM_RATE_LIMIT) # общий лимит исходящих сообщений всего бота
+
+# клиенты создаются при первом обращении, доступность API проверяют пробы startup
+outline_pool = OutlinePool(config.OUTLINE_SERVERS)
+yoomoney_client = LazyClient(lambda: Client(config.yoomoney_token, base_url=config.YOOMONEY_API_URL), "ЮMoney")
 
 class PromoCodeState(StatesGroup):
     waiting_for_code = State()
@@ -62,51 +92,46 @@ def ensure_dirs_exist(): # Создаем все необходимые дире
             os.makedirs(directory)
             logger.info(f"Создана директория: {directory}")
 
-def read_file(path, default=""):
-    try:
-        with open(path, 'r', encoding='utf-8') as f:
-            return f.read().strip()
-    except FileNotFoundError:
-        logger.warning(f"Файл не найден: {path}. Возвращено значение по умолчанию.")
-        return default
-
-def read_file_lines(path):
-    content = read_file(path)
-    return content.splitlines() if content else []
-
-async def append_to_file(path, content):
-    try:
-        with open(path, 'a', encoding='utf-8') as f:
-            f.write(str(content) + '\n')
-    except IOError as e:
-        logger.error(f"Ошибка записи в файл {path}: {e}")
-
 async def get_moscow_time():
     return datetime.datetime.now(datetime.timezone(datetime.timedelta(hours=3)))
 
 
 ### РАБОТА С OUTLINE VPN ###
 
+key_pool = KeyPool(store, outline_pool) # заранее созданные ключи каждого тарифа
+
 async def create_outline_key(user_id: int, gb_limit: int = 0, name_prefix: str = "Paid"):
     try:
-        new_key = outline_client.create_key()
         key_name = f"{name_prefix}_{user_id}_{int(time.time())}"
-        outline_client.rename_key(new_key.key_id, key_name)
+        pooled = await key_pool.take(gb_limit) if config.KEY_POOL_ENABLED else None
+        if pooled: # лимит уже установлен, имя меняем в фоне
+            server = outline_pool.get(pooled.server)
+            key_id, access_url = pooled.key_id, pooled.access_url
+            key_pool.rename_later(pooled, key_name)
+        else:
+            server = await outline_pool.pick_server()
+            new_key = await server.client.create_key()
+            key_id, access_url = new_key.key_id, new_key.access_url
+            await server.client.rename_key(key_id, key_name)
 
-        if gb_limit > 0 and gb_limit < 998:  # 998, 999 - коды для безлимита
-            bytes_limit = gb_limit * 1024 * 1024 * 1024
-            outline_client.add_data_limit(new_key.key_id, bytes_limit)
+            if gb_limit > 0 and gb_limit < 998:  # 998, 999 - коды для безлимита
+                bytes_limit = gb_limit * 1024 * 1024 * 1024
+                await server.client.add_data_limit(key_id, bytes_limit)
 
-        await append_to_file(config.KEYS_IDS_FILE, f'{user_id}||{new_key.access_url}||{new_key.key_id}')
+        await store.add_key(str(user_id), access_url, key_id, server.name, gb_limit)
 
         # Установка срока действия ключа
         months_to_add = 3 if gb_limit == 999 else 1
         moscow_now = await get_moscow_time()
         expiration_date = moscow_now + datetime.timedelta(days=30 * months_to_add)
-        await append_to_file(config.USERS_KEYS_EXPIRATIONS_FILE, f'{user_id}||{int(expiration_date.timestamp())}||{new_key.key_id}')
-
-        logger.info(f"Создан ключ {new_key.key_id} для пользователя {user_id} с лимитом {gb_limit}GB")
-        return new_key.access_url
+        expiration = await store.add_expiration(str(user_id), int(expiration_date.timestamp()), key_id, server.name)
+        expiration_scheduler.schedule(expiration)
+        if not pooled: # ключи запаса уже учтены в снимке сервера
+            server.note_placed()
+
+        logger.info(f"{'Выдан из запаса' if pooled else 'Создан'} ключ {key_id} на сервере {server.name} "
+                    f"для пользователя {user_id} с лимитом {gb_limit}GB")
+        return access_url
     except Exception as e:
         logger.error(f"Ошибка при создании ключа Outline для {user_id}: {e}")
         return None
@@ -117,71 +142,83 @@ async def create_outline_key(user_id: int, gb_limit: int = 0, name_prefix: str =
 async def generate_payment(amount: float, user_id: int, description: str):
     """Генерирует объект платежа Quickpay."""
     label = f"{user_id}_{int(time.time())}_{random.randint(1000, 9999)}"
-    quickpay = Quickpay(
-        receiver=config.yoomoney_wallet,
-        quickpay_form="shop",
-        targets=description,
-        paymentType="SB",
-        sum=amount,
-        label=label
-    )
-    return quickpay
-
-async def check_yoomoney_payment(label: str, expected_amount: float):
-    try:
-        history = yoomoney_client.operation_history(label=label)
-        for operation in history.operations:
-            if operation.status == 'success' and float(operation.amount) >= expected_amount:
-                logger.info(f"Успешная оплата найдена по {label} на сумму {operation.amount}")
-                return True
-    except Exception as e:
-        logger.error(f"Ошибка при проверке платежа YooMoney по {label}: {e}")
+    return await payment_engine.create_payment(amount, user_id, description, label)
+
+async def deliver_paid_key(payment): # вызывается, как только оплата подтверждена уведомлением или опросом
+    new_key_url = await create_outline_key(int(payment.user_id), gb_limit=payment.gb_limit)
+
+    if new_key_url:
+        await store.add_transaction(payment.user_id, payment.price, payment.gb_limit, payment.label)
+        final_text = (
+            f"🎉 Ваш новый VPN-ключ готов!\n\n"
+            f"🗝️ Ключ доступа:\n`{new_key_url}`\n\n"
+            f"Спасибо за покупку! Не забудьте ознакомиться с инструкцией, если вы делаете это в первый раз."
+        )
+        # ключ выдан и записан: если сообщение не дошло, ключ все равно виден в "Мои ключи"
+        if not await telegram_limiter.send_message(bot, payment.user_id, final_text, reply_markup=back_to_main_kb,
+                                                   parse_mode=ParseMode.MARKDOWN):
+            logger.error(f"Ключ по оплате {payment.label} выдан, но сообщение пользователю {payment.user_id} не доставлено")
+        return True
+
+    # если оплата прошла, а ключ не создался
+    error_text = f"Произошла критическая ошибка при создании ключа после оплаты. Пожалуйста, немедленно свяжитесь с поддержкой и предоставьте этот код: `{payment.label}`"
+    await telegram_limiter.send_message(bot, payment.user_id, error_text, reply_markup=back_to_main_kb, parse_mode=ParseMode.MARKDOWN)
+    logger.critical(f"Ключ не создан для {payment.user_id} после успешной оплаты {payment.label}")
     return False
 
+payment_engine = PaymentEngine(yoomoney_client, store, deliver_paid_key)
 
-### ТЕКСТЫ И КЛАВИАТУРЫ ###
+startup.add_probe(readiness.OUTLINE, outline_pool.probe)
+startup.add_probe(readiness.YOOMONEY, payment_engine.probe)
 
-start_text = read_file(config.START_MESSAGE_FILE, "Добро пожаловать!")
-support_text = read_file(config.SUPPORT_MESSAGE_FILE, "Свяжитесь с поддержкой.")
-info_text = read_file(config.INFORMATION_FILE, "Информация о сервисе.")
-guide_text = read_file(config.GUIDE_FILE, "Инструкция по использованию.")
 
-main_menu_kb = InlineKeyboardMarkup(row_width=2).add(
-    InlineKeyboardButton('🛒 Купить VPN', callback_data='buy_vpn'),
-    InlineKeyboardButton('📚 Информация', callback_data='info'),
-    InlineKeyboardButton('💬 Поддержка', callback_data='support'),
-    InlineKeyboardButton('🎁 Мои ключи', callback_data='my_keys'),
-    InlineKeyboardButton('🔥 Промокод', callback_data='promo')
-)
+### ТЕКСТЫ И КЛАВИАТУРЫ ###
 
-info_kb = InlineKeyboardMarkup(row_width=1).add(
-    InlineKeyboardButton('🔥 Инструкция по использованию', callback_data='guide'),
-    InlineKeyboardButton('🔙 Назад', callback_data='back_to_main_menu')
-)
+templates = TemplateRegistry() # тексты перечитываются при изменении файлов, клавиатуры собраны заранее
 
-back_to_main_kb = InlineKeyboardMarkup().add(InlineKeyboardButton('🔙 Главное меню', callback_data='back_to_main_menu'))
+main_menu_kb = templates.keyboards['main_menu']
+info_kb = templates.keyboards['info']
+back_to_main_kb = templates.keyboards['back_to_main']
+back_to_info_kb = templates.keyboards['back_to_info']
+buy_kb = templates.keyboards['buy']
+cancel_kb = templates.keyboards['cancel']
 
 
 ### ОБРАБОТЧИКИ ДЕЙСТВИЙ ###
 
+registering_users = set()  # новые пользователи, чей первый /start ждет готовности Outline
+
 @dp.message_handler(commands=['start'])
 async def cmd_start(message: types.Message):
     user_id = str(message.from_user.id)
-    users = read_file_lines(config.USERS_FILE)
 
-    if user_id not in users:
-        await append_to_file(config.USERS_FILE, user_id)
-        
+    if store.is_unreachable(user_id): # вернулся после блокировки бота
+        await store.mark_reachable(user_id)
+
+    if not store.has_user(user_id) and user_id not in registering_users:
+        # место занимается до первого await, иначе два быстрых /start выдадут два пробных ключа;
+        # без Outline пользователь не регистрируется, чтобы повторный /start выдал ему пробный ключ
+        registering_users.add(user_id)
+        try:
+            outline_ready = await startup.wait((readiness.OUTLINE,), config.READINESS_WAIT)
+            if outline_ready:
+                await store.add_user(user_id)
+        finally:
+            registering_users.discard(user_id)
+        if not outline_ready:
+            await message.answer("⏳ Серверы VPN сейчас недоступны. Пожалуйста, повторите /start через пару минут.")
+            return
+
         # Выдача пробного ключа
-        free_key_url = await create_outline_key(message.from_user.id, gb_limit=3, name_prefix="FreeTrial")
+        free_key_url = await create_outline_key(message.from_user.id, gb_limit=config.FREE_TRIAL_GB, name_prefix="FreeTrial")
         if free_key_url:
             moscow_time_str = (await get_moscow_time()).strftime('%Y-%m-%d %H:%M:%S')
             username = message.from_user.username or "N/A"
-            await append_to_file(config.USERS_USERNAME_FILE, f'{user_id}|{username}|{moscow_time_str}|{free_key_url}|Free')
+            await store.add_username(user_id, username, moscow_time_str, free_key_url, 'Free')
             
             welcome_text = (
                 f"*Добро пожаловать, {message.from_user.first_name}! 👋*\n\n"
-                f"🎉 В качестве подарка мы дарим вам *бесплатный ключ на 3 ГБ* трафика:\n\n"
+                f"🎉 В качестве подарка мы дарим вам *бесплатный ключ на {config.FREE_TRIAL_GB} ГБ* трафика:\n\n"
                 f"🗝️ Ваш ключ:\n`{free_key_url}`\n\n"
                 f"Этот ключ поможет вам протестировать наш сервис. Когда трафик закончится, вы сможете приобрести новый.\n\n"
                 f"ℹ️ Для начала работы, пожалуйста, ознакомьтесь с инструкцией в разделе *'Информация'*."
@@ -190,38 +227,28 @@ async def cmd_start(message: types.Message):
         else:
             await message.answer("К сожалению, произошла ошибка при создании вашего пробного ключа. Пожалуйста, обратитесь в поддержку.")
 
-    await message.answer(start_text, reply_markup=main_menu_kb, parse_mode=ParseMode.MARKDOWN)
+    await message.answer(templates.text(config.START_MESSAGE_FILE), reply_markup=main_menu_kb, parse_mode=ParseMode.MARKDOWN)
 
 @dp.callback_query_handler(text='back_to_main_menu')
 async def cb_back_to_main_menu(call: types.CallbackQuery):
-    await call.message.edit_text(start_text, reply_markup=main_menu_kb, parse_mode=ParseMode.MARKDOWN)
+    await call.message.edit_text(templates.text(config.START_MESSAGE_FILE), reply_markup=main_menu_kb, parse_mode=ParseMode.MARKDOWN)
     await call.answer()
 
 @dp.callback_query_handler(text='info')
 async def cb_info(call: types.CallbackQuery):
-    await call.message.edit_text(info_text, reply_markup=info_kb, parse_mode=ParseMode.MARKDOWN)
+    await call.message.edit_text(templates.text(config.INFORMATION_FILE), reply_markup=info_kb, parse_mode=ParseMode.MARKDOWN)
     await call.answer()
 
 @dp.callback_query_handler(text='guide')
 async def cb_guide(call: types.CallbackQuery):
-    back_kb = InlineKeyboardMarkup().add(InlineKeyboardButton('🔙 Назад', callback_data='info'))
-    await call.message.edit_text(guide_text, reply_markup=back_kb, parse_mode=ParseMode.MARKDOWN)
+    await call.message.edit_text(templates.text(config.GUIDE_FILE), reply_markup=back_to_info_kb, parse_mode=ParseMode.MARKDOWN)
     await call.answer()
 
 
 
-def get_buy_keyboard():
-    kb = InlineKeyboardMarkup(row_width=2)
-    buttons = [InlineKeyboardButton(f"{gb} ГБ - {price}₽", callback_data=f"buy_new_{gb}") for gb, price in config.PRICE_NEW.items() if gb < 998]
-    buttons.append(InlineKeyboardButton(f"Безлимит (1 мес) - {config.PRICE_NEW[998]}₽", callback_data="buy_new_998"))
-    buttons.append(InlineKeyboardButton(f"Безлимит (3 мес) - {config.PRICE_NEW[999]}₽", callback_data="buy_new_999"))
-    kb.add(*buttons)
-    kb.add(InlineKeyboardButton('🔙 Назад', callback_data='back_to_main_menu'))
-    return kb
-
 @dp.callback_query_handler(text='buy_vpn')
 async def cb_buy_vpn(call: types.CallbackQuery):
-    await call.message.edit_text("Выберите тариф для нового ключа:", reply_markup=get_buy_keyboard())
+    await call.message.edit_text("Выберите тариф для нового ключа:", reply_markup=buy_kb)
     await call.answer()
 
 @dp.callback_query_handler(Text(startswith="buy_new_"))
@@ -233,61 +260,64 @@ async def cb_process_new_key_purchase(call: types.CallbackQuery):
         await call.answer("Тариф не найден.", show_alert=True)
         return
     
-    if gb_limit >= 998:
-        tariff_name = f"Безлимит ({'3 мес.' if gb_limit == 999 else '1 мес.'})"
-    else:
-        tariff_name = f"{gb_limit} ГБ"
-
-    payment_description = f"Покупка VPN: {tariff_name}"
+    payment_description = f"Покупка VPN: {tariff_name(gb_limit)}"
     payment = await generate_payment(price, call.from_user.id, payment_description)
+    await payment_engine.register(payment.label, call.from_user.id, price, gb_limit)
 
     payment_kb = InlineKeyboardMarkup(row_width=1).add(
         InlineKeyboardButton('🔗 Перейти к оплате', url=payment.redirected_url),
-        InlineKeyboardButton('✅ Я оплатил', callback_data=f"check_payment_:{payment.label}:{price}:{gb_limit}"),
+        InlineKeyboardButton('✅ Я оплатил', callback_data=f"check_payment_:{payment.label}"),
         InlineKeyboardButton('🔙 Отмена', callback_data='buy_vpn')
     )
     
     await call.message.edit_text(
-        f"Вы выбрали тариф: *{tariff_name}*.\nСумма к оплате: *{price} ₽*.\n\n"
-        "Нажмите на кнопку ниже, чтобы перейти к оплате. После успешной оплаты вернитесь и нажмите 'Я оплатил'.",
+        templates.payment_texts[gb_limit],
         reply_markup=payment_kb,
         parse_mode=ParseMode.MARKDOWN
     )
     await call.answer()
 
-@dp.callback_query_handler(Text(startswith="check_payment_")) # проверка оплаты
-async def cb_check_payment(call: types.CallbackQuery):
+def parse_legacy_payment(price_str: str, gb_limit_str: str):
+    """Цена и тариф из кнопки старого формата check_payment_:метка:цена:ГБ или None."""
     try:
-        prefix, rest = call.data.split(':', 1)
-        rest, gb_limit_str = rest.rsplit(':', 1)
-        label, price_str = rest.rsplit(':', 1)
+        price, gb_limit = float(price_str), int(gb_limit_str)
     except ValueError:
-        logging.error(f"Не удалось разобрать callback_data: {call.data}")
-        await call.answer("Произошла ошибка. Пожалуйста, попробуйте еще раз.", show_alert=True)
+        return None
+    if gb_limit not in config.PRICE_NEW:
+        return None
+    # callback_data присылает клиент: цена не может быть ниже текущей цены тарифа
+    return max(price, config.PRICE_NEW[gb_limit]), gb_limit
+
+@dp.callback_query_handler(Text(startswith="check_payment_")) # проверка оплаты
+async def cb_check_payment(call: types.CallbackQuery):
+    # сумма и тариф берутся из журнала платежей, а не из callback_data; старые кнопки содержат их после метки
+    parts = call.data.split(':')
+    label = parts[1] if len(parts) > 1 else ''
+    payment = payment_engine.ledger.get(label)
+    legacy = None
+    if payment is None and len(parts) == 4 and label.startswith(f"{call.from_user.id}_"):
+        legacy = parse_legacy_payment(parts[2], parts[3])
+
+    if legacy is not None: # счет выставлен до появления журнала платежей
+        price, gb_limit = legacy
+        await payment_engine.register(label, call.from_user.id, price, gb_limit)
+        status = PAID if await payment_engine.lookup(label) else payment_engine.status(label)
+    elif payment is None or payment.user_id != str(call.from_user.id):
+        await call.answer("Счет не найден. Пожалуйста, оформите покупку заново.", show_alert=True)
         return
-    price = float(price_str)
-    gb_limit = int(gb_limit_str)
-    
-    await call.answer("🔍 Проверяем вашу оплату...", show_alert=False)
+    else:
+        status = await payment_engine.check(label)
 
-    if await check_yoomoney_payment(label, price):
+    if status == PAID:
+        await call.answer()
         await call.message.edit_text("✅ Оплата прошла успешно! Создаем ваш ключ...", reply_markup=None)
-        
-        new_key_url = await create_outline_key(call.from_user.id, gb_limit=gb_limit)
-        
-        if new_key_url:
-            await append_to_file(config.TRANSACTION_LOGS_FILE, f"{call.from_user.id}|{price}|{gb_limit}GB|{label}")
-            final_text = (
-                f"🎉 Ваш новый VPN-ключ готов!\n\n"
-                f"🗝️ Ключ доступа:\n`{new_key_url}`\n\n"
-                f"Спасибо за покупку! Не забудьте ознакомиться с инструкцией, если вы делаете это в первый раз."
-            )
-            await call.message.answer(final_text, reply_markup=back_to_main_kb, parse_mode=ParseMode.MARKDOWN)
-            
-        else: # если оплата прошла, а ключ не создался
-            error_text = "Произошла критическая ошибка при создании ключа после оплаты. Пожалуйста, немедленно свяжитесь с поддержкой и предоставьте этот код: `{label}`"
-            await call.message.answer(error_text, reply_markup=back_to_main_kb)
-            logger.critical(f"Ключ не создан для {call.from_user.id} после успешной оплаты {label}")
+    elif status == FULFILLED:
+        await call.answer("✅ Оплата подтверждена, ключ уже отправлен вам сообщением.", show_alert=True)
+        await call.message.edit_reply_markup(reply_markup=None)
+    elif status == FAILED:
+        await call.answer(f"Оплата получена, но ключ создать не удалось. Обратитесь в поддержку с кодом {label}", show_alert=True)
+    elif status == EXPIRED:
+        await call.answer("Срок действия счета истек. Если вы оплатили его, обратитесь в поддержку с кодом " + label, show_alert=True)
     else:
         await call.answer("❌ Оплата еще не поступила. Пожалуйста, подождите 1-2 минуты после оплаты и попробуйте снова.", show_alert=True)
 
@@ -295,12 +325,9 @@ async def cb_check_payment(call: types.CallbackQuery):
 @dp.callback_query_handler(text='my_keys') # при нажатии "мои ключи"
 async def cb_my_keys(call: types.CallbackQuery):
     user_id = str(call.from_user.id)
-    user_keys_info = []
-    
-    all_keys = read_file_lines(config.KEYS_IDS_FILE)
-    user_keys_data = [line.split('||') for line in all_keys if line.startswith(user_id)]
+    user_keys = store.get_user_keys(user_id)
 
-    if not user_keys_data:
+    if not user_keys:
         await call.message.edit_text("У вас еще нет купленных ключей.", reply_markup=back_to_main_kb)
         await call.answer()
         return
@@ -308,16 +335,19 @@ async def cb_my_keys(call: types.CallbackQuery):
     await call.answer("Загружаю информацию о ключах...")
     
     try:
-        outline_keys = outline_client.get_keys()
-        outline_keys_dict = {key.key_id: key for key in outline_keys}
-        
+        # снимки серверов, на которых лежат ключи пользователя, запрашиваются параллельно
+        server_names = list(dict.fromkeys(record.server for record in user_keys if outline_pool.get(record.server)))
+        snapshots = await asyncio.gather(*(outline_pool.get(name).cache.get_keys() for name in server_names))
+        outline_keys_by_server = dict(zip(server_names, snapshots))
+
         response_text = "*Ваши активные ключи:*\n\n"
         
-        for key_data in user_keys_data:
-            _, access_url, key_id = key_data
-            
-            if key_id in outline_keys_dict:
-                key = outline_keys_dict[key_id]
+        for record in user_keys:
+            access_url = record.access_url
+            outline_keys_dict = outline_keys_by_server.get(record.server, {})
+
+            if record.key_id in outline_keys_dict:
+                key = outline_keys_dict[record.key_id]
                 used_gb = key.used_bytes / (1024**3) if key.used_bytes else 0
                 
                 if key.data_limit:
@@ -346,8 +376,7 @@ async def cb_my_keys(call: types.CallbackQuery):
 async def cb_support(call: types.CallbackQuery):
     """Начинает диалог с поддержкой."""
     await SupportState.waiting_for_message.set()
-    cancel_kb = ReplyKeyboardMarkup(resize_keyboard=True).add("Отмена")
-    await call.message.answer(support_text, reply_markup=cancel_kb, parse_mode=ParseMode.MARKDOWN)
+    await call.message.answer(templates.text(config.SUPPORT_MESSAGE_FILE), reply_markup=cancel_kb, parse_mode=ParseMode.MARKDOWN)
     await call.answer()
 
 @dp.message_handler(state=SupportState.waiting_for_message, content_types=types.ContentTypes.ANY)
@@ -356,7 +385,7 @@ async def process_support_message(message: types.Message, state: FSMContext):
     if message.text and message.text.lower() == 'отмена':
         await state.finish()
         await message.answer("Действие отменено.", reply_markup=ReplyKeyboardRemove())
-        await message.answer(start_text, reply_markup=main_menu_kb, parse_mode=ParseMode.MARKDOWN)
+        await message.answer(templates.text(config.START_MESSAGE_FILE), reply_markup=main_menu_kb, parse_mode=ParseMode.MARKDOWN)
         return
         
     forward_kb = InlineKeyboardMarkup().add(
@@ -399,6 +428,9 @@ async def process_admin_response(message: types.Message, state: FSMContext):
 
 
 ### Промокоды ###
+
+promo_engine = PromoEngine(store)
+
 @dp.callback_query_handler(text='promo')
 async def cb_promo(call: types.CallbackQuery):
     """Запрашивает ввод промокода."""
@@ -406,139 +438,287 @@ async def cb_promo(call: types.CallbackQuery):
     await call.message.edit_text("Введите ваш промокод:")
     await call.answer()
 
+PROMO_REJECTIONS = {
+    promo.ALREADY_ACTIVATED: "❌ Вы уже активировали промокод.",
+    promo.IN_PROGRESS: "⏳ Предыдущий промокод еще активируется, подождите немного.",
+    promo.NOT_FOUND: "❌ Такого промокода не существует или он уже был использован.",
+    promo.EXHAUSTED: "❌ Такого промокода не существует или он уже был использован.",
+    promo.EXPIRED: "❌ Срок действия промокода истек.",
+}
+
 @dp.message_handler(state=PromoCodeState.waiting_for_code) # проверяет введеный промокод
 async def process_promo_code(message: types.Message, state: FSMContext):
     await state.finish()
     user_id = str(message.from_user.id)
-    user_code = message.text.strip()
-
-    # проверяем, не активировал ли пользователь промокод ранее
-    activation_logs = read_file_lines(config.PROMO_ACTIVATION_LOGS)
-    for log in activation_logs:
-        if log.startswith(user_id):
-            await message.answer("❌ Вы уже активировали промокод.", reply_markup=back_to_main_kb)
-            return
+    user_code = (message.text or '').strip()
 
-    # проверяем, существует ли такой промокод
-    all_promocodes = read_file_lines(config.PROMOCODES_FILE)
-    if user_code not in all_promocodes:
-        await message.answer("❌ Такого промокода не существует или он уже был использован.", reply_markup=back_to_main_kb)
+    # проверка и резервирование использования кода без обращений к диску
+    promo_code, status = promo_engine.reserve(user_id, user_code)
+    if promo_code is None:
+        await message.answer(PROMO_REJECTIONS[status], reply_markup=back_to_main_kb)
         return
 
-    # находим ключ пользователя
-    all_keys = read_file_lines(config.KEYS_IDS_FILE)
-    user_key_id = None
-    for key_line in all_keys:
-        if key_line.startswith(user_id):
-            user_key_id = key_line.split('||')[2]
+    activated = False
+    try:
+        # находим последний выданный ключ пользователя
+        user_keys = store.get_user_keys(user_id)
+        user_key = user_keys[-1] if user_keys else None
+        server = outline_pool.get(user_key.server) if user_key else None
 
-    if not user_key_id:
-        await message.answer("❌ Не удалось найти ваш активный ключ для начисления бонуса.", reply_markup=back_to_main_kb)
-        return
+        if not server:
+            await message.answer("❌ Не удалось найти ваш активный ключ для начисления бонуса.", reply_markup=back_to_main_kb)
+            return
 
-    try:
-        # получаем бонус из файла, обновляем лимит
-        bonus_gb_str = read_file(os.path.join(config.PROMO_DISCOUNT_DIR, f"{user_code}.txt"))
-        if not bonus_gb_str:
-             await message.answer("❌ Ошибка конфигурации промокода. Сообщите администратору.", reply_markup=back_to_main_kb)
-             logger.error(f"Не найден файл скидки для промокода {user_code}")
-             return
-
-        bonus_gb = int(bonus_gb_str)
+        bonus_gb = promo_code.bonus_gb
         bonus_bytes = bonus_gb * 1024 * 1024 * 1024
 
-        key_details = outline_client.get_keys(key_id=user_key_id)[0]
-        current_limit_bytes = key_details.data_limit if key_details.data_limit else 0
-        new_limit_bytes = current_limit_bytes + bonus_bytes
+        user_key_id = user_key.key_id
+        key_details = await server.client.get_key(user_key_id)
+        if not key_details.data_limit: # безлимитный ключ: лимит в размере бонуса только урезал бы его
+            await message.answer("ℹ️ Ваш ключ безлимитный, дополнительный трафик ему не нужен.", reply_markup=back_to_main_kb)
+            return
+        new_limit_bytes = key_details.data_limit + bonus_bytes
 
         # устанавливаем новый лимит
-        if outline_client.add_data_limit(user_key_id, new_limit_bytes):
-            await append_to_file(config.PROMO_ACTIVATION_LOGS, f"{user_id}||{user_code}")
-            await message.answer(f"✅ Промокод '{user_code}' успешно активирован! Вам начислено *{bonus_gb} ГБ* трафика.", reply_markup=back_to_main_kb, parse_mode=ParseMode.MARKDOWN)
+        if await server.client.add_data_limit(user_key_id, new_limit_bytes):
+            await promo_engine.commit(user_id, promo_code)
+            activated = True
+            server.cache.refresh_soon()
+            await message.answer(f"✅ Промокод '{promo_code.code}' успешно активирован! Вам начислено *{bonus_gb} ГБ* трафика.", reply_markup=back_to_main_kb, parse_mode=ParseMode.MARKDOWN)
         else:
             raise Exception("Outline client failed to set new data limit.")
 
     except Exception as e:
         logger.error(f"Ошибка при активации промокода {user_code} для пользователя {user_id}: {e}")
         await message.answer("❌ Произошла непредвиденная ошибка при активации промокода. Пожалуйста, обратитесь в поддержку.", reply_markup=back_to_main_kb)
+    finally:
+        if not activated:
+            promo_engine.rollback(user_id, promo_code)
+
+@dp.message_handler(lambda message: message.from_user.id == config.support_account, commands=['promo_gen'])
+async def cmd_promo_gen(message: types.Message):
+    usage = (f"Использование: /promo_gen <количество> <ГБ> [лимит использований, по умолчанию {config.PROMO_DEFAULT_MAX_USES}; "
+             "0 — без лимита] [действует до ГГГГ-ММ-ДД]\n"
+             "Например: /promo_gen 1000 5 1 2025-12-31")
+    args = message.get_args().split()
+    try:
+        count, bonus_gb = int(args[0]), int(args[1])
+        max_uses = int(args[2]) if len(args) > 2 else config.PROMO_DEFAULT_MAX_USES
+        expires_at = promo.parse_expiration(args[3]) if len(args) > 3 else None
+    except (IndexError, ValueError):
+        await message.answer(usage)
+        return
+    if not 0 < count <= config.PROMO_GENERATE_MAX or bonus_gb <= 0 or max_uses < 0:
+        await message.answer(f"{usage}\nКоличество — от 1 до {config.PROMO_GENERATE_MAX}, ГБ — больше нуля.")
+        return
+
+    codes = await promo_engine.generate(count, bonus_gb, max_uses, expires_at)
+    expires_text = datetime.datetime.fromtimestamp(expires_at, promo.MOSCOW_TZ).strftime('%Y-%m-%d %H:%M') if expires_at else "бессрочно"
+    caption = f"Выпущено {count} промокодов на {bonus_gb} ГБ, лимит использований: {max_uses or 'нет'}, срок: {expires_text}"
+    document = types.InputFile(io.BytesIO('\n'.join(codes).encode('utf-8')), filename=f"promocodes_{bonus_gb}gb_{int(time.time())}.txt")
+    await message.answer_document(document, caption=caption)
+
+### Рассылка ###
+
+broadcaster = Broadcaster(bot, store, telegram_limiter)
+
+@dp.message_handler(lambda message: message.from_user.id == config.support_account, commands=['mailing'])
+async def cmd_mailing(message: types.Message):
+    if broadcaster.running:
+        await message.answer("Рассылка уже идет. Остановить: /mailing_stop")
+        return
+    await MailingState.waiting_for_text.set()
+    await message.answer("Отправьте сообщение для рассылки (текст, фото, видео или документ). "
+                         "Не удаляйте его до окончания рассылки — пользователи получат его копию.", reply_markup=cancel_kb)
+
+@dp.message_handler(state=MailingState.waiting_for_text, content_types=types.ContentTypes.ANY)
+async def process_mailing_message(message: types.Message, state: FSMContext):
+    await state.finish()
+    if message.text and message.text.lower() == 'отмена':
+        await message.answer("Рассылка отменена.", reply_markup=ReplyKeyboardRemove())
+        return
+    if broadcaster.start(message.chat.id, message.message_id):
+        await message.answer(f"Рассылка запущена: {broadcaster.state.total} пользователей. Остановить: /mailing_stop",
+                             reply_markup=ReplyKeyboardRemove())
+    else:
+        await message.answer("Рассылка уже идет. Остановить: /mailing_stop", reply_markup=ReplyKeyboardRemove())
+
+@dp.message_handler(lambda message: message.from_user.id == config.support_account, commands=['mailing_stop'])
+async def cmd_mailing_stop(message: types.Message):
+    if not broadcaster.stop():
+        await message.answer("Сейчас рассылка не идет.")
+
+### Платежи: администрирование ###
+
+@dp.message_handler(lambda message: message.from_user.id == config.support_account, commands=['payment'])
+async def cmd_payment(message: types.Message):
+    label = message.get_args().strip()
+    payment = payment_engine.ledger.get(label)
+    if payment is None:
+        await message.answer(f"Платеж {label or '—'} не найден.")
+        return
+    updated = datetime.datetime.fromtimestamp(payment.updated_at).strftime('%Y-%m-%d %H:%M:%S')
+    await message.answer(f"Платеж {payment.label}\nПользователь: {payment.user_id}\nСумма: {payment.price} ₽, "
+                         f"тариф: {payment.gb_limit} ГБ\nСостояние: {payment.state} (с {updated})")
+
+@dp.message_handler(lambda message: message.from_user.id == config.support_account, commands=['payments_audit'])
+async def cmd_payments_audit(message: types.Message):
+    await message.answer(payment_engine.ledger.audit())
+
+### Сверка ключей с Outline ###
+
+@dp.message_handler(lambda message: message.from_user.id == config.support_account, commands=['reconcile'])
+async def cmd_reconcile(message: types.Message):
+    apply = message.get_args().strip() == 'apply'
+    await message.answer("Сверка ключей запущена..." if apply else "Пробная сверка ключей (ничего не меняется)...")
+    try:
+        report = await reconciler.reconcile(dry_run=not apply)
+    except Exception as e:
+        logger.error(f"Ошибка сверки ключей: {e}")
+        await message.answer(f"Сверка не выполнена: {e}")
+        return
+    await message.answer(report.text())
+
+### Блокировка пользователей ###
+
+@dp.message_handler(lambda message: message.from_user.id == config.support_account, commands=['ban'])
+async def cmd_ban(message: types.Message):
+    user_id = message.get_args().strip()
+    if not user_id.isdigit():
+        await message.answer("Использование: /ban <ID пользователя>")
+        return
+    if await bans.ban(user_id):
+        logger.info(f"Пользователь {user_id} заблокирован")
+        await message.answer(f"Пользователь {user_id} заблокирован.")
+    else:
+        await message.answer(f"Пользователь {user_id} уже заблокирован.")
+
+@dp.message_handler(lambda message: message.from_user.id == config.support_account, commands=['unban'])
+async def cmd_unban(message: types.Message):
+    user_id = message.get_args().strip()
+    if not user_id.isdigit():
+        await message.answer("Использование: /unban <ID пользователя>")
+        return
+    if await bans.unban(user_id):
+        logger.info(f"Пользователь {user_id} разблокирован")
+        await message.answer(f"Пользователь {user_id} разблокирован.")
+    else:
+        await message.answer(f"Пользователь {user_id} не был заблокирован.")
+
+### Аналитика ###
+
+analytics = Analytics(store, outline_pool)
+
+@dp.message_handler(lambda message: message.from_user.id == config.support_account, commands=['report'])
+async def cmd_report(message: types.Message):
+    args = message.get_args().strip()
+    if args and not (args.isdigit() and 0 < int(args) <= 366):
+        await message.answer("Использование: /report [число дней, до 366]")
+        return
+    await analytics.update() # дочитываем только то, что появилось после прошлого обновления
+    await message.answer(analytics.report(int(args) if args else config.ANALYTICS_REPORT_DAYS))
+
+@dp.message_handler(lambda message: message.from_user.id == config.support_account, commands=['report_csv'])
+async def cmd_report_csv(message: types.Message):
+    daily = message.get_args().strip() == 'daily'
+    await analytics.update()
+    path = await analytics.export_csv(daily)
+    try:
+        document = types.InputFile(path, filename=f"{'revenue_daily' if daily else 'purchases'}_{int(time.time())}.csv")
+        await message.answer_document(document, caption="Итоги по дням и тарифам" if daily else "Все покупки")
+    finally:
+        os.remove(path)
 
 ### Фоновая задача: Уведомления и отчистка ###
 
-async def check_keys_and_notify(): # уведомляет об истечении срока; о малом остатке трафика; удаляет истекшие и исчерпанные ключи
-    await asyncio.sleep(10)
-    while True:
+sweeper = KeySweeper(bot, store, outline_pool, telegram_limiter, templates)
+expiration_scheduler = ExpirationScheduler(sweeper)
+usage_watcher = UsageWatcher(sweeper)
+reconciler = Reconciler(bot, store, outline_pool, telegram_limiter, expiration_scheduler, key_pool)
+
+# значения вычисляются только при запросе /metrics
+metrics.REGISTRY.gauge('bot_sweep_duration_seconds', "Длительность последней проверки ключей",
+                       function=lambda: sweeper.last_report and sweeper.last_report.duration)
+metrics.REGISTRY.gauge('bot_outline_keys', "Ключей на сервере Outline", ('server',),
+                       function=lambda: {(name,): server.key_count for name, server in outline_pool.servers.items()})
+metrics.REGISTRY.gauge('bot_outline_snapshot_age_seconds', "Возраст снимка ключей сервера", ('server',),
+                       function=lambda: {(name,): server.cache.age for name, server in outline_pool.servers.items()})
+metrics.REGISTRY.gauge('bot_pending_payments', "Счетов, ожидающих оплаты", function=lambda: len(payment_engine.pending))
+metrics.REGISTRY.gauge('bot_log_writer_queue', "Строк журналов, ожидающих записи", function=lambda: log_writer.queue_size)
+metrics.REGISTRY.gauge('bot_scheduled_expirations', "Событий в планировщике сроков", function=lambda: len(expiration_scheduler))
+metrics.REGISTRY.gauge('bot_key_pool_keys', "Ключей в запасе", ('gb_class',),
+                       function=lambda: {(str(gb_class),): len(keys) for gb_class, keys in key_pool.keys.items()})
+metrics.REGISTRY.gauge('bot_key_pool_target', "Целевой размер запаса", ('gb_class',),
+                       function=lambda: {(str(gb_class),): key_pool.target_size(gb_class) for gb_class in key_pool.keys})
+metrics.REGISTRY.gauge('bot_dependency_ready', "Готовность зависимости: 1 — готова, 0 — нет", ('dependency',),
+                       function=lambda: {(name,): int(ready) for name, ready in startup.state().items()})
+metrics.REGISTRY.gauge('bot_banned_users', "Заблокированных пользователей", function=lambda: len(bans))
+metrics.REGISTRY.gauge('bot_broadcast_processed', "Обработано получателей текущей рассылки",
+                       function=lambda: broadcaster.state.processed if broadcaster.running else None)
+
+async def load_data():
+    """Загрузка данных с диска вне цикла событий. До ее окончания обновления ждут готовности store."""
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(None, store.load)
+    # запас ключей, промокоды и аналитика читают только хранилище и свои файлы — загружаются параллельно
+    await asyncio.gather(*(loop.run_in_executor(None, load) for load in (key_pool.load, promo_engine.load, analytics.load)))
+    log_writer.start()
+    expiration_scheduler.load()
+    broadcaster.resume()
+    stuck_payments = payment_engine.load()
+    startup.mark_ready(readiness.STORE)
+    asyncio.create_task(expiration_scheduler.run())
+    asyncio.create_task(usage_watcher.run())
+    asyncio.create_task(sweeper.run())
+    asyncio.create_task(reconciler.run())
+    asyncio.create_task(analytics.run())
+    if config.KEY_POOL_ENABLED:
+        asyncio.create_task(key_pool.run())
+    asyncio.create_task(payment_engine.run())
+    if config.YOOMONEY_NOTIFICATIONS_ENABLED and not config.WEBHOOK_ENABLED:
+        await payment_engine.start_server()
+    logger.info("Фоновые задачи проверки ключей запущены.")
+    if stuck_payments: # упали во время выдачи ключа: повторять автоматически нельзя, ключ мог быть уже создан
+        logger.critical(f"Оплаченные платежи без выданного ключа: {stuck_payments}")
         try:
-            logger.info("Запущена периодическая проверка ключей...")
-            current_time_unix = int(time.time())
-            all_outline_keys = outline_client.get_keys()
-            expirations = read_file_lines(config.USERS_KEYS_EXPIRATIONS_FILE)
-            notified_users = read_file_lines(config.NOTIFIED_KEYS_FILE)
-
-            # Словари для быстрого доступа
-            outline_keys_dict = {key.key_id: key for key in all_outline_keys}
-            
-            new_expirations = []
-            keys_to_delete = []
-
-            for line in expirations:
-                try:
-                    user_id, expiration_unix, key_id = line.split('||')
-                    expiration_unix = int(expiration_unix)
-                    
-                    # Проверка на удаление
-                    if key_id not in outline_keys_dict or expiration_unix < current_time_unix:
-                        keys_to_delete.append((key_id, user_id, "срок действия истек"))
-                        continue
-
-                    outline_key = outline_keys_dict[key_id]
-                    used_bytes = outline_key.used_bytes if outline_key.used_bytes is not None else 0
-                    
-                    # Проверка лимита трафика
-                    if outline_key.data_limit and used_bytes >= outline_key.data_limit:
-                        keys_to_delete.append((key_id, user_id, "лимит трафика исчерпан"))
-                        continue
-
-                    # Логика уведомлений (один раз)
-                    if key_id not in notified_users:
-                        # Уведомление об окончании срока (за 3 дня)
-                        if expiration_unix - current_time_unix < 259200: # 3 дня
-                             await bot.send_message(user_id, read_file(config.NOTIFY_EXPIRATION_FILE))
-                             await append_to_file(config.NOTIFIED_KEYS_FILE, key_id)
-
-                        # Уведомление о малом трафике (осталось < 10%)
-                        elif outline_key.data_limit and (outline_key.data_limit - used_bytes) / outline_key.data_limit < 0.1:
-                            await bot.send_message(user_id, read_file(config.NOTIFY_LOW_TRAFFIC_FILE))
-                            await append_to_file(config.NOTIFIED_KEYS_FILE, key_id)
-                    
-                    new_expirations.append(line)
-
-                except Exception as e:
-                    logger.error(f"Ошибка при обработке строки ключа '{line}': {e}")
-                    new_expirations.append(line) # Сохраняем строку, чтобы не потерять данные
-
-            # Удаление ключей
-            for key_id, user_id, reason in keys_to_delete:
-                try:
-                    outline_client.delete_key(key_id)
-                    await bot.send_message(user_id, f"Ваш ключ был удален, так как {reason}. Вы можете приобрести новый в главном меню.")
-                    logger.info(f"Удален ключ {key_id} пользователя {user_id}. Причина: {reason}.")
-                except Exception as e:
-                    logger.error(f"Не удалось удалить ключ {key_id}: {e}")
-            
-            # Перезапись файла с актуальными ключами
-            with open(config.USERS_KEYS_EXPIRATIONS_FILE, 'w', encoding='utf-8') as f:
-                f.write('\n'.join(new_expirations) + '\n')
-
+            await bot.send_message(config.support_account, "Оплачены, но ключ не подтвержден (проверьте вручную):\n"
+                                   + "\n".join(stuck_payments))
         except Exception as e:
-            logger.error(f"Критическая ошибка в фоновой задаче `check_keys_and_notify`: {e}")
+            logger.error(f"Не удалось уведомить поддержку о незавершенных платежах: {e}")
 
-        await asyncio.sleep(3600)
+async def safe_load_data():
+    try:
+        await load_data()
+    except Exception as e: # без данных бот не работает: обновления так и будут получать ответ "бот запускается"
+        logger.critical(f"Не удалось загрузить данные, бот не готов к работе: {e!r}")
+        try:
+            await bot.send_message(config.support_account, f"Бот не смог загрузить данные и не отвечает пользователям: {e!r}")
+        except Exception as notify_error:
+            logger.error(f"Не удалось уведомить поддержку об ошибке запуска: {notify_error}")
 
 async def on_startup(dp: Dispatcher):
+    # прием обновлений начинается сразу, загрузка данных и пробы Outline и ЮMoney идут в фоне параллельно
     logger.info("Бот запускается...")
     ensure_dirs_exist()
-    asyncio.create_task(check_keys_and_notify())
-    logger.info("Фоновая задача проверки ключей запущена.")
+    bans.reload()
+    asyncio.create_task(safe_load_data())
+    asyncio.create_task(startup.run())
+    asyncio.create_task(outline_pool.run())
+    asyncio.create_task(templates.run())
+    asyncio.create_task(bans.run())
+    if config.METRICS_ENABLED:
+        await metrics.start_server()
+
+async def on_shutdown(dp: Dispatcher):
+    logger.info("Бот останавливается...")
+    await log_writer.close()
 
 if __name__ == '__main__':
-    executor.start_polling(dp, skip_updates=True, on_startup=on_startup)
\ No newline at end of file
+    if config.WEBHOOK_ENABLED:
+        webhook_server = WebhookServer(dp, on_startup=on_startup, on_shutdown=on_shutdown)
+        if config.YOOMONEY_NOTIFICATIONS_ENABLED: # уведомления ЮMoney принимает тот же HTTP-сервер
+            payment_engine.setup_routes(webhook_server.app)
+        webhook_server.run()
+    else:
+        # накопившиеся обновления обрабатываются пачками, внутри пачки — параллельно
+        executor.start_polling(dp, skip_updates=not config.STARTUP_PROCESS_BACKLOG, on_startup=on_startup, on_shutdown=on_shutdown)
\ No newline at end of file
@@ -0,0 +1,200 @@
+import bisect
+import logging
+import time
+from contextlib import contextmanager
+
+from aiogram import Bot
+from aiogram.dispatcher.handler import ctx_data, current_handler
+from aiogram.dispatcher.middlewares import BaseMiddleware
+from aiohttp import web
+
+import config
+
+logger = logging.getLogger(__name__)
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def format_labels(names, values) -> str:
+    if not names:
+        return ''
+    pairs = ','.join(f'{name}="{str(value)}"'.replace('\n', ' ') for name, value in zip(names, values))
+    return '{' + pairs + '}'
+
+
+class Counter:
+    def __init__(self, name: str, documentation: str, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+
+    def inc(self, *labels, amount: float = 1.0):
+        self._values[labels] = self._values.get(labels, 0.0) + amount
+
+    def collect(self):
+        yield f"# HELP {self.name} {self.documentation}"
+        yield f"# TYPE {self.name} counter"
+        for labels, value in list(self._values.items()):
+            yield f"{self.name}{format_labels(self.labelnames, labels)} {value}"
+
+
+class Gauge:
+    """Значение вычисляется функцией в момент запроса /metrics, а не обновляется на каждом событии.
+    Функция возвращает число или словарь {кортеж значений меток: число}."""
+
+    def __init__(self, name: str, documentation: str, labelnames=(), function=None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.function = function
+        self._values = {}
+
+    def set(self, value: float, *labels):
+        self._values[labels] = value
+
+    def set_function(self, function):
+        self.function = function
+
+    def collect(self):
+        yield f"# HELP {self.name} {self.documentation}"
+        yield f"# TYPE {self.name} gauge"
+        values = dict(self._values)
+        if self.function is not None:
+            try:
+                result = self.function()
+            except Exception as e:
+                logger.error(f"Ошибка вычисления метрики {self.name}: {e}")
+                result = {}
+            values.update(result if isinstance(result, dict) else {(): result})
+        for labels, value in values.items():
+            if value is not None:
+                yield f"{self.name}{format_labels(self.labelnames, labels)} {value}"
+
+
+class Histogram:
+    def __init__(self, name: str, documentation: str, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._series = {}  # labels -> [счетчики по корзинам..., +Inf, сумма]
+
+    def observe(self, value: float, *labels):
+        series = self._series.get(labels)
+        if series is None:
+            series = self._series[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+        series[bisect.bisect_left(self.buckets, value)] += 1
+        series[-1] += value
+
+    def collect(self):
+        yield f"# HELP {self.name} {self.documentation}"
+        yield f"# TYPE {self.name} histogram"
+        names = self.labelnames + ('le',)
+        for labels, series in list(self._series.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), series):
+                cumulative += count
+                yield f"{self.name}_bucket{format_labels(names, labels + (bound,))} {cumulative}"
+            yield f"{self.name}_sum{format_labels(self.labelnames, labels)} {series[-1]}"
+            yield f"{self.name}_count{format_labels(self.labelnames, labels)} {cumulative}"
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+
+    def register(self, metric):
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self.register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name, documentation, labelnames=(), function=None):
+        return self.register(Gauge(name, documentation, labelnames, function))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def render(self) -> str:
+        return '\n'.join(line for metric in self._metrics.values() for line in metric.collect()) + '\n'
+
+
+REGISTRY = Registry()
+
+handler_seconds = REGISTRY.histogram('bot_handler_seconds', "Время работы обработчика обновления", ('handler',))
+handler_errors = REGISTRY.counter('bot_handler_errors_total', "Необработанные исключения в обработчиках", ('handler',))
+api_seconds = REGISTRY.histogram('bot_api_call_seconds', "Время вызова внешнего API", ('service', 'target', 'method'))
+api_errors = REGISTRY.counter('bot_api_call_errors_total', "Ошибки вызовов внешнего API", ('service', 'target', 'method'))
+
+
+@contextmanager
+def track_call(service: str, target: str, method: str):
+    """Замеряет вызов внешнего API: время и ошибки по (service, target, method)."""
+    started_at = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        api_errors.inc(service, target, method)
+        raise
+    finally:
+        api_seconds.observe(time.perf_counter() - started_at, service, target, method)
+
+
+class InstrumentedBot(Bot):
+    """Bot, замеряющий каждый запрос к Bot API."""
+
+    async def request(self, method, data=None, files=None, **kwargs):
+        with track_call('telegram', 'bot_api', method):
+            return await super().request(method, data, files, **kwargs)
+
+
+class HandlerMetricsMiddleware(BaseMiddleware):
+    """Время работы каждого обработчика сообщений и нажатий кнопок, по имени функции."""
+
+    KEY = 'metrics_handler'
+
+    async def _start(self, data: dict):
+        handler = current_handler.get(None)
+        data[self.KEY] = (getattr(handler, '__name__', 'unknown'), time.perf_counter())
+
+    async def _finish(self, data: dict):
+        name, started_at = data.get(self.KEY, (None, None))
+        if name is not None:
+            handler_seconds.observe(time.perf_counter() - started_at, name)
+
+    async def on_process_message(self, message, data: dict):
+        await self._start(data)
+
+    async def on_post_process_message(self, message, results, data: dict):
+        await self._finish(data)
+
+    async def on_process_callback_query(self, call, data: dict):
+        await self._start(data)
+
+    async def on_post_process_callback_query(self, call, results, data: dict):
+        await self._finish(data)
+
+    @staticmethod
+    async def on_error(update, exception):
+        """Регистрируется как errors_handler: считает ошибку и передает ее дальше."""
+        data = ctx_data.get(None) or {}
+        name = data.get(HandlerMetricsMiddleware.KEY, ('unknown',))[0]
+        handler_errors.inc(name)
+
+
+async def handle_metrics(request: web.Request):
+    return web.Response(text=REGISTRY.render(), content_type='text/plain', charset='utf-8',
+                        headers={'X-Content-Type-Options': 'nosniff'})
+
+
+async def start_server():
+    """HTTP-сервер /metrics только для локальных сборщиков (по умолчанию 127.0.0.1)."""
+    app = web.Application()
+    app.router.add_get('/metrics', handle_metrics)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, config.METRICS_HOST, config.METRICS_PORT).start()
+    logger.info(f"Метрики доступны на http://{config.METRICS_HOST}:{config.METRICS_PORT}/metrics")
+    return runner
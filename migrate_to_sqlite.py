@@ -0,0 +1,15 @@
+"""Переносит данные из data/*.txt в базу SQLite.
+
+Запуск: python migrate_to_sqlite.py [путь_к_базе]
+После переноса укажите STORAGE_BACKEND = 'sqlite' в config.py.
+"""
+import logging
+import sys
+
+import config
+from storage import import_flat_files
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+if __name__ == '__main__':
+    import_flat_files(sys.argv[1] if len(sys.argv) > 1 else config.SQLITE_DB_FILE)
@@ -0,0 +1,287 @@
+import asyncio
+import functools
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from outline_vpn.outline_vpn import OutlineServerErrorException, OutlineVPN
+
+import config
+from metrics import track_call
+from readiness import LazyClient
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncOutlineClient:
+    """Неблокирующий клиент Outline.
+
+    Синхронные вызовы OutlineVPN выполняются в ограниченном пуле потоков, поэтому медленный
+    сервер Outline не останавливает цикл событий. HTTP-сессия с keep-alive у OutlineVPN общая
+    для всех потоков, на каждый вызов действует таймаут. OutlineVPN создается при первом вызове.
+    """
+
+    def __init__(self, api_url: str, cert_sha256: str, timeout: float = None, max_workers: int = None, name: str = 'outline'):
+        self.name = name
+        self.timeout = timeout or config.OUTLINE_API_TIMEOUT
+        self._client = LazyClient(functools.partial(OutlineVPN, api_url=api_url, cert_sha256=cert_sha256), f"Outline {name}")
+        self._executor = ThreadPoolExecutor(max_workers=max_workers or config.OUTLINE_API_MAX_WORKERS,
+                                            thread_name_prefix='outline')
+
+    async def _call(self, method: str, *args, **kwargs):
+        return await self._run(method, getattr(self._client, method), *args, **kwargs)
+
+    async def _run(self, method: str, func, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        # таймаут передается и в requests, чтобы поток не висел после отмены ожидания
+        func = functools.partial(func, *args, timeout=self.timeout, **kwargs)
+        try:
+            with track_call('outline', self.name, method):
+                return await asyncio.wait_for(loop.run_in_executor(self._executor, func), self.timeout * 2)
+        except asyncio.TimeoutError:
+            logger.error(f"Превышено время ожидания Outline API: {method}")
+            raise
+
+    async def get_keys(self):
+        return await self._call('get_keys')
+
+    async def get_key(self, key_id: str):
+        return await self._call('get_key', key_id)
+
+    async def create_key(self, **kwargs):
+        return await self._call('create_key', **kwargs)
+
+    async def rename_key(self, key_id: str, name: str):
+        return await self._call('rename_key', key_id, name)
+
+    async def add_data_limit(self, key_id: str, limit_bytes: int):
+        return await self._call('add_data_limit', key_id, limit_bytes)
+
+    def _delete_key(self, key_id: str, timeout: float = None) -> bool:
+        # OutlineVPN.delete_key возвращает False на любой ответ, кроме 204, и ошибку сервера не отличить от удаленного ключа
+        response = self._client.session.delete(f"{self._client.api_url}/access-keys/{key_id}", timeout=timeout)
+        if response.status_code == 404:
+            return False
+        if response.status_code != 204:
+            raise OutlineServerErrorException(f"Unable to delete key {key_id}: HTTP {response.status_code} {response.text}")
+        return True
+
+    async def delete_key(self, key_id: str) -> bool:
+        """True — ключ удален, False — его уже нет на сервере. Ошибка сервера поднимает исключение,
+        поэтому retry_with_backoff и повторы планировщика срабатывают."""
+        return await self._run('delete_key', self._delete_key, key_id)
+
+    async def get_transferred_data(self):
+        return await self._call('get_transferred_data')
+
+    async def get_server_information(self):
+        return await self._call('get_server_information')
+
+    def close(self):
+        self._executor.shutdown(wait=False)
+
+
+class KeyMetricsCache:
+    """Общий снимок ключей сервера Outline вместе с расходом трафика.
+
+    Снимок обновляется в фоне раз в OUTLINE_KEYS_CACHE_TTL секунд. Одновременно к серверу идет
+    не больше одного get_keys(): изменение ключей во время запроса (invalidate) только помечает
+    снимок устаревшим, и после текущего запроса выполняется ровно один повторный. get_keys()
+    отдает имеющийся снимок сразу, а устаревший обновляет в фоне; ждет запроса, только если
+    снимка еще нет или последнее обновление не удалось. refresh() дожидается снимка, начатого
+    после последнего изменения.
+    """
+
+    def __init__(self, client: AsyncOutlineClient, ttl: float = None):
+        self.client = client
+        self.ttl = ttl or config.OUTLINE_KEYS_CACHE_TTL
+        self._keys = {}
+        self._updated_at = None
+        self._fetch_task = None
+        self._dirty = False  # ключи менялись после начала последнего запроса
+        self._total_bytes = 0
+        self.transfer_rate = 0.0  # байт/с по всем ключам между двумя последними снимками
+        self.last_error = None  # ошибка последнего обновления, None — обновилось успешно
+
+    @property
+    def snapshot(self) -> dict:
+        """Последний полученный снимок без обращения к серверу."""
+        return self._keys
+
+    @property
+    def age(self):
+        return None if self._updated_at is None else time.monotonic() - self._updated_at
+
+    @property
+    def available(self) -> bool:
+        """Снимок есть и последнее обновление не завершилось ошибкой."""
+        return self._updated_at is not None and self.last_error is None
+
+    async def get_keys(self) -> dict:
+        """Возвращает {key_id: OutlineKey}; устаревший снимок отдается сразу и обновляется в фоне."""
+        if not self.available:
+            return await self.refresh()
+        if self.age >= self.ttl or self._dirty:
+            self._start()
+        return self._keys
+
+    async def get_key(self, key_id: str):
+        return (await self.get_keys()).get(key_id)
+
+    def _start(self) -> asyncio.Future:
+        task = self._fetch_task
+        if task is None or task.done():
+            task = self._fetch_task = asyncio.ensure_future(self._fetch_until_clean())
+            task.add_done_callback(self._fetch_done)
+        return task
+
+    async def refresh(self) -> dict:
+        # shield: отмена одного ожидающего обработчика не должна прерывать общий запрос
+        return await asyncio.shield(self._start())
+
+    def invalidate(self):
+        self._dirty = True
+
+    def refresh_soon(self):
+        """Помечает снимок устаревшим и запускает обновление, не дожидаясь его."""
+        self.invalidate()
+        self._start()
+
+    def _fetch_done(self, task: asyncio.Future):
+        if task.cancelled():
+            return
+        error = task.exception() # ошибку получают и ожидающие refresh(), здесь она только записывается
+        if error is not None:
+            logger.error(f"Не удалось обновить снимок ключей Outline: {error!r}")
+
+    async def _safe_refresh(self):
+        try:
+            await self.refresh()
+        except Exception:
+            pass # уже записано в _fetch_done
+
+    async def _fetch_until_clean(self) -> dict:
+        while True:
+            self._dirty = False
+            try:
+                await self._fetch()
+            except Exception as e:
+                self.last_error = e
+                raise
+            self.last_error = None
+            if not self._dirty:
+                return self._keys
+
+    async def _fetch(self):
+        started_at = time.monotonic()
+        keys = await self.client.get_keys()
+        if self._updated_at is not None and started_at <= self._updated_at:
+            return # снимок, начатый раньше текущего, его не заменяет
+        total_bytes = sum(key.used_bytes or 0 for key in keys)
+        if self._updated_at is not None:
+            self.transfer_rate = max(total_bytes - self._total_bytes, 0) / (started_at - self._updated_at)
+        self._total_bytes = total_bytes
+        self._keys = {key.key_id: key for key in keys}
+        self._updated_at = started_at
+
+    async def run(self): # фоновое обновление снимка
+        while True:
+            await self._safe_refresh()
+            await asyncio.sleep(self.ttl)
+
+
+class OutlineServer:
+    """Один сервер Outline из config.OUTLINE_SERVERS: клиент и снимок его ключей."""
+
+    def __init__(self, name: str, api_url: str, cert_sha256: str, weight: float = 1.0):
+        self.name = name
+        self.weight = weight
+        self.client = AsyncOutlineClient(api_url=api_url, cert_sha256=cert_sha256, name=name)
+        self.cache = KeyMetricsCache(self.client)
+        self._placed_at = []  # время размещения ключей, которых еще нет в снимке
+
+    @property
+    def key_count(self) -> int:
+        updated_at = self.cache._updated_at or 0.0
+        self._placed_at = [t for t in self._placed_at if t >= updated_at]
+        return len(self.cache._keys) + len(self._placed_at)
+
+    def note_placed(self, refresh: bool = True):
+        self._placed_at.append(time.monotonic())
+        if refresh: # при создании ключей пачкой снимок обновляется один раз после пачки
+            self.cache.refresh_soon()
+
+
+class OutlinePool:
+    """Набор серверов Outline. Новые ключи размещаются на наименее загруженном сервере,
+    остальные вызовы направляются серверу, которому принадлежит ключ."""
+
+    def __init__(self, servers_config: list):
+        self.servers = {}
+        for server_config in servers_config:
+            server = OutlineServer(server_config['name'], server_config['api_url'], server_config['cert_sha256'],
+                                   server_config.get('weight', 1.0))
+            self.servers[server.name] = server
+        self.default = next(iter(self.servers.values()))
+
+    def get(self, name: str):
+        return self.servers.get(name)
+
+    async def pick_server(self) -> OutlineServer:
+        """Наименее загруженный сервер: доля ключей и доля недавнего трафика с учетом веса сервера.
+
+        Загрузка считается по последним снимкам и ключам, размещенным после них, без запросов к серверам.
+        Сервер пропускается, если последнее обновление его снимка не удалось; снимок запрашивается,
+        только если его еще нет.
+        """
+        servers = list(self.servers.values())
+        if len(servers) == 1:
+            return servers[0]
+
+        missing = [server for server in servers if server.cache.age is None and server.cache.last_error is None]
+        if missing: # сразу после запуска
+            await asyncio.gather(*(server.cache.get_keys() for server in missing), return_exceptions=True)
+        available = [server for server in servers if server.cache.available]
+        if not available:
+            raise RuntimeError("Нет доступных серверов Outline")
+
+        total_keys = sum(server.key_count for server in available) or 1
+        total_rate = sum(server.cache.transfer_rate for server in available) or 1.0
+
+        def load(server):
+            return (server.key_count / total_keys + server.cache.transfer_rate / total_rate) / server.weight
+
+        return min(available, key=load)
+
+    async def probe(self):
+        """Проба готовности: хотя бы один сервер отдает ключи. Заодно прогревает снимки ключей."""
+        servers = list(self.servers.values())
+        results = await asyncio.gather(*(server.cache.get_keys() for server in servers), return_exceptions=True)
+        errors = [f"{server.name}: {result!r}" for server, result in zip(servers, results) if isinstance(result, Exception)]
+        if len(errors) == len(servers):
+            raise RuntimeError(f"Нет доступных серверов Outline ({'; '.join(errors)})")
+        for error in errors:
+            logger.warning(f"Сервер Outline недоступен: {error}")
+
+    async def get_all_keys(self, fresh: bool = False) -> dict:
+        """Снимки всех серверов параллельно: {server_name: {key_id: OutlineKey}}. Недоступные серверы пропускаются.
+
+        fresh — дождаться снимков, запрошенных после вызова: кэшированный снимок может не содержать
+        недавно созданных ключей, и отсутствие ключа в нем не значит, что ключа нет на сервере.
+        """
+        servers = list(self.servers.values())
+        if fresh:
+            for server in servers:
+                server.cache.invalidate()
+        results = await asyncio.gather(*(server.cache.refresh() if fresh else server.cache.get_keys() for server in servers),
+                                       return_exceptions=True)
+        snapshots = {}
+        for server, result in zip(servers, results):
+            if isinstance(result, Exception):
+                logger.error(f"Не удалось получить ключи сервера {server.name}: {result}")
+                continue
+            snapshots[server.name] = result
+        return snapshots
+
+    async def run(self):
+        await asyncio.gather(*(server.cache.run() for server in self.servers.values()))
@@ -0,0 +1,334 @@
+import asyncio
+import datetime
+import functools
+import hashlib
+import hmac
+import logging
+import time
+import dataclasses
+
+from aiohttp import web
+from yoomoney import Quickpay
+
+import config
+from metrics import track_call
+from storage import PaymentRecord
+
+logger = logging.getLogger(__name__)
+
+# Состояния платежа в журнале: pending → paid → fulfilled, либо failed (ключ не создан) и expired (не оплачен вовремя)
+PENDING = 'pending'
+PAID = 'paid'
+FULFILLED = 'fulfilled'
+FAILED = 'failed'
+EXPIRED = 'expired'
+UNKNOWN = 'unknown'
+FINAL_STATES = (FULFILLED, FAILED, EXPIRED)
+
+NOTIFICATION_FIELDS = ('notification_type', 'operation_id', 'amount', 'currency', 'datetime', 'sender', 'codepro')
+PAYMENT_HISTORY_MARGIN = 600  # секунд истории до создания самого старого ожидающего счета
+STUCK_PAYMENT_SECONDS = 600  # оплачено, но ключ не выдан дольше этого — требуется внимание
+
+
+def check_notification_signature(form, secret: str) -> bool:
+    """Проверка sha1_hash HTTP-уведомления ЮMoney о входящем переводе. Без секрета подпись подделывается,
+    поэтому с пустым секретом не принимается ни одно уведомление."""
+    if not secret:
+        return False
+    values = [form.get(name, '') for name in NOTIFICATION_FIELDS] + [secret, form.get('label', '')]
+    expected = hashlib.sha1('&'.join(values).encode('utf-8')).hexdigest()
+    return hmac.compare_digest(expected, form.get('sha1_hash', ''))
+
+
+class PaymentLedger:
+    """Сохраняемый журнал платежей по меткам.
+
+    generate_payment создает запись pending, дальше метка переходит pending → paid → fulfilled.
+    Переходы выполняются под асинхронной блокировкой метки и записываются в хранилище до того,
+    как создается ключ, поэтому повторная проверка или перезапуск не приводят к повторной выдаче.
+    """
+
+    def __init__(self, store):
+        self.store = store
+        self._locks = {}
+
+    def get(self, label: str):
+        return self.store.get_payment(label)
+
+    def lock(self, label: str) -> asyncio.Lock:
+        return self._locks.setdefault(label, asyncio.Lock())
+
+    async def create(self, label: str, user_id, price: float, gb_limit: int):
+        now = int(time.time())
+        record = PaymentRecord(label, str(user_id), float(price), int(gb_limit), PENDING, now, now)
+        await self.store.save_payment(record)
+        return record
+
+    async def transition(self, record: PaymentRecord, state: str) -> PaymentRecord:
+        """Вызывается под lock(record.label)."""
+        record = dataclasses.replace(record, state=state, updated_at=int(time.time()))
+        await self.store.save_payment(record)
+        return record
+
+    def forget_lock(self, label: str):
+        lock = self._locks.get(label)
+        if lock is not None and not lock.locked():
+            del self._locks[label]
+
+    def audit(self) -> str:
+        """Сверка журнала платежей с журналом покупок."""
+        now = time.time()
+        paid = self.store.get_payments(PAID)
+        failed = self.store.get_payments(FAILED)
+        fulfilled = self.store.get_payments(FULFILLED)
+        transactions = self.store.get_transaction_label_counts()
+
+        stuck = [r.label for r in paid if now - r.updated_at > STUCK_PAYMENT_SECONDS]
+        unlogged = [r.label for r in fulfilled if r.label not in transactions]
+        duplicates = [f"{label} ×{count}" for label, count in transactions.items() if count > 1]
+
+        lines = [
+            f"Ожидают оплаты: {len(self.store.get_payments(PENDING))}",
+            f"Оплачены, ключ выдается: {len(paid)}",
+            f"Выданы: {len(fulfilled)}",
+            f"Не оплачены вовремя: {len(self.store.get_payments(EXPIRED))}",
+            f"Ошибка выдачи ключа: {len(failed)}",
+        ]
+        for title, labels in (("Оплачены, но ключ не выдан", stuck), ("Ошибка выдачи", [r.label for r in failed]),
+                              ("Выданы без записи в журнале покупок", unlogged),
+                              ("Повторные записи в журнале покупок", duplicates)):
+            if labels:
+                lines.append(f"\n{title}:\n" + "\n".join(labels[:50]))
+        return "\n".join(lines)
+
+
+class PaymentEngine:
+    """Подтверждение оплат ЮMoney без участия пользователя.
+
+    Оплата подтверждается HTTP-уведомлением ЮMoney (с проверкой подписи) или фоновым опросом:
+    одна выборка истории операций сверяется сразу со всеми ожидающими метками. Как только оплата
+    найдена, ключ выдается автоматически через on_paid. Повторные нажатия "Я оплатил" отвечаются
+    из журнала платежей, а не новым запросом к API.
+    """
+
+    def __init__(self, client, store, on_paid):
+        self.client = client
+        self.ledger = PaymentLedger(store)
+        self.on_paid = on_paid  # корутина (PaymentRecord) -> bool: выдать ключ и сообщить пользователю
+        self.pending = set()  # метки в состоянии pending
+        self._last_poll_at = 0.0
+        self._poll_task = None
+        self._history_complete = False  # последний опрос прочитал историю с самого старого счета целиком
+        self._lookups = {}  # метка -> (время запуска, задача поиска с label=)
+        self._wakeup = asyncio.Event()
+        self._tasks = set()
+        self.loaded = False
+
+    # Платежи
+
+    async def create_payment(self, amount: float, user_id: int, description: str, label: str):
+        loop = asyncio.get_running_loop()
+        with track_call('yoomoney', 'quickpay', 'create'):
+            quickpay = await loop.run_in_executor(None, functools.partial(
+                Quickpay, receiver=config.yoomoney_wallet, quickpay_form="shop", targets=description,
+                paymentType="SB", sum=amount, label=label))
+        return quickpay
+
+    def load(self):
+        """Восстанавливает ожидающие оплаты после перезапуска. Возвращает метки, оплата которых
+        подтверждена, но выдача ключа не завершилась, — их нужно проверить вручную."""
+        self.pending = {record.label for record in self.ledger.store.get_payments(PENDING)}
+        self.loaded = True
+        if self.pending:
+            self._wakeup.set()
+        return [record.label for record in self.ledger.store.get_payments(PAID)]
+
+    async def register(self, label: str, user_id, price: float, gb_limit: int):
+        await self.ledger.create(label, user_id, price, gb_limit)
+        self.pending.add(label)
+        self._wakeup.set()
+
+    def status(self, label: str) -> str:
+        record = self.ledger.get(label)
+        return record.state if record else UNKNOWN
+
+    async def check(self, label: str) -> str:
+        """Статус оплаты для кнопки "Я оплатил". Общая история запрашивается не чаще раза в PAYMENT_CHECK_CACHE_TTL
+        секунд, одновременные нажатия ждут один общий запрос. Отдельный запрос с label= делается, только
+        если последний опрос не прочитал историю целиком, и не чаще раза в PAYMENT_CHECK_CACHE_TTL на метку."""
+        if self.status(label) != PENDING:
+            return self.status(label)
+        if time.monotonic() - self._last_poll_at >= config.PAYMENT_CHECK_CACHE_TTL:
+            await self.poll()
+        if self.status(label) == PENDING and not self._history_complete and await self._shared_lookup(label):
+            return PAID
+        return self.status(label)
+
+    async def _shared_lookup(self, label: str) -> bool:
+        started_at, task = self._lookups.get(label, (0.0, None))
+        if task is None or (task.done() and time.monotonic() - started_at >= config.PAYMENT_CHECK_CACHE_TTL):
+            task = asyncio.ensure_future(self.lookup(label))
+            self._lookups[label] = (time.monotonic(), task)
+        return await asyncio.shield(task)
+
+    def _start_confirm(self, label: str, amount: float): # выдача ключа идет в фоне, статус PAID виден сразу
+        task = asyncio.create_task(self._confirm(label, amount))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _confirm(self, label: str, amount: float):
+        async with self.ledger.lock(label):
+            record = self.ledger.get(label)
+            if record is None or record.state != PENDING or amount < record.price:
+                return
+            record = await self.ledger.transition(record, PAID) # сохраняется до выдачи ключа
+            self.pending.discard(label)
+            logger.info(f"Успешная оплата найдена по {label} на сумму {amount}")
+            try:
+                delivered = await self.on_paid(record)
+            except Exception as e:
+                logger.critical(f"Ошибка выдачи ключа после оплаты {label}: {e}")
+                delivered = False
+            await self.ledger.transition(record, FULFILLED if delivered else FAILED)
+        self.ledger.forget_lock(label)
+
+    # Опрос истории операций
+
+    async def poll(self):
+        if self._poll_task is None or self._poll_task.done():
+            self._poll_task = asyncio.ensure_future(self._poll())
+        await asyncio.shield(self._poll_task)
+
+    async def _poll(self):
+        if not self.pending:
+            return
+        self._last_poll_at = time.monotonic()
+        found = await self._scan_history()
+        self._history_complete = found is not None
+        self._lookups = {label: lookup for label, lookup in self._lookups.items() if label in self.pending}
+        if found is not None: # без полной выборки истории счета не истекают: оплата могла в нее не попасть
+            await self._expire_pending(found)
+
+    async def _scan_history(self):
+        """Вся история поступлений с создания самого старого ожидающего счета, по страницам.
+        Возвращает найденные оплаченные метки или None, если историю получить не удалось."""
+        records = [self.ledger.get(label) for label in self.pending]
+        oldest = min((record.created_at for record in records if record), default=time.time())
+        # время без часового пояса: UTC не позже московского, поэтому выборка не окажется короче нужной
+        from_date = datetime.datetime.fromtimestamp(oldest - PAYMENT_HISTORY_MARGIN, datetime.timezone.utc).replace(tzinfo=None)
+        found, start_record = set(), None
+        for _ in range(config.PAYMENT_HISTORY_MAX_PAGES):
+            try:
+                history = await self._history(type='deposition', from_date=from_date, start_record=start_record,
+                                              records=config.PAYMENT_HISTORY_RECORDS)
+            except Exception as e:
+                logger.error(f"Ошибка при получении истории операций YooMoney: {e}")
+                return None
+            for operation in history.operations:
+                if operation.label in self.pending and operation.status == 'success':
+                    found.add(operation.label)
+                    self._start_confirm(operation.label, float(operation.amount or 0))
+            start_record = history.next_record
+            if not start_record:
+                return found
+        logger.warning(f"История операций YooMoney длиннее {config.PAYMENT_HISTORY_MAX_PAGES} страниц, остаток проверим в следующий раз")
+        return None
+
+    async def _history(self, **kwargs):
+        loop = asyncio.get_running_loop()
+        with track_call('yoomoney', 'api', 'operation_history'):
+            return await asyncio.wait_for(loop.run_in_executor(None, functools.partial(
+                self.client.operation_history, **kwargs)), config.YOOMONEY_API_TIMEOUT)
+
+    async def lookup(self, label: str) -> bool:
+        """Ищет оплату одной метки запросом истории с label=. Возвращает True, если оплата найдена
+        и запущена выдача ключа."""
+        try:
+            return await self._lookup(label)
+        except Exception as e:
+            logger.error(f"Ошибка при поиске оплаты {label} в истории YooMoney: {e}")
+            return False
+
+    async def _lookup(self, label: str) -> bool:
+        history = await self._history(label=label)
+        for operation in history.operations:
+            if operation.label == label and operation.status == 'success' and label in self.pending:
+                self._start_confirm(label, float(operation.amount or 0))
+                return True
+        return False
+
+    async def _expire_pending(self, found: set):
+        deadline = time.time() - config.PAYMENT_PENDING_TTL
+        for label in list(self.pending):
+            record = self.ledger.get(label)
+            if record is None or record.created_at >= deadline or label in found:
+                continue
+            try: # последняя проверка метки перед тем, как счет истечет
+                if await self._lookup(label):
+                    continue
+            except Exception as e:
+                logger.error(f"Ошибка при поиске оплаты {label} в истории YooMoney, счет пока не истекает: {e}")
+                continue
+            async with self.ledger.lock(label):
+                record = self.ledger.get(label)
+                if record.state == PENDING:
+                    await self.ledger.transition(record, EXPIRED)
+                self.pending.discard(label)
+            self.ledger.forget_lock(label)
+
+    async def run(self):
+        while True:
+            if not self.pending:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+            try:
+                await self.poll()
+            except Exception as e:
+                logger.error(f"Ошибка фоновой проверки оплат: {e}")
+            await asyncio.sleep(config.PAYMENT_POLL_INTERVAL)
+
+    async def probe(self):
+        """Проба готовности: API ЮMoney принимает токен (запрос одной операции из истории)."""
+        loop = asyncio.get_running_loop()
+        with track_call('yoomoney', 'api', 'operation_history'):
+            await asyncio.wait_for(loop.run_in_executor(None, functools.partial(
+                self.client.operation_history, records=1)), config.YOOMONEY_API_TIMEOUT)
+
+    # HTTP-уведомления
+
+    async def handle_notification(self, request: web.Request):
+        form = await request.post()
+        if not check_notification_signature(form, config.yoomoney_notification_secret):
+            logger.warning(f"Отклонено уведомление YooMoney с неверной подписью от {request.remote}")
+            return web.Response(status=403)
+        if not self.loaded: # журнал еще загружается, ЮMoney повторит уведомление позже
+            return web.Response(status=503)
+        if form.get('unaccepted') == 'true': # перевод еще не зачислен (например, защищен кодом)
+            return web.Response()
+
+        label = form.get('label', '')
+        # withdraw_amount — сумма, списанная с плательщика, то есть цена тарифа без учета комиссии
+        amount = float(form.get('withdraw_amount') or form.get('amount') or 0)
+        if label in self.pending:
+            self._start_confirm(label, amount)
+        return web.Response()
+
+    def setup_routes(self, app: web.Application) -> bool:
+        if not config.yoomoney_notification_secret:
+            logger.critical("Уведомления ЮMoney включены, но yoomoney_notification_secret не задан: "
+                            "прием уведомлений отключен, оплаты подтверждаются только опросом")
+            return False
+        app.router.add_post(config.YOOMONEY_NOTIFY_PATH, self.handle_notification)
+        return True
+
+    async def start_server(self):
+        """Отдельный HTTP-сервер для уведомлений, если бот работает без вебхука."""
+        app = web.Application()
+        if not self.setup_routes(app):
+            return None
+        runner = web.AppRunner(app)
+        await runner.setup()
+        await web.TCPSite(runner, config.PAYMENTS_WEBAPP_HOST, config.PAYMENTS_WEBAPP_PORT).start()
+        logger.info(f"Прием уведомлений YooMoney: {config.PAYMENTS_WEBAPP_HOST}:{config.PAYMENTS_WEBAPP_PORT}"
+                    f"{config.YOOMONEY_NOTIFY_PATH}")
+        return runner
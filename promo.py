@@ -0,0 +1,165 @@
+import datetime
+import logging
+import os
+import secrets
+import time
+from dataclasses import dataclass
+
+import config
+from fileio import append_to_file, log_writer, read_file, read_file_lines, rewrite_file
+
+logger = logging.getLogger(__name__)
+
+# результаты reserve()
+RESERVED = 'reserved'
+NOT_FOUND = 'not_found'
+EXHAUSTED = 'exhausted'
+EXPIRED = 'expired'
+ALREADY_ACTIVATED = 'already_activated'
+IN_PROGRESS = 'in_progress'
+
+CODE_ALPHABET = 'ABCDEFGHJKLMNPQRSTUVWXYZ23456789'  # без похожих O/0 и I/1
+MOSCOW_TZ = datetime.timezone(datetime.timedelta(hours=3))
+
+
+@dataclass
+class PromoCode:
+    code: str
+    bonus_gb: int
+    max_uses: int  # 0 — без ограничения
+    expires_at: int = None  # unix-время, None — бессрочный
+    uses: int = 0  # подтвержденные и зарезервированные активации
+
+    @property
+    def exhausted(self) -> bool:
+        return self.max_uses > 0 and self.uses >= self.max_uses
+
+    def expired(self, now: float) -> bool:
+        return self.expires_at is not None and now >= self.expires_at
+
+    def line(self) -> str:
+        return f"{self.code}||{self.bonus_gb}||{self.max_uses}||{self.expires_at or ''}"
+
+
+def parse_expiration(value: str):
+    """unix-время или дата ГГГГ-ММ-ДД (действует до конца дня по Москве); пусто — бессрочно."""
+    value = value.strip()
+    if not value:
+        return None
+    if value.isdigit():
+        return int(value)
+    day = datetime.datetime.strptime(value, '%Y-%m-%d').replace(tzinfo=MOSCOW_TZ)
+    return int((day + datetime.timedelta(days=1)).timestamp())
+
+
+class PromoEngine:
+    """Промокоды: индекс кодов в памяти, лимиты использований, сроки и одна активация на пользователя.
+
+    Строка PROMOCODES_FILE — code||бонус ГБ||лимит использований||срок (unix-время или ГГГГ-ММ-ДД).
+    Старые строки из одного кода берут бонус из PROMO_DISCOUNT_DIR/<code>.txt и лимит
+    PROMO_DEFAULT_MAX_USES; при загрузке файл переписывается в новом формате без исчерпанных
+    и истекших кодов. Число использований восстанавливается по журналу активаций хранилища,
+    поэтому при активации файлы кодов не читаются и не переписываются.
+
+    reserve() проверяет и занимает использование кода без единого await, поэтому одновременные
+    активации не превысят лимит, а один пользователь не активирует два кода параллельно.
+    После начисления бонуса вызывается commit(), при ошибке — rollback().
+    """
+
+    def __init__(self, store):
+        self.store = store
+        self.codes = {}  # code -> PromoCode
+        self._reserved_users = {}  # user_id -> code, активация которого еще идет
+        self._raw_lines = []  # нераспознанные строки файла кодов, сохраняются как есть
+
+    def __len__(self):
+        return len(self.codes)
+
+    def load(self):
+        counts = self.store.get_promo_activation_counts()
+        rewrite_needed = False
+        now = time.time()
+        for line in read_file_lines(config.PROMOCODES_FILE):
+            parts = [part.strip() for part in line.split('||')]
+            code = parts[0]
+            if not code:
+                continue
+            try:
+                if len(parts) == 1: # старый формат: бонус в отдельном файле
+                    bonus = read_file(os.path.join(config.PROMO_DISCOUNT_DIR, f"{code}.txt"))
+                    promo = PromoCode(code, int(bonus), config.PROMO_DEFAULT_MAX_USES)
+                    rewrite_needed = True
+                else:
+                    promo = PromoCode(code, int(parts[1]), int(parts[2]) if len(parts) > 2 and parts[2] else config.PROMO_DEFAULT_MAX_USES,
+                                      parse_expiration(parts[3]) if len(parts) > 3 else None)
+            except ValueError:
+                logger.error(f"Некорректная строка в {config.PROMOCODES_FILE}: '{line}'")
+                self._raw_lines.append(line)
+                continue
+            promo.uses = counts.get(code, 0)
+            if promo.exhausted or promo.expired(now):
+                rewrite_needed = True
+                continue
+            self.codes[code] = promo
+        if rewrite_needed:
+            rewrite_file(config.PROMOCODES_FILE, self._lines())
+        logger.info(f"Промокоды загружены: {len(self.codes)} активных")
+
+    def _lines(self) -> list:
+        return self._raw_lines + [promo.line() for promo in self.codes.values()]
+
+    def find(self, code: str):
+        return self.codes.get(code) or self.codes.get(code.upper())
+
+    # Активация
+
+    def reserve(self, user_id: str, code: str):
+        """Возвращает (PromoCode, RESERVED) или (None, причина отказа)."""
+        if user_id in self._reserved_users:
+            return None, IN_PROGRESS
+        if self.store.has_promo_activation(user_id):
+            return None, ALREADY_ACTIVATED
+        promo = self.find(code)
+        if promo is None:
+            return None, NOT_FOUND
+        if promo.expired(time.time()):
+            return None, EXPIRED
+        if promo.exhausted:
+            return None, EXHAUSTED
+        promo.uses += 1
+        self._reserved_users[user_id] = promo.code
+        return promo, RESERVED
+
+    async def commit(self, user_id: str, promo: PromoCode):
+        try:
+            await self.store.add_promo_activation(user_id, promo.code)
+        finally:
+            self._reserved_users.pop(user_id, None)
+        if promo.exhausted: # из файла код уйдет при следующей загрузке
+            logger.info(f"Промокод {promo.code} использован полностью ({promo.uses} из {promo.max_uses})")
+
+    def rollback(self, user_id: str, promo: PromoCode):
+        if self._reserved_users.pop(user_id, None) is not None:
+            promo.uses -= 1
+
+    # Выпуск кодов
+
+    def _new_code(self, prefix: str, length: int) -> str:
+        while True:
+            code = prefix + ''.join(secrets.choice(CODE_ALPHABET) for _ in range(length))
+            if code not in self.codes:
+                return code
+
+    async def generate(self, count: int, bonus_gb: int, max_uses: int = 1, expires_at: int = None,
+                       prefix: str = '') -> list:
+        """Выпускает count новых кодов одной записью в PROMOCODES_FILE."""
+        promos = []
+        for _ in range(count):
+            promo = PromoCode(self._new_code(prefix, config.PROMO_CODE_LENGTH), bonus_gb, max_uses, expires_at)
+            self.codes[promo.code] = promo
+            promos.append(promo)
+        await append_to_file(config.PROMOCODES_FILE, '\n'.join(promo.line() for promo in promos))
+        if log_writer.running:
+            await log_writer.flush()
+        logger.info(f"Выпущено {count} промокодов на {bonus_gb} ГБ (лимит {max_uses or 'нет'})")
+        return [promo.code for promo in promos]
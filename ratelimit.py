@@ -0,0 +1,110 @@
+import asyncio
+import logging
+import time
+
+from aiogram.utils.exceptions import BotBlocked, ChatNotFound, RetryAfter, UserDeactivated
+
+logger = logging.getLogger(__name__)
+
+# Результаты TelegramRateLimiter.deliver
+SENT = 'sent'
+UNREACHABLE = 'unreachable'
+FAILED = 'failed'
+
+
+class TokenBucket:
+    """Ограничитель частоты: rate токенов в секунду, не больше capacity подряд.
+    Ожидающие получают токены по очереди."""
+
+    def __init__(self, rate: float, capacity: float = None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self._tokens = self.capacity
+        self._updated_at = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated_at) * self.rate)
+        self._updated_at = now
+
+    async def acquire(self):
+        async with self._lock:
+            self._refill()
+            while self._tokens < 1:
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+                self._refill()
+            self._tokens -= 1
+
+    def pause(self, seconds: float):
+        """Забирает все токены на seconds секунд вперед (после flood wait от Telegram)."""
+        self._tokens = -seconds * self.rate
+
+
+class TelegramRateLimiter:
+    """Общий для всего бота лимит исходящих сообщений: глобальный поток токенов
+    и минимальный интервал между сообщениями в один чат.
+
+    С parent лимитер — доля общего лимита (например, для рассылки): сообщение ждет токен и своего,
+    и общего лимитера, а flood wait от Telegram приостанавливает оба.
+    """
+
+    def __init__(self, rate: float, per_chat_interval: float = 1.0, max_chats: int = 10000, parent=None):
+        self.bucket = TokenBucket(rate)
+        self.per_chat_interval = per_chat_interval
+        self.max_chats = max_chats
+        self.parent = parent
+        self._chat_last_sent = {}
+
+    def pause(self, seconds: float):
+        self.bucket.pause(seconds)
+        if self.parent is not None:
+            self.parent.pause(seconds)
+
+    async def acquire(self, chat_id):
+        if self.parent is not None: # интервал между сообщениями в чат соблюдает общий лимитер
+            await self.bucket.acquire()
+            await self.parent.acquire(chat_id)
+            return
+        now = time.monotonic()
+        wait = self._chat_last_sent.get(chat_id, 0) + self.per_chat_interval - now
+        self._chat_last_sent[chat_id] = max(now, now + wait)
+        if len(self._chat_last_sent) > self.max_chats:
+            self._chat_last_sent = {chat: t for chat, t in self._chat_last_sent.items() if t > now - self.per_chat_interval}
+        if wait > 0:
+            await asyncio.sleep(wait)
+        await self.bucket.acquire()
+
+    async def deliver(self, chat_id, send, attempts: int = 3) -> str:
+        """Выполняет отправку send() в чат chat_id с учетом лимитов и повторами.
+        Возвращает SENT, UNREACHABLE (бот заблокирован, чат удален) или FAILED."""
+        for attempt in range(attempts):
+            await self.acquire(chat_id)
+            try:
+                await send()
+                return SENT
+            except RetryAfter as e: # flood wait: приостанавливаем всю отправку
+                logger.warning(f"Telegram просит подождать {e.timeout} с")
+                self.pause(e.timeout)
+            except (BotBlocked, ChatNotFound, UserDeactivated) as e:
+                logger.info(f"Сообщение пользователю {chat_id} не доставлено: {e}")
+                return UNREACHABLE
+            except Exception as e:
+                logger.error(f"Ошибка отправки сообщения пользователю {chat_id} (попытка {attempt + 1}): {e}")
+                await asyncio.sleep(2 ** attempt)
+        return FAILED
+
+    async def send_message(self, bot, chat_id, text, attempts: int = 3, **kwargs) -> bool:
+        """Отправляет сообщение с учетом лимитов и повторами. False — если доставить не удалось."""
+        return await self.deliver(chat_id, lambda: bot.send_message(chat_id, text, **kwargs), attempts) == SENT
+
+
+async def retry_with_backoff(func, *args, attempts: int = 3, base_delay: float = 1.0, **kwargs):
+    """Вызывает корутину func, повторяя при ошибке с экспоненциальной задержкой."""
+    for attempt in range(attempts):
+        try:
+            return await func(*args, **kwargs)
+        except Exception:
+            if attempt == attempts - 1:
+                raise
+            await asyncio.sleep(base_delay * 2 ** attempt)
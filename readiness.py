@@ -0,0 +1,197 @@
+import asyncio
+import logging
+import threading
+import time
+
+from aiogram import types
+from aiogram.dispatcher.handler import CancelHandler
+from aiogram.dispatcher.middlewares import BaseMiddleware
+
+import config
+from metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+not_ready_updates = REGISTRY.counter('bot_not_ready_updates_total', "Обновлений, отклоненных до готовности зависимостей", ('dependency',))
+
+STORE = 'store'  # данные с диска загружены, журналы открыты
+OUTLINE = 'outline'  # отвечает хотя бы один сервер Outline
+YOOMONEY = 'yoomoney'  # API ЮMoney принимает токен
+
+
+class LazyClient:
+    """Клиент внешнего API, который создается при первом обращении к нему.
+
+    Ошибка создания (неверный сертификат, недоступная библиотека) не прерывает импорт main:
+    она повторится при следующем обращении и будет видна в пробах готовности.
+    Создание потокобезопасно — клиенты вызываются из пулов потоков.
+    """
+
+    def __init__(self, factory, name: str):
+        self._factory = factory
+        self._name = name
+        self._client = None
+        self._lock = threading.Lock()
+
+    def get(self):
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    self._client = self._factory()
+                    logger.info(f"Создан клиент {self._name}")
+        return self._client
+
+    def __getattr__(self, name):
+        return getattr(self.get(), name)
+
+
+class Readiness:
+    """Готовность зависимостей бота: данных на диске и внешних API.
+
+    Локальные шаги запуска отмечаются mark_ready(). Внешние API проверяются пробами, все пробы идут
+    параллельно. До первого успеха проба повторяется с задержкой от READINESS_RETRY_MIN, удваивая ее
+    до READINESS_RETRY_MAX секунд, затем — раз в READINESS_PROBE_INTERVAL; неудачная проба снимает
+    готовность до следующего успеха. Запуск считается завершенным, когда каждая зависимость
+    хотя бы раз была проверена, даже если какая-то из них недоступна.
+    """
+
+    def __init__(self, names=(STORE,)):
+        self.started_at = time.monotonic()
+        self._events = {name: asyncio.Event() for name in names}
+        self._probes = {}  # имя -> корутина проверки
+        self._checked = set()  # зависимости, проверенные хотя бы раз
+        self.errors = {}  # имя -> последняя ошибка пробы
+
+    def add_probe(self, name: str, probe):
+        self._events.setdefault(name, asyncio.Event())
+        self._probes[name] = probe
+
+    @property
+    def names(self) -> tuple:
+        return tuple(self._events)
+
+    @property
+    def starting(self) -> bool:
+        return len(self._checked) < len(self._events)
+
+    def ready(self, names=None) -> bool:
+        return all(self._events[name].is_set() for name in (self.names if names is None else names))
+
+    def state(self) -> dict:
+        return {name: event.is_set() for name, event in self._events.items()}
+
+    def _checked_once(self, name: str):
+        if name in self._checked:
+            return
+        self._checked.add(name)
+        if not self.starting:
+            unavailable = [name for name, event in self._events.items() if not event.is_set()]
+            logger.info(f"Запуск завершен за {time.monotonic() - self.started_at:.1f} с"
+                        + (f", недоступны: {', '.join(unavailable)}" if unavailable else ""))
+
+    def mark_ready(self, name: str):
+        event = self._events[name]
+        if not event.is_set():
+            event.set()
+            self.errors.pop(name, None)
+            logger.info(f"Зависимость {name} готова через {time.monotonic() - self.started_at:.1f} с после запуска")
+        self._checked_once(name)
+
+    def mark_failed(self, name: str, error: Exception):
+        event = self._events[name]
+        if event.is_set():
+            logger.error(f"Зависимость {name} стала недоступна: {error}")
+        event.clear()
+        self.errors[name] = str(error)
+        self._checked_once(name)
+
+    async def wait(self, names=None, timeout: float = None) -> bool:
+        """Ждет готовности names (по умолчанию всех) не дольше timeout. Возвращает, дождались ли."""
+        names = self.names if names is None else names
+        try:
+            await asyncio.wait_for(asyncio.gather(*(self._events[name].wait() for name in names)), timeout)
+        except asyncio.TimeoutError:
+            return False
+        return self.ready(names)
+
+    async def _watch(self, name: str, probe):
+        delay = config.READINESS_RETRY_MIN
+        while True:
+            try:
+                await asyncio.wait_for(probe(), config.READINESS_PROBE_TIMEOUT)
+            except Exception as e:
+                self.mark_failed(name, e)
+                logger.warning(f"Проба {name} не прошла, повтор через {delay:.0f} с: {e!r}")
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, config.READINESS_RETRY_MAX)
+                continue
+            self.mark_ready(name)
+            delay = config.READINESS_RETRY_MIN
+            await asyncio.sleep(config.READINESS_PROBE_INTERVAL)
+
+    async def run(self):
+        await asyncio.gather(*(self._watch(name, probe) for name, probe in self._probes.items()))
+
+
+class ReadinessMiddleware(BaseMiddleware):
+    """Не пускает обновление к обработчику, пока не готовы нужные ему зависимости.
+
+    Нужные зависимости берутся из READINESS_REQUIREMENTS: ключ '*' — для всех обновлений, остальные —
+    команда или начало callback_data, как в THROTTLE_RATES. Обновление ждет готовности READINESS_WAIT
+    секунд, после чего пользователь сразу получает ответ "сервис запускается" вместо ошибки.
+    С hold_backlog обновления, пришедшие во время запуска (накопившиеся за перезапуск), ждут до
+    STARTUP_BACKLOG_WAIT секунд и обрабатываются, как только зависимости готовы; aiogram
+    обрабатывает их параллельно, поэтому очередь не выстраивается за медленным API.
+    """
+
+    def __init__(self, readiness: Readiness, requirements: dict = None, hold_backlog: bool = False):
+        super().__init__()
+        self.readiness = readiness
+        self.requirements = config.READINESS_REQUIREMENTS if requirements is None else requirements
+        self.hold_backlog = hold_backlog
+        self._prefixes = sorted((key for key in self.requirements if key != '*'), key=len, reverse=True)
+
+    def needs(self, key: str) -> tuple:
+        """Зависимости обновления: общие '*' и правило с самым длинным совпадающим началом."""
+        needs = tuple(self.requirements.get('*', ()))
+        for prefix in self._prefixes:
+            if key.startswith(prefix):
+                return needs + tuple(name for name in self.requirements[prefix] if name not in needs)
+        return needs
+
+    async def _admitted(self, key: str):
+        """Возвращает None, если обработчик можно запускать, иначе текст ответа пользователю."""
+        needs = self.needs(key)
+        if self.readiness.ready(needs):
+            return None
+        starting = self.readiness.starting
+        timeout = config.STARTUP_BACKLOG_WAIT if self.hold_backlog and starting else config.READINESS_WAIT
+        if await self.readiness.wait(needs, timeout):
+            return None
+        for name in needs:
+            if not self.readiness.ready((name,)):
+                not_ready_updates.inc(name)
+                break
+        if starting:
+            return "⏳ Бот запускается. Повторите, пожалуйста, через минуту."
+        return "⚠️ Сервис временно недоступен. Мы уже чиним, попробуйте чуть позже."
+
+    async def on_pre_process_message(self, message: types.Message, data: dict):
+        text = await self._admitted(message.get_command(pure=True) or '')
+        if text is None:
+            return
+        try:
+            await message.answer(text)
+        except Exception as e:
+            logger.warning(f"Не удалось ответить {message.from_user.id} о недоступности: {e}")
+        raise CancelHandler()
+
+    async def on_pre_process_callback_query(self, call: types.CallbackQuery, data: dict):
+        text = await self._admitted(call.data or '')
+        if text is None:
+            return
+        try:
+            await call.answer(text, show_alert=True)
+        except Exception as e:
+            logger.warning(f"Не удалось ответить {call.from_user.id} о недоступности: {e}")
+        raise CancelHandler()
@@ -0,0 +1,218 @@
+import asyncio
+import logging
+import re
+import time
+from dataclasses import dataclass, field
+
+import config
+from payments import FAILED
+from ratelimit import retry_with_backoff
+
+logger = logging.getLogger(__name__)
+
+KEY_NAME = re.compile(r'^(Paid|FreeTrial)_(\d+)_(\d+)$')  # имена из create_outline_key: {префикс}_{user_id}_{время}
+POOL_KEY_NAME = re.compile(r'^Pool_\d+_(\d+)$')  # ключи запаса из keypool: Pool_{ГБ}_{время}
+MONTH_SECONDS = 30 * 24 * 3600
+GB = 1024 ** 3
+REPORT_ITEMS = 10  # строк каждого раздела в отчете, остальное — только числом
+
+
+@dataclass
+class Orphan:
+    server: str
+    key: object  # OutlineKey
+    user_id: str = None
+    expiration_unix: int = None
+    reason: str = ''
+    gb_limit: int = None  # тариф, выведенный из лимита ключа; None — лимит не совпадает ни с одним тарифом
+
+
+@dataclass
+class ReconcileReport:
+    checked_servers: list = field(default_factory=list)
+    skipped_servers: list = field(default_factory=list)
+    local_keys: int = 0
+    remote_keys: int = 0
+    dead: list = field(default_factory=list)       # (server, key_id): есть в файлах, нет на сервере
+    adopt: list = field(default_factory=list)      # Orphan: ключ пользователя, не попавший в файлы
+    delete: list = field(default_factory=list)     # Orphan: удалить с сервера
+    unknown: list = field(default_factory=list)    # Orphan: имя не наше, не трогаем
+    applied: bool = False
+    errors: int = 0
+
+    @property
+    def clean(self) -> bool:
+        return not (self.dead or self.adopt or self.delete or self.unknown)
+
+    def text(self) -> str:
+        mode = "применена" if self.applied else "пробный запуск, ничего не изменено"
+        lines = [f"Сверка ключей с Outline ({mode})",
+                 f"Серверы: {', '.join(self.checked_servers) or 'нет'}"
+                 + (f"; недоступны: {', '.join(self.skipped_servers)}" if self.skipped_servers else ""),
+                 f"Ключей в файлах: {self.local_keys}, на серверах: {self.remote_keys}"]
+
+        def section(title, items, render):
+            if items:
+                lines.append(f"\n{title}: {len(items)}")
+                lines.extend(f"  {render(item)}" for item in items[:REPORT_ITEMS])
+                if len(items) > REPORT_ITEMS:
+                    lines.append(f"  … и еще {len(items) - REPORT_ITEMS}")
+
+        section("Нет на сервере, убрать из файлов", self.dead, lambda ref: f"{ref[0]}/{ref[1]}")
+        section("Потерянные ключи пользователей, вернуть владельцам", self.adopt,
+                lambda o: f"{o.server}/{o.key.key_id} {o.key.name} → {o.user_id}{o.reason and f' ({o.reason})'}")
+        section("Удалить с сервера", self.delete, lambda o: f"{o.server}/{o.key.key_id} {o.key.name}: {o.reason}")
+        section("Чужие ключи без записи (не трогаем)", self.unknown, lambda o: f"{o.server}/{o.key.key_id} '{o.key.name}'")
+        if self.clean:
+            lines.append("\nРасхождений нет.")
+        elif not self.applied:
+            lines.append("\nПрименить: /reconcile apply")
+        if self.errors:
+            lines.append(f"\nОшибок при применении: {self.errors} (подробности в журнале)")
+        return "\n".join(lines)
+
+
+class Reconciler:
+    """Сверка записей о ключах (keys_ids.txt, сроки, отметки уведомлений) с ключами на серверах Outline.
+
+    Локальные записи берутся до запроса снимков, поэтому ключ, созданный во время сверки, не будет
+    принят за удаленный. Расхождения считаются разностями множеств (server, key_id):
+    - записи о ключах, которых нет на сервере, вычищаются из всех файлов одной перезаписью каждого;
+    - ключи на сервере без записи с именем Paid_/FreeTrial_ возвращаются владельцу (запись, срок,
+      сообщение с ключом), если пользователь известен и срок по времени создания еще не вышел,
+      иначе удаляются. Ключи моложе RECONCILE_GRACE не трогаются: их создание может еще идти.
+    Ключи запаса (Pool_) сверяются с его составом: пропавшие с сервера убираются из запаса,
+    не попавшие в запас удаляются. Ключи с другими именами только попадают в отчет.
+    """
+
+    def __init__(self, bot, store, pool, limiter, scheduler, key_pool=None):
+        self.bot = bot
+        self.store = store
+        self.pool = pool
+        self.limiter = limiter
+        self.scheduler = scheduler
+        self.key_pool = key_pool
+        self.last_report = None
+        self._lock = asyncio.Lock()
+
+    def _months(self, user_id: str, outline_key, created_at: int) -> int:
+        """Срок ключа в месяцах: безлимит на 3 месяца узнаем по неудачному платежу пользователя."""
+        if outline_key.data_limit:
+            return 1
+        payments = [p for p in self.store.get_payments(FAILED) if p.user_id == user_id and p.gb_limit >= 998]
+        if not payments:
+            return 1
+        payment = min(payments, key=lambda p: abs(p.updated_at - created_at))
+        return 3 if payment.gb_limit == 999 else 1
+
+    @staticmethod
+    def _tariff(outline_key, months: int):
+        """Тариф по лимиту ключа на сервере. Лимит, увеличенный промокодом, тарифу не соответствует — тогда None."""
+        if not outline_key.data_limit:
+            return 999 if months == 3 else 998
+        gb_limit = round(outline_key.data_limit / GB)
+        return gb_limit if gb_limit in config.PRICE_NEW or gb_limit == config.FREE_TRIAL_GB else None
+
+    def _classify(self, server: str, outline_key, now: int, report: ReconcileReport):
+        pool_match = POOL_KEY_NAME.match(outline_key.name or '')
+        if pool_match is not None:
+            if now - int(pool_match.group(1)) >= config.RECONCILE_GRACE:
+                report.delete.append(Orphan(server, outline_key, reason="ключ запаса без записи"))
+            return
+        match = KEY_NAME.match(outline_key.name or '')
+        if match is None:
+            report.unknown.append(Orphan(server, outline_key))
+            return
+        kind, user_id, created_at = match.group(1), match.group(2), int(match.group(3))
+        if now - created_at < config.RECONCILE_GRACE:
+            return
+        months = self._months(user_id, outline_key, created_at)
+        expiration_unix = created_at + MONTH_SECONDS * months
+        if not self.store.has_user(user_id):
+            report.delete.append(Orphan(server, outline_key, user_id, reason="неизвестный пользователь"))
+        elif expiration_unix <= now:
+            report.delete.append(Orphan(server, outline_key, user_id, reason="срок действия уже истек"))
+        else:
+            reason = "пробный" if kind == 'FreeTrial' else ""
+            report.adopt.append(Orphan(server, outline_key, user_id, expiration_unix, reason, self._tariff(outline_key, months)))
+
+    async def plan(self) -> ReconcileReport:
+        report = ReconcileReport()
+        known = {(record.server, record.key_id) for record in self.store.get_all_keys()}
+        report.local_keys = len(known)
+        known.update((record.server, record.key_id) for record in self.store.get_expirations())
+        if self.key_pool is not None:
+            known.update(self.key_pool.refs())
+
+        servers = list(self.pool.servers.values())
+        for server in servers: # снимок, запрошенный до чтения записей, может не содержать только что созданный ключ
+            server.cache.invalidate()
+        results = await asyncio.gather(*(server.cache.refresh() for server in servers), return_exceptions=True)
+        now = int(time.time())
+        for server, result in zip(servers, results):
+            if isinstance(result, Exception):
+                logger.error(f"Сверка: не удалось получить ключи сервера {server.name}: {result}")
+                report.skipped_servers.append(server.name)
+                continue
+            report.checked_servers.append(server.name)
+            report.remote_keys += len(result)
+            local_ids = {key_id for name, key_id in known if name == server.name}
+            remote_ids = set(result)
+            report.dead.extend((server.name, key_id) for key_id in sorted(local_ids - remote_ids))
+            for key_id in sorted(remote_ids - local_ids):
+                self._classify(server.name, result[key_id], now, report)
+
+        # записи о серверах, которых больше нет в конфигурации, не трогаем — сервер мог быть отключен временно
+        return report
+
+    async def _adopt(self, orphan: Orphan):
+        key = orphan.key
+        await self.store.add_key(orphan.user_id, key.access_url, key.key_id, orphan.server, orphan.gb_limit)
+        expiration = await self.store.add_expiration(orphan.user_id, orphan.expiration_unix, key.key_id, orphan.server)
+        self.scheduler.schedule(expiration)
+        logger.info(f"Сверка: ключ {key.key_id} на сервере {orphan.server} возвращен пользователю {orphan.user_id}")
+        await self.limiter.send_message(
+            self.bot, orphan.user_id,
+            f"🔑 Мы нашли ваш ключ, который не удалось выдать ранее:\n\n`{key.access_url}`\n\n"
+            "Он уже работает и отображается в разделе «Мои ключи».", parse_mode='Markdown')
+
+    async def _delete(self, orphan: Orphan):
+        await retry_with_backoff(self.pool.get(orphan.server).client.delete_key, orphan.key.key_id)
+        logger.info(f"Сверка: удален ключ {orphan.key.key_id} '{orphan.key.name}' на сервере {orphan.server}: {orphan.reason}")
+
+    async def apply(self, report: ReconcileReport):
+        if report.dead:
+            removed = await self.store.remove_keys(report.dead)
+            if self.key_pool is not None:
+                removed += await self.key_pool.discard(report.dead)
+            logger.info(f"Сверка: из файлов убрано {len(report.dead)} записей ({removed} ключей)")
+        results = await asyncio.gather(*(self._adopt(orphan) for orphan in report.adopt),
+                                       *(self._delete(orphan) for orphan in report.delete), return_exceptions=True)
+        for result in results:
+            if isinstance(result, Exception):
+                report.errors += 1
+                logger.error(f"Сверка: ошибка применения: {result}")
+        for server_name in {orphan.server for orphan in report.adopt + report.delete}:
+            self.pool.get(server_name).cache.refresh_soon()
+        report.applied = True
+
+    async def reconcile(self, dry_run: bool = True) -> ReconcileReport:
+        async with self._lock:
+            report = await self.plan()
+            if not dry_run:
+                await self.apply(report)
+            self.last_report = report
+            logger.info(f"Сверка завершена{' (пробный запуск)' if dry_run else ''}: к очистке {len(report.dead)}, "
+                        f"вернуть {len(report.adopt)}, удалить {len(report.delete)}, чужих {len(report.unknown)}")
+            return report
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(config.RECONCILE_INTERVAL)
+            try:
+                report = await self.reconcile(dry_run=not config.RECONCILE_AUTO_APPLY)
+                # рутинную очистку файлов не докладываем, но без автоприменения ее нужно подтвердить
+                if report.adopt or report.delete or report.errors or (report.dead and not report.applied):
+                    await self.limiter.send_message(self.bot, config.support_account, report.text())
+            except Exception as e:
+                logger.error(f"Ошибка фоновой сверки ключей: {e}")
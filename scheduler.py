@@ -0,0 +1,100 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+
+import config
+from sweeper import EXPIRATION_NOTICE_SECONDS, SweepReport
+
+logger = logging.getLogger(__name__)
+
+NOTICE = 'notice'
+EXPIRE = 'expire'
+MAX_SLEEP = 300  # просыпаемся не реже раза в 5 минут на случай перевода системных часов
+RETRY_DELAY = 300  # повтор неудачного удаления через 5 минут
+
+
+class ExpirationScheduler:
+    """Планировщик сроков действия ключей на min-куче (deadline, key).
+
+    Для каждого ключа в куче лежат два события: уведомление за 3 дня до окончания срока и само
+    окончание. Планировщик спит ровно до ближайшего события и обрабатывает только наступившие.
+    Устаревшие события (ключ уже удален или продлен) отбрасываются при извлечении из кучи.
+    Удаление и уведомления выполняются теми же средствами, что и в KeySweeper, который остается
+    резервной сверкой с Outline.
+    """
+
+    def __init__(self, sweeper):
+        self.sweeper = sweeper
+        self.store = sweeper.store
+        self._heap = []
+        self._counter = itertools.count()
+        self._wakeup = asyncio.Event()
+
+    def __len__(self):
+        return len(self._heap)
+
+    def load(self):
+        for record in self.store.get_expirations():
+            self.schedule(record)
+        logger.info(f"Планировщик сроков загружен: {len(self._heap)} событий")
+
+    def schedule(self, record):
+        earliest = self._heap[0][0] if self._heap else None
+        if not self.store.is_notified(record.server, record.key_id):
+            self._push(record.expiration_unix - EXPIRATION_NOTICE_SECONDS, NOTICE, record)
+        self._push(record.expiration_unix, EXPIRE, record)
+        if earliest is None or self._heap[0][0] < earliest:
+            self._wakeup.set()
+
+    def _push(self, deadline, kind, record):
+        heapq.heappush(self._heap, (deadline, next(self._counter), kind, record.server, record.key_id, record.expiration_unix))
+
+    def _pop_due(self, now):
+        due = []
+        while self._heap and self._heap[0][0] <= now:
+            due.append(heapq.heappop(self._heap))
+        return due
+
+    async def _process(self, due):
+        report = SweepReport()
+        expired, notifications = [], []
+        for _, _, kind, server, key_id, expiration_unix in due:
+            record = self.store.get_expiration(server, key_id)
+            if record is None or record.expiration_unix != expiration_unix: # ключ удален или продлен
+                continue
+            report.checked += 1
+            if kind == EXPIRE:
+                expired.append(record)
+            elif not self.store.is_notified(server, key_id):
+                notifications.append(record)
+
+        results = await asyncio.gather(
+            *(self.sweeper._delete(record, "срок действия истек", True, report) for record in expired),
+            *(self.sweeper._notify(record, config.NOTIFY_EXPIRATION_FILE, report) for record in notifications))
+        await self.sweeper.finish_deletions(results[:len(expired)])
+        for record, ref in zip(expired, results):
+            if not ref: # повторим позже; если ключ уже удален другим путем, событие отбросится
+                self._push(time.time() + RETRY_DELAY, EXPIRE, record)
+        if report.checked:
+            logger.info(f"Обработаны наступившие сроки: {report.checked} событий, удалено {report.deleted} "
+                        f"(ошибок {report.delete_failed}), уведомлений {report.notified} (ошибок {report.notify_failed})")
+
+    async def run(self):
+        while True:
+            try:
+                due = self._pop_due(time.time())
+                if due:
+                    await self._process(due)
+                    continue
+
+                self._wakeup.clear()
+                timeout = min(self._heap[0][0] - time.time(), MAX_SLEEP) if self._heap else MAX_SLEEP
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), max(timeout, 0))
+                except asyncio.TimeoutError:
+                    pass
+            except Exception as e:
+                logger.error(f"Ошибка в планировщике сроков действия ключей: {e}")
+                await asyncio.sleep(5)
@@ -0,0 +1,553 @@
+import logging
+import sqlite3
+import time
+from collections import Counter, defaultdict
+from dataclasses import dataclass
+
+import config
+from fileio import append_to_file, log_writer, read_file_lines
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class KeyRecord:
+    user_id: str
+    access_url: str
+    key_id: str
+    server: str
+    gb_limit: int = None  # тариф, по которому выдан ключ; None — ключ выдан до появления этого поля
+
+
+@dataclass
+class ExpirationRecord:
+    user_id: str
+    expiration_unix: int
+    key_id: str
+    server: str
+
+
+@dataclass
+class PaymentRecord:
+    label: str
+    user_id: str
+    price: float
+    gb_limit: int
+    state: str
+    created_at: int
+    updated_at: int
+
+
+def user_order(user_id: str):
+    """Порядок обхода пользователей: числовые user_id по возрастанию без преобразования в int."""
+    return len(user_id), user_id
+
+
+def key_line(record: KeyRecord) -> str:
+    """Строка keys_ids.txt; тариф пишется пятым полем, у ключей без тарифа оно пустое."""
+    gb_limit = '' if record.gb_limit is None else record.gb_limit
+    return f'{record.user_id}||{record.access_url}||{record.key_id}||{record.server}||{gb_limit}'
+
+
+def default_server() -> str:
+    """Сервер для старых записей, сделанных до появления нескольких серверов Outline."""
+    return config.OUTLINE_SERVERS[0]['name']
+
+
+class FileStore:
+    """Хранилище пользователей и ключей поверх файлов из data/.
+
+    Файлы читаются один раз при старте, дальше все обработчики работают с индексами в памяти
+    по user_id и (server, key_id), а изменения дописываются в те же файлы. key_id уникален
+    только в пределах одного сервера Outline, поэтому ключи адресуются парой (server, key_id).
+    """
+
+    def __init__(self):
+        self.users = set()
+        self.unreachable_users = set()        # пользователи, заблокировавшие бота
+        self.usernames = {}                   # user_id -> последняя строка из users_username.txt
+        self.keys = {}                        # (server, key_id) -> KeyRecord
+        self.user_keys = defaultdict(list)    # user_id -> [(server, key_id)] в порядке выдачи
+        self.expirations = {}                 # (server, key_id) -> ExpirationRecord
+        self.notified_keys = set()            # {(server, key_id)}
+        self.promo_activations = {}           # user_id -> промокод
+        self.payments = {}                    # label -> PaymentRecord
+        self.transaction_labels = Counter()   # label -> число записей в журнале покупок
+
+    def load(self):
+        for line in read_file_lines(config.USERS_FILE):
+            self.users.add(line.strip())
+
+        self.unreachable_users.update(read_file_lines(config.UNREACHABLE_USERS_FILE))
+
+        for line in read_file_lines(config.USERS_USERNAME_FILE):
+            self.usernames[line.split('|', 1)[0]] = line
+
+        server = default_server()
+        for line in read_file_lines(config.KEYS_IDS_FILE):
+            parts = line.split('||')
+            if len(parts) == 3: # запись без сервера
+                parts.append(server)
+            if len(parts) == 4: # запись без тарифа
+                parts.append('')
+            if len(parts) != 5 or not (parts[4] == '' or parts[4].isdigit()):
+                logger.error(f"Некорректная строка в {config.KEYS_IDS_FILE}: '{line}'")
+                continue
+            self._index_key(KeyRecord(*parts[:4], int(parts[4]) if parts[4] else None))
+
+        for line in read_file_lines(config.USERS_KEYS_EXPIRATIONS_FILE):
+            parts = line.split('||')
+            if len(parts) == 3:
+                parts.append(server)
+            try:
+                user_id, expiration_unix, key_id, key_server = parts
+                self.expirations[(key_server, key_id)] = ExpirationRecord(user_id, int(expiration_unix), key_id, key_server)
+            except ValueError:
+                logger.error(f"Некорректная строка в {config.USERS_KEYS_EXPIRATIONS_FILE}: '{line}'")
+
+        for line in read_file_lines(config.NOTIFIED_KEYS_FILE):
+            key_id, _, key_server = line.partition('||')
+            self.notified_keys.add((key_server or server, key_id))
+
+        for line in read_file_lines(config.PROMO_ACTIVATION_LOGS):
+            user_id, _, code = line.partition('||')
+            self.promo_activations[user_id] = code
+
+        for line in read_file_lines(config.TRANSACTION_LOGS_FILE):
+            self.transaction_labels[line.rsplit('|', 1)[-1]] += 1
+
+        # журнал платежей — последовательность смен состояния, итог восстанавливается проигрыванием
+        for line in read_file_lines(config.PAYMENTS_LEDGER_FILE):
+            try:
+                label, state, user_id, price, gb_limit, timestamp = line.split('||')
+                previous = self.payments.get(label)
+                created_at = previous.created_at if previous else int(timestamp)
+                self.payments[label] = PaymentRecord(label, user_id, float(price), int(gb_limit), state, created_at, int(timestamp))
+            except ValueError:
+                logger.error(f"Некорректная строка в {config.PAYMENTS_LEDGER_FILE}: '{line}'")
+
+        logger.info(f"Хранилище загружено: {len(self.users)} пользователей, {len(self.keys)} ключей, "
+                    f"{len(self.expirations)} сроков действия, {len(self.payments)} платежей")
+
+    def _index_key(self, record: KeyRecord):
+        ref = (record.server, record.key_id)
+        if ref not in self.keys:
+            self.user_keys[record.user_id].append(ref)
+        self.keys[ref] = record
+
+    # Пользователи
+
+    def has_user(self, user_id: str) -> bool:
+        return user_id in self.users
+
+    async def add_user(self, user_id: str):
+        if user_id in self.users:
+            return
+        self.users.add(user_id)
+        await append_to_file(config.USERS_FILE, user_id)
+
+    def count_users(self) -> int:
+        return len(self.users)
+
+    def iter_users(self, after: str = None):
+        """Все пользователи в порядке user_order, начиная со следующего после after."""
+        for user_id in sorted(self.users, key=user_order):
+            if after is None or user_order(user_id) > user_order(after):
+                yield user_id
+
+    def is_unreachable(self, user_id: str) -> bool:
+        return user_id in self.unreachable_users
+
+    async def mark_unreachable(self, user_id: str):
+        if user_id in self.unreachable_users:
+            return
+        self.unreachable_users.add(user_id)
+        await append_to_file(config.UNREACHABLE_USERS_FILE, user_id)
+
+    async def mark_reachable(self, user_id: str):
+        if user_id not in self.unreachable_users:
+            return
+        self.unreachable_users.discard(user_id)
+        await log_writer.rewrite(config.UNREACHABLE_USERS_FILE, lambda: sorted(self.unreachable_users, key=user_order))
+
+    async def add_username(self, user_id: str, username: str, time_str: str, key_url: str, kind: str):
+        line = f'{user_id}|{username}|{time_str}|{key_url}|{kind}'
+        self.usernames[user_id] = line
+        await append_to_file(config.USERS_USERNAME_FILE, line)
+
+    # Ключи
+
+    def get_key(self, server: str, key_id: str):
+        return self.keys.get((server, key_id))
+
+    def get_user_keys(self, user_id: str) -> list:
+        return [self.keys[ref] for ref in self.user_keys.get(user_id, ())]
+
+    def get_all_keys(self) -> list:
+        return list(self.keys.values())
+
+    async def add_key(self, user_id: str, access_url: str, key_id: str, server: str, gb_limit: int = None):
+        record = KeyRecord(user_id, access_url, key_id, server, gb_limit)
+        self._index_key(record)
+        await append_to_file(config.KEYS_IDS_FILE, key_line(record))
+
+    async def remove_keys(self, refs):
+        """Удаляет ключи refs — пары (server, key_id) — вместе с их сроками и отметками об уведомлении.
+
+        Каждый файл переписывается целиком один раз: дубликаты и записи удаленных ключей
+        из keys_ids.txt при этом тоже исчезают.
+        """
+        refs = set(refs)
+        removed = [self.keys.pop(ref) for ref in refs if ref in self.keys]
+        if removed:
+            for user_id in {record.user_id for record in removed}:
+                self.user_keys[user_id] = [ref for ref in self.user_keys[user_id] if ref not in refs]
+                if not self.user_keys[user_id]:
+                    del self.user_keys[user_id]
+            await log_writer.rewrite(config.KEYS_IDS_FILE, lambda: [key_line(r) for r in self.keys.values()])
+        await self.remove_expirations(refs)
+        if refs & self.notified_keys:
+            self.notified_keys -= refs
+            await log_writer.rewrite(config.NOTIFIED_KEYS_FILE, lambda: [f'{key_id}||{server}' for server, key_id in self.notified_keys])
+        return len(removed)
+
+    # Сроки действия
+
+    def get_expirations(self) -> list:
+        return list(self.expirations.values())
+
+    def get_due_expirations(self, before_unix: int) -> list:
+        return [r for r in self.expirations.values() if r.expiration_unix < before_unix]
+
+    def get_expiration(self, server: str, key_id: str):
+        return self.expirations.get((server, key_id))
+
+    async def add_expiration(self, user_id: str, expiration_unix: int, key_id: str, server: str) -> ExpirationRecord:
+        record = self.expirations[(server, key_id)] = ExpirationRecord(user_id, expiration_unix, key_id, server)
+        await append_to_file(config.USERS_KEYS_EXPIRATIONS_FILE, f'{user_id}||{expiration_unix}||{key_id}||{server}')
+        return record
+
+    async def remove_expirations(self, refs):
+        """refs — пары (server, key_id)."""
+        removed = [ref for ref in refs if self.expirations.pop(ref, None)]
+        if removed: # файл сроков переписывается целиком только если что-то действительно удалено
+            await log_writer.rewrite(config.USERS_KEYS_EXPIRATIONS_FILE, lambda: [
+                f'{r.user_id}||{r.expiration_unix}||{r.key_id}||{r.server}' for r in self.expirations.values()])
+
+    # Уведомления
+
+    def is_notified(self, server: str, key_id: str) -> bool:
+        return (server, key_id) in self.notified_keys
+
+    async def mark_notified(self, server: str, key_id: str):
+        if (server, key_id) in self.notified_keys:
+            return
+        self.notified_keys.add((server, key_id))
+        await append_to_file(config.NOTIFIED_KEYS_FILE, f'{key_id}||{server}')
+
+    # Промокоды
+
+    def has_promo_activation(self, user_id: str) -> bool:
+        return user_id in self.promo_activations
+
+    async def add_promo_activation(self, user_id: str, code: str):
+        self.promo_activations[user_id] = code
+        await append_to_file(config.PROMO_ACTIVATION_LOGS, f"{user_id}||{code}")
+
+    def get_promo_activation_counts(self) -> dict:
+        return dict(Counter(self.promo_activations.values()))
+
+    # Транзакции
+
+    async def add_transaction(self, user_id: str, price, gb_limit: int, label: str):
+        self.transaction_labels[label] += 1
+        await append_to_file(config.TRANSACTION_LOGS_FILE, f"{user_id}|{price}|{gb_limit}GB|{label}")
+
+    def get_transaction_label_counts(self) -> dict:
+        return dict(self.transaction_labels)
+
+    # Платежи
+
+    def get_payment(self, label: str):
+        return self.payments.get(label)
+
+    def get_payments(self, state: str) -> list:
+        return [record for record in self.payments.values() if record.state == state]
+
+    async def save_payment(self, record: PaymentRecord):
+        self.payments[record.label] = record
+        await append_to_file(config.PAYMENTS_LEDGER_FILE, f"{record.label}||{record.state}||{record.user_id}||"
+                                                          f"{record.price}||{record.gb_limit}||{record.updated_at}")
+        if log_writer.running: # смена состояния платежа должна попасть на диск до выдачи ключа
+            await log_writer.flush()
+
+
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    user_id TEXT PRIMARY KEY,
+    created_at INTEGER
+);
+CREATE TABLE IF NOT EXISTS unreachable_users (
+    user_id TEXT PRIMARY KEY,
+    marked_at INTEGER
+);
+CREATE TABLE IF NOT EXISTS usernames (
+    user_id TEXT PRIMARY KEY,
+    username TEXT,
+    registered_at TEXT,
+    key_url TEXT,
+    kind TEXT
+);
+CREATE TABLE IF NOT EXISTS keys (
+    server TEXT NOT NULL,
+    key_id TEXT NOT NULL,
+    user_id TEXT NOT NULL,
+    access_url TEXT NOT NULL,
+    created_at INTEGER,
+    gb_limit INTEGER,
+    PRIMARY KEY (server, key_id)
+);
+CREATE INDEX IF NOT EXISTS keys_user_id ON keys (user_id);
+CREATE TABLE IF NOT EXISTS expirations (
+    server TEXT NOT NULL,
+    key_id TEXT NOT NULL,
+    user_id TEXT NOT NULL,
+    expiration_unix INTEGER NOT NULL,
+    PRIMARY KEY (server, key_id)
+);
+CREATE INDEX IF NOT EXISTS expirations_expiration_unix ON expirations (expiration_unix);
+CREATE TABLE IF NOT EXISTS notified_keys (
+    server TEXT NOT NULL,
+    key_id TEXT NOT NULL,
+    PRIMARY KEY (server, key_id)
+);
+CREATE TABLE IF NOT EXISTS promo_activations (
+    user_id TEXT PRIMARY KEY,
+    code TEXT NOT NULL,
+    activated_at INTEGER
+);
+CREATE TABLE IF NOT EXISTS transactions (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id TEXT NOT NULL,
+    price REAL NOT NULL,
+    gb_limit INTEGER NOT NULL,
+    label TEXT UNIQUE,
+    created_at INTEGER
+);
+CREATE INDEX IF NOT EXISTS transactions_user_id ON transactions (user_id);
+CREATE TABLE IF NOT EXISTS payments (
+    label TEXT PRIMARY KEY,
+    user_id TEXT NOT NULL,
+    price REAL NOT NULL,
+    gb_limit INTEGER NOT NULL,
+    state TEXT NOT NULL,
+    created_at INTEGER NOT NULL,
+    updated_at INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS payments_state ON payments (state);
+"""
+
+
+class SqliteStore:
+    """Хранилище на встроенной SQLite в режиме WAL с тем же интерфейсом, что и FileStore.
+
+    Все выборки идут по индексам, удаление сроков — точечный DELETE вместо перезаписи файла.
+    Журналы покупок и регистраций по-прежнему дописываются в текстовые файлы для аудита.
+    """
+
+    def __init__(self, path: str = None):
+        self.path = path or config.SQLITE_DB_FILE
+        self.conn = None
+
+    def load(self):
+        self.conn = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(SQLITE_SCHEMA)
+        if 'gb_limit' not in {row[1] for row in self.conn.execute("PRAGMA table_info(keys)")}: # база до появления тарифа ключа
+            self.conn.execute("ALTER TABLE keys ADD COLUMN gb_limit INTEGER")
+        users_count = self.conn.execute("SELECT COUNT(*) FROM users").fetchone()[0]
+        keys_count = self.conn.execute("SELECT COUNT(*) FROM keys").fetchone()[0]
+        logger.info(f"Подключена база SQLite {self.path}: {users_count} пользователей, {keys_count} ключей")
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+    # Пользователи
+
+    def has_user(self, user_id: str) -> bool:
+        return self.conn.execute("SELECT 1 FROM users WHERE user_id = ?", (user_id,)).fetchone() is not None
+
+    async def add_user(self, user_id: str):
+        self.conn.execute("INSERT OR IGNORE INTO users (user_id, created_at) VALUES (?, ?)", (user_id, int(time.time())))
+
+    def count_users(self) -> int:
+        return self.conn.execute("SELECT COUNT(*) FROM users").fetchone()[0]
+
+    def iter_users(self, after: str = None, page_size: int = 1000):
+        # постраничная выборка по ключу: курсор не держится открытым между страницами
+        cursor_order = user_order(after) if after is not None else (0, '')
+        while True:
+            rows = self.conn.execute("SELECT user_id FROM users WHERE (length(user_id), user_id) > (?, ?) "
+                                     "ORDER BY length(user_id), user_id LIMIT ?", (*cursor_order, page_size)).fetchall()
+            for (user_id,) in rows:
+                yield user_id
+            if len(rows) < page_size:
+                return
+            cursor_order = user_order(rows[-1][0])
+
+    def is_unreachable(self, user_id: str) -> bool:
+        return self.conn.execute("SELECT 1 FROM unreachable_users WHERE user_id = ?", (user_id,)).fetchone() is not None
+
+    async def mark_unreachable(self, user_id: str):
+        self.conn.execute("INSERT OR IGNORE INTO unreachable_users VALUES (?, ?)", (user_id, int(time.time())))
+
+    async def mark_reachable(self, user_id: str):
+        self.conn.execute("DELETE FROM unreachable_users WHERE user_id = ?", (user_id,))
+
+    async def add_username(self, user_id: str, username: str, time_str: str, key_url: str, kind: str):
+        self.conn.execute("INSERT OR REPLACE INTO usernames VALUES (?, ?, ?, ?, ?)", (user_id, username, time_str, key_url, kind))
+        await append_to_file(config.USERS_USERNAME_FILE, f'{user_id}|{username}|{time_str}|{key_url}|{kind}')
+
+    # Ключи
+
+    def get_key(self, server: str, key_id: str):
+        row = self.conn.execute("SELECT user_id, access_url, key_id, server, gb_limit FROM keys WHERE server = ? AND key_id = ?",
+                                (server, key_id)).fetchone()
+        return KeyRecord(*row) if row else None
+
+    def get_user_keys(self, user_id: str) -> list:
+        rows = self.conn.execute("SELECT user_id, access_url, key_id, server, gb_limit FROM keys WHERE user_id = ? ORDER BY rowid", (user_id,))
+        return [KeyRecord(*row) for row in rows]
+
+    def get_all_keys(self) -> list:
+        return [KeyRecord(*row) for row in self.conn.execute("SELECT user_id, access_url, key_id, server, gb_limit FROM keys ORDER BY rowid")]
+
+    async def add_key(self, user_id: str, access_url: str, key_id: str, server: str, gb_limit: int = None):
+        self.conn.execute("INSERT OR REPLACE INTO keys VALUES (?, ?, ?, ?, ?, ?)",
+                          (server, key_id, user_id, access_url, int(time.time()), gb_limit))
+
+    async def remove_keys(self, refs):
+        """Удаляет ключи refs — пары (server, key_id) — вместе с их сроками и отметками об уведомлении."""
+        refs = list(set(refs))
+        with self.conn:
+            self.conn.execute("BEGIN")
+            removed = sum(self.conn.execute("DELETE FROM keys WHERE server = ? AND key_id = ?", ref).rowcount for ref in refs)
+            self.conn.executemany("DELETE FROM expirations WHERE server = ? AND key_id = ?", refs)
+            self.conn.executemany("DELETE FROM notified_keys WHERE server = ? AND key_id = ?", refs)
+        return removed
+
+    # Сроки действия
+
+    def get_expirations(self) -> list:
+        rows = self.conn.execute("SELECT user_id, expiration_unix, key_id, server FROM expirations ORDER BY expiration_unix")
+        return [ExpirationRecord(*row) for row in rows]
+
+    def get_due_expirations(self, before_unix: int) -> list:
+        rows = self.conn.execute("SELECT user_id, expiration_unix, key_id, server FROM expirations WHERE expiration_unix < ? "
+                                 "ORDER BY expiration_unix", (before_unix,))
+        return [ExpirationRecord(*row) for row in rows]
+
+    def get_expiration(self, server: str, key_id: str):
+        row = self.conn.execute("SELECT user_id, expiration_unix, key_id, server FROM expirations WHERE server = ? AND key_id = ?",
+                                (server, key_id)).fetchone()
+        return ExpirationRecord(*row) if row else None
+
+    async def add_expiration(self, user_id: str, expiration_unix: int, key_id: str, server: str) -> ExpirationRecord:
+        self.conn.execute("INSERT OR REPLACE INTO expirations VALUES (?, ?, ?, ?)", (server, key_id, user_id, expiration_unix))
+        return ExpirationRecord(user_id, expiration_unix, key_id, server)
+
+    async def remove_expirations(self, refs):
+        """refs — пары (server, key_id)."""
+        self.conn.executemany("DELETE FROM expirations WHERE server = ? AND key_id = ?", list(refs))
+
+    # Уведомления
+
+    def is_notified(self, server: str, key_id: str) -> bool:
+        return self.conn.execute("SELECT 1 FROM notified_keys WHERE server = ? AND key_id = ?",
+                                 (server, key_id)).fetchone() is not None
+
+    async def mark_notified(self, server: str, key_id: str):
+        self.conn.execute("INSERT OR IGNORE INTO notified_keys VALUES (?, ?)", (server, key_id))
+
+    # Промокоды
+
+    def has_promo_activation(self, user_id: str) -> bool:
+        return self.conn.execute("SELECT 1 FROM promo_activations WHERE user_id = ?", (user_id,)).fetchone() is not None
+
+    async def add_promo_activation(self, user_id: str, code: str):
+        self.conn.execute("INSERT OR REPLACE INTO promo_activations VALUES (?, ?, ?)", (user_id, code, int(time.time())))
+
+    def get_promo_activation_counts(self) -> dict:
+        return dict(self.conn.execute("SELECT code, COUNT(*) FROM promo_activations GROUP BY code"))
+
+    # Транзакции
+
+    async def add_transaction(self, user_id: str, price, gb_limit: int, label: str):
+        self.conn.execute("INSERT OR IGNORE INTO transactions (user_id, price, gb_limit, label, created_at) VALUES (?, ?, ?, ?, ?)",
+                          (user_id, float(price), int(gb_limit), label, int(time.time())))
+        await append_to_file(config.TRANSACTION_LOGS_FILE, f"{user_id}|{price}|{gb_limit}GB|{label}")
+
+    def get_transaction_label_counts(self) -> dict:
+        return dict(self.conn.execute("SELECT label, COUNT(*) FROM transactions GROUP BY label"))
+
+    # Платежи
+
+    def get_payment(self, label: str):
+        row = self.conn.execute("SELECT * FROM payments WHERE label = ?", (label,)).fetchone()
+        return PaymentRecord(*row) if row else None
+
+    def get_payments(self, state: str) -> list:
+        return [PaymentRecord(*row) for row in self.conn.execute("SELECT * FROM payments WHERE state = ?", (state,))]
+
+    async def save_payment(self, record: PaymentRecord):
+        self.conn.execute("INSERT OR REPLACE INTO payments VALUES (?, ?, ?, ?, ?, ?, ?)",
+                          (record.label, record.user_id, record.price, record.gb_limit, record.state,
+                           record.created_at, record.updated_at))
+
+
+def create_store():
+    if config.STORAGE_BACKEND == 'sqlite':
+        return SqliteStore()
+    return FileStore()
+
+
+def import_flat_files(db_path: str = None):
+    """Однократный перенос данных из data/*.txt в базу SQLite. Повторный запуск ничего не дублирует."""
+    files = FileStore()
+    files.load()
+
+    db = SqliteStore(db_path)
+    db.load()
+    now = int(time.time())
+    with db.conn: # одна транзакция на весь импорт
+        db.conn.execute("BEGIN")
+        db.conn.executemany("INSERT OR IGNORE INTO users VALUES (?, ?)", [(user_id, now) for user_id in files.users])
+        db.conn.executemany("INSERT OR IGNORE INTO unreachable_users VALUES (?, ?)",
+                            [(user_id, now) for user_id in files.unreachable_users])
+        for line in files.usernames.values():
+            parts = line.split('|')
+            if len(parts) == 5:
+                db.conn.execute("INSERT OR REPLACE INTO usernames VALUES (?, ?, ?, ?, ?)", parts)
+        db.conn.executemany("INSERT OR IGNORE INTO keys VALUES (?, ?, ?, ?, ?, ?)",
+                            [(r.server, r.key_id, r.user_id, r.access_url, now, r.gb_limit) for r in files.keys.values()])
+        db.conn.executemany("INSERT OR REPLACE INTO expirations VALUES (?, ?, ?, ?)",
+                            [(r.server, r.key_id, r.user_id, r.expiration_unix) for r in files.expirations.values()])
+        db.conn.executemany("INSERT OR IGNORE INTO notified_keys VALUES (?, ?)", list(files.notified_keys))
+        db.conn.executemany("INSERT OR IGNORE INTO promo_activations VALUES (?, ?, ?)",
+                            [(user_id, code, now) for user_id, code in files.promo_activations.items()])
+        db.conn.executemany("INSERT OR REPLACE INTO payments VALUES (?, ?, ?, ?, ?, ?, ?)",
+                            [(r.label, r.user_id, r.price, r.gb_limit, r.state, r.created_at, r.updated_at)
+                             for r in files.payments.values()])
+        for line in read_file_lines(config.TRANSACTION_LOGS_FILE):
+            try:
+                user_id, price, gb_limit, label = line.split('|')
+                db.conn.execute("INSERT OR IGNORE INTO transactions (user_id, price, gb_limit, label, created_at) "
+                                "VALUES (?, ?, ?, ?, ?)", (user_id, float(price), int(gb_limit.rstrip('GB')), label, now))
+            except ValueError:
+                logger.error(f"Некорректная строка в {config.TRANSACTION_LOGS_FILE}: '{line}'")
+    logger.info(f"Импорт в {db.path} завершен: {len(files.users)} пользователей, {len(files.keys)} ключей, "
+                f"{len(files.expirations)} сроков действия")
+    db.close()
@@ -0,0 +1,170 @@
+import asyncio
+import logging
+import time
+from dataclasses import dataclass, field
+
+import config
+from ratelimit import retry_with_backoff
+
+logger = logging.getLogger(__name__)
+
+EXPIRATION_NOTICE_SECONDS = 259200  # уведомление об окончании срока — за 3 дня
+
+
+@dataclass
+class SweepReport:
+    checked: int = 0
+    deleted: int = 0
+    delete_failed: int = 0
+    notified: int = 0
+    notify_failed: int = 0
+    skipped_servers: list = field(default_factory=list)
+    duration: float = 0.0
+
+
+class KeySweeper:
+    """Проверка сроков и трафика ключей: уведомляет об истечении срока и малом остатке трафика,
+    удаляет истекшие и исчерпанные ключи.
+
+    Сначала по снимкам серверов составляется список действий, затем удаления и уведомления
+    выполняются параллельно: удаления ограничены семафором на каждый сервер, уведомления —
+    общим лимитом Telegram. Ошибки повторяются с нарастающей задержкой.
+    """
+
+    def __init__(self, bot, store, pool, limiter, templates):
+        self.bot = bot
+        self.store = store
+        self.pool = pool
+        self.limiter = limiter
+        self.templates = templates
+        self.last_report = None
+        self._deleting = set()  # ключи, удаление которых уже идет (сверка, планировщик и наблюдатель работают параллельно)
+        self._delete_semaphores = {name: asyncio.Semaphore(config.SWEEP_DELETE_CONCURRENCY) for name in pool.servers}
+        self._send_semaphore = asyncio.Semaphore(config.SWEEP_SEND_CONCURRENCY)
+
+    def text(self, path):
+        return self.templates.text(path)
+
+    def plan(self, snapshots: dict, now: int, report: SweepReport):
+        """Возвращает (к удалению, к уведомлению) по снимкам {server: {key_id: OutlineKey}}.
+
+        Сроки читаются индексной выборкой: только записи, у которых срок истек или началось окно
+        уведомления. Трафик проверяется по снимкам, а запись ключа и отметка об уведомлении
+        запрашиваются только для ключей, которым нужно действие.
+        """
+        to_delete, to_notify = [], []
+        handled, expiring = set(), {}  # expiring: ключ -> запись в окне уведомления о сроке
+        for record in self.store.get_due_expirations(now + EXPIRATION_NOTICE_SECONDS):
+            outline_keys = snapshots.get(record.server)
+            if outline_keys is None: # сервер недоступен — его ключи проверим в следующий раз
+                continue
+            ref = (record.server, record.key_id)
+            if record.expiration_unix < now:
+                to_delete.append((record, "срок действия истек", record.key_id in outline_keys, None))
+                handled.add(ref)
+            elif record.key_id in outline_keys: # запись о ключе, пропавшем с сервера до срока, разбирает сверка
+                expiring[ref] = record
+
+        for server_name, outline_keys in snapshots.items():
+            report.checked += len(outline_keys)
+            for key_id, outline_key in outline_keys.items():
+                ref = (server_name, key_id)
+                limit = outline_key.data_limit
+                if not limit or ref in handled:
+                    continue
+                used_bytes = outline_key.used_bytes or 0
+                depleted = used_bytes >= limit
+                if not depleted and (ref in expiring or (limit - used_bytes) / limit >= config.LOW_TRAFFIC_THRESHOLD):
+                    continue
+                record = self.store.get_expiration(server_name, key_id)
+                if record is None: # ключ запаса или не выданный пользователю
+                    continue
+                if depleted:
+                    to_delete.append((record, "лимит трафика исчерпан", True, config.NOTIFY_DEPLETED_FILE))
+                    expiring.pop(ref, None)
+                elif not self.store.is_notified(server_name, key_id): # уведомляем один раз
+                    to_notify.append((record, config.NOTIFY_LOW_TRAFFIC_FILE))
+
+        for ref, record in expiring.items():
+            if not self.store.is_notified(*ref):
+                to_notify.append((record, config.NOTIFY_EXPIRATION_FILE))
+        return to_delete, to_notify
+
+    async def _delete(self, record, reason, exists_on_server, report: SweepReport, text: str = None):
+        server = self.pool.get(record.server)
+        ref = (record.server, record.key_id)
+        if ref in self._deleting or self.store.get_expiration(*ref) is None:
+            return None
+        self._deleting.add(ref)
+        try:
+            if exists_on_server:
+                async with self._delete_semaphores[server.name]:
+                    if not await retry_with_backoff(server.client.delete_key, record.key_id):
+                        logger.info(f"Ключа {record.key_id} уже нет на сервере {server.name}")
+        except Exception as e:
+            self._deleting.discard(ref)
+            report.delete_failed += 1
+            logger.error(f"Не удалось удалить ключ {record.key_id} на сервере {server.name}: {e}")
+            return None
+        if not exists_on_server: # ключ удален не нами, сообщать пользователю не о чем
+            logger.info(f"Ключа {record.key_id} пользователя {record.user_id} уже нет на сервере {server.name}, "
+                        f"запись о сроке снята. Причина: {reason}.")
+            return ref
+        report.deleted += 1
+        logger.info(f"Удален ключ {record.key_id} пользователя {record.user_id} на сервере {server.name}. Причина: {reason}.")
+        async with self._send_semaphore:
+            await self.limiter.send_message(
+                self.bot, record.user_id,
+                text or f"Ваш ключ был удален, так как {reason}. Вы можете приобрести новый в главном меню.")
+        return ref
+
+    async def finish_deletions(self, refs):
+        """Убирает удаленные ключи из индекса сроков одной записью и обновляет снимки их серверов."""
+        refs = [ref for ref in refs if ref]
+        if not refs:
+            return
+        await self.store.remove_expirations(refs)
+        self._deleting.difference_update(refs)
+        for server_name in {server_name for server_name, _ in refs}:
+            self.pool.get(server_name).cache.refresh_soon()
+
+    async def _notify(self, record, text_path, report: SweepReport):
+        async with self._send_semaphore:
+            sent = await self.limiter.send_message(self.bot, record.user_id, self.text(text_path))
+        if sent:
+            report.notified += 1
+            await self.store.mark_notified(record.server, record.key_id)
+        else:
+            report.notify_failed += 1
+
+    async def sweep(self) -> SweepReport:
+        started_at = time.monotonic()
+        report = SweepReport()
+        snapshots = await self.pool.get_all_keys(fresh=True)
+        report.skipped_servers = [name for name in self.pool.servers if name not in snapshots]
+
+        to_delete, to_notify = self.plan(snapshots, int(time.time()), report)
+        results = await asyncio.gather(
+            *(self._delete(record, reason, exists, report, text_path and self.text(text_path))
+              for record, reason, exists, text_path in to_delete),
+            *(self._notify(record, text_path, report) for record, text_path in to_notify))
+
+        # из индекса сроков убираем только ключи, которых на сервере больше нет
+        await self.finish_deletions(results[:len(to_delete)])
+
+        report.duration = time.monotonic() - started_at
+        self.last_report = report
+        logger.info(f"Проверка ключей завершена за {report.duration:.1f} с: проверено {report.checked}, "
+                    f"удалено {report.deleted} (ошибок {report.delete_failed}), уведомлений {report.notified} "
+                    f"(ошибок {report.notify_failed}), пропущены серверы: {report.skipped_servers or 'нет'}")
+        return report
+
+    async def run(self):
+        await asyncio.sleep(10)
+        while True:
+            try:
+                logger.info("Запущена периодическая проверка ключей...")
+                await self.sweep()
+            except Exception as e:
+                logger.error(f"Критическая ошибка в фоновой задаче проверки ключей: {e}")
+            await asyncio.sleep(config.SWEEP_INTERVAL)
@@ -0,0 +1,122 @@
+import asyncio
+import json
+import logging
+import os
+
+from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardMarkup
+
+import config
+from fileio import read_file
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TEXTS = {
+    config.START_MESSAGE_FILE: "Добро пожаловать!",
+    config.SUPPORT_MESSAGE_FILE: "Свяжитесь с поддержкой.",
+    config.INFORMATION_FILE: "Информация о сервисе.",
+    config.GUIDE_FILE: "Инструкция по использованию.",
+}
+
+
+def tariff_name(gb_limit: int) -> str:
+    if gb_limit >= 998:
+        return f"Безлимит ({'3 мес.' if gb_limit == 999 else '1 мес.'})"
+    return f"{gb_limit} ГБ"
+
+
+def serialize(markup) -> str:
+    """JSON клавиатуры в том виде, в каком его отправляет aiogram; строку reply_markup он передает как есть."""
+    return json.dumps(markup.to_python(), ensure_ascii=False)
+
+
+def build_keyboards() -> dict:
+    buy_kb = InlineKeyboardMarkup(row_width=2)
+    buttons = [InlineKeyboardButton(f"{gb} ГБ - {price}₽", callback_data=f"buy_new_{gb}") for gb, price in config.PRICE_NEW.items() if gb < 998]
+    buttons.append(InlineKeyboardButton(f"Безлимит (1 мес) - {config.PRICE_NEW[998]}₽", callback_data="buy_new_998"))
+    buttons.append(InlineKeyboardButton(f"Безлимит (3 мес) - {config.PRICE_NEW[999]}₽", callback_data="buy_new_999"))
+    buy_kb.add(*buttons)
+    buy_kb.add(InlineKeyboardButton('🔙 Назад', callback_data='back_to_main_menu'))
+
+    keyboards = {
+        'main_menu': InlineKeyboardMarkup(row_width=2).add(
+            InlineKeyboardButton('🛒 Купить VPN', callback_data='buy_vpn'),
+            InlineKeyboardButton('📚 Информация', callback_data='info'),
+            InlineKeyboardButton('💬 Поддержка', callback_data='support'),
+            InlineKeyboardButton('🎁 Мои ключи', callback_data='my_keys'),
+            InlineKeyboardButton('🔥 Промокод', callback_data='promo')
+        ),
+        'info': InlineKeyboardMarkup(row_width=1).add(
+            InlineKeyboardButton('🔥 Инструкция по использованию', callback_data='guide'),
+            InlineKeyboardButton('🔙 Назад', callback_data='back_to_main_menu')
+        ),
+        'back_to_main': InlineKeyboardMarkup().add(InlineKeyboardButton('🔙 Главное меню', callback_data='back_to_main_menu')),
+        'back_to_info': InlineKeyboardMarkup().add(InlineKeyboardButton('🔙 Назад', callback_data='info')),
+        'buy': buy_kb,
+        'cancel': ReplyKeyboardMarkup(resize_keyboard=True).add("Отмена"),
+    }
+    return {name: serialize(markup) for name, markup in keyboards.items()}
+
+
+def build_payment_texts() -> dict:
+    return {
+        gb_limit: (f"Вы выбрали тариф: *{tariff_name(gb_limit)}*.\nСумма к оплате: *{price} ₽*.\n\n"
+                   "Нажмите на кнопку ниже, чтобы перейти к оплате. После успешной оплаты вернитесь и нажмите 'Я оплатил'.")
+        for gb_limit, price in config.PRICE_NEW.items()
+    }
+
+
+class TemplateRegistry:
+    """Тексты сообщений и заранее собранные клавиатуры.
+
+    Тексты из TEMPLATE_DIRS держатся в памяти и перечитываются фоновой задачей, как только
+    у файла меняется время модификации. Новый набор текстов подменяет старый одним присваиванием,
+    поэтому обработчик видит либо старую, либо новую версию целиком. Клавиатуры и тексты тарифов
+    строятся из config один раз при запуске.
+    """
+
+    def __init__(self, directories=None, defaults=None):
+        self.directories = directories or config.TEMPLATE_DIRS
+        self.defaults = {os.path.normpath(path): text for path, text in (defaults or DEFAULT_TEXTS).items()}
+        self.keyboards = build_keyboards()
+        self.payment_texts = build_payment_texts()
+        self._texts = {}   # path -> текст
+        self._mtimes = {}  # path -> st_mtime_ns
+        self.reload()
+
+    def text(self, path: str) -> str:
+        path = os.path.normpath(path)
+        return self._texts.get(path) or self.defaults.get(path, "")
+
+    def _scan(self) -> dict:
+        mtimes = {}
+        for directory in self.directories:
+            try:
+                with os.scandir(directory) as entries:
+                    for entry in entries:
+                        if entry.is_file() and not entry.name.endswith('.tmp'):
+                            mtimes[os.path.normpath(entry.path)] = entry.stat().st_mtime_ns
+            except FileNotFoundError:
+                continue
+        return mtimes
+
+    def reload(self) -> list:
+        """Перечитывает измененные файлы. Возвращает список обновленных путей."""
+        mtimes = self._scan()
+        if mtimes == self._mtimes:
+            return []
+        changed = [path for path, mtime in mtimes.items() if self._mtimes.get(path) != mtime]
+        texts = {path: self._texts[path] for path in mtimes if path in self._texts and path not in changed}
+        for path in changed:
+            texts[path] = read_file(path)
+        self._texts, self._mtimes = texts, mtimes
+        return changed
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(config.TEMPLATES_RELOAD_INTERVAL)
+            try:
+                changed = self.reload()
+                if changed:
+                    logger.info(f"Обновлены тексты: {', '.join(changed)}")
+            except Exception as e:
+                logger.error(f"Ошибка перечитывания текстов: {e}")
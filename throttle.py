@@ -0,0 +1,189 @@
+import asyncio
+import logging
+import os
+import time
+from collections import OrderedDict, deque
+
+from aiogram import types
+from aiogram.dispatcher.handler import CancelHandler
+from aiogram.dispatcher.middlewares import BaseMiddleware
+
+import config
+from fileio import read_file_lines, rewrite_file
+from metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+throttled_updates = REGISTRY.counter('bot_throttled_updates_total', "Отброшено обновлений из-за частоты", ('action',))
+banned_updates = REGISTRY.counter('bot_banned_updates_total', "Отброшено обновлений от заблокированных пользователей")
+
+
+class BanList:
+    """Заблокированные пользователи: множество в памяти, файл BANNED_USERS_FILE — по одному ID в строке.
+
+    Файл можно править вручную: фоновая задача перечитывает его, как только меняется время модификации.
+    /ban и /unban меняют множество и атомарно перезаписывают файл.
+    """
+
+    def __init__(self, path: str = None):
+        self.path = path or config.BANNED_USERS_FILE
+        self.users = set()
+        self._mtime = None
+        self._lock = asyncio.Lock()
+
+    def __contains__(self, user_id) -> bool:
+        return str(user_id) in self.users
+
+    def __len__(self) -> int:
+        return len(self.users)
+
+    def _stat(self):
+        try:
+            return os.stat(self.path).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    def reload(self) -> bool:
+        """Перечитывает файл, если он изменился. Возвращает True, если список обновлен."""
+        mtime = self._stat()
+        if mtime == self._mtime:
+            return False
+        users = set()
+        for line in read_file_lines(self.path) if mtime is not None else []:
+            user_id = line.split('#', 1)[0].strip()
+            if user_id:
+                users.add(user_id)
+        self.users, self._mtime = users, mtime
+        return True
+
+    async def _save(self):
+        lines = sorted(self.users, key=lambda user_id: (len(user_id), user_id))
+        await asyncio.get_running_loop().run_in_executor(None, rewrite_file, self.path, lines)
+        self._mtime = self._stat()
+
+    async def ban(self, user_id) -> bool:
+        async with self._lock:
+            self.reload() # не затираем ручные правки, сделанные после последней проверки
+            if str(user_id) in self.users:
+                return False
+            self.users = self.users | {str(user_id)}
+            await self._save()
+            return True
+
+    async def unban(self, user_id) -> bool:
+        async with self._lock:
+            self.reload()
+            if str(user_id) not in self.users:
+                return False
+            self.users = self.users - {str(user_id)}
+            await self._save()
+            return True
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(config.BANNED_USERS_RELOAD_INTERVAL)
+            try:
+                if self.reload():
+                    logger.info(f"Список заблокированных перечитан: {len(self.users)} пользователей")
+            except Exception as e:
+                logger.error(f"Ошибка перечитывания {self.path}: {e}")
+
+
+class SlidingWindow:
+    """Моменты последних limit разрешенных действий; новое разрешено, если самое старое вышло из окна."""
+
+    __slots__ = ('hits', 'warned')
+
+    def __init__(self, limit: int):
+        self.hits = deque(maxlen=limit)
+        self.warned = False
+
+    def hit(self, window: float, now: float) -> bool:
+        if len(self.hits) == self.hits.maxlen and now - self.hits[0] < window:
+            return False
+        self.hits.append(now)
+        self.warned = False
+        return True
+
+
+class ThrottlingMiddleware(BaseMiddleware):
+    """Отбрасывает обновления от заблокированных и слишком частые действия до запуска обработчиков.
+
+    Для каждого пользователя действует общий лимит THROTTLE_DEFAULT_RATE и отдельные лимиты
+    THROTTLE_RATES для команд и кнопок (ключ — команда или начало callback_data). Окна хранятся
+    в LRU на THROTTLE_MAX_BUCKETS записей, давно неактивные пользователи вытесняются.
+    Аккаунт поддержки не ограничивается.
+    """
+
+    def __init__(self, bans: BanList, rates: dict = None, default_rate: tuple = None, max_buckets: int = None):
+        super().__init__()
+        self.bans = bans
+        self.rates = config.THROTTLE_RATES if rates is None else rates
+        self.default_rate = default_rate or config.THROTTLE_DEFAULT_RATE
+        self.max_buckets = max_buckets or config.THROTTLE_MAX_BUCKETS
+        self._buckets = OrderedDict()  # (user_id, действие) -> SlidingWindow
+        self._prefixes = sorted(self.rates, key=len, reverse=True)
+
+    def action(self, key: str):
+        """Правило из THROTTLE_RATES для команды или callback_data; самое длинное совпадение."""
+        for prefix in self._prefixes:
+            if key.startswith(prefix):
+                return prefix
+        return None
+
+    def _bucket(self, user_id: int, action: str, limit: int) -> SlidingWindow:
+        key = (user_id, action)
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = SlidingWindow(limit)
+            if len(self._buckets) > self.max_buckets:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(key)
+        return bucket
+
+    def check(self, user_id: int, key: str):
+        """Возвращает None, если действие разрешено, иначе окно, лимит которого превышен."""
+        now = time.monotonic()
+        action = self.action(key)
+        checks = [('*', self.default_rate)]
+        if action is not None:
+            checks.append((action, self.rates[action]))
+        for name, (limit, window) in checks:
+            bucket = self._bucket(user_id, name, limit)
+            if not bucket.hit(window, now):
+                throttled_updates.inc(name)
+                return bucket
+        return None
+
+    def _admitted(self, user: types.User, key: str):
+        if user is None or user.id == config.support_account:
+            return None
+        if user.id in self.bans:
+            banned_updates.inc()
+            raise CancelHandler()
+        return self.check(user.id, key)
+
+    async def on_pre_process_message(self, message: types.Message, data: dict):
+        bucket = self._admitted(message.from_user, message.get_command(pure=True) or '')
+        if bucket is None:
+            return
+        if not bucket.warned: # предупреждаем один раз, дальше молча отбрасываем
+            bucket.warned = True
+            try:
+                await message.answer("⏳ Слишком много запросов. Подождите немного и попробуйте снова.")
+            except Exception as e:
+                logger.warning(f"Не удалось предупредить {message.from_user.id} о лимите: {e}")
+        raise CancelHandler()
+
+    async def on_pre_process_callback_query(self, call: types.CallbackQuery, data: dict):
+        bucket = self._admitted(call.from_user, call.data or '')
+        if bucket is None:
+            return
+        if not bucket.warned:
+            bucket.warned = True
+            try: # без ответа кнопка у пользователя так и останется "в загрузке"
+                await call.answer("⏳ Слишком часто. Подождите немного.")
+            except Exception as e:
+                logger.warning(f"Не удалось ответить {call.from_user.id} на нажатие: {e}")
+        raise CancelHandler()
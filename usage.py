@@ -0,0 +1,101 @@
+import asyncio
+import logging
+import time
+from dataclasses import dataclass
+
+import config
+from sweeper import SweepReport
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class KeyUsage:
+    used_bytes: int
+    observed_at: float
+    rate: float  # байт/с, сглаженная оценка
+
+
+class UsageWatcher:
+    """Следит за расходом трафика ключей с лимитом по дешевому запросу /metrics/transfer.
+
+    Для каждого ключа хранится предыдущее значение и скорость расхода; события срабатывают только
+    при пересечении порогов: предупреждение о малом остатке, исчерпание лимита (уведомление из
+    NOTIFY_DEPLETED_FILE и удаление ключа). Интервал опроса сервера подстраивается под ключ,
+    который ближе всех к своему порогу.
+    """
+
+    def __init__(self, sweeper):
+        self.sweeper = sweeper
+        self.store = sweeper.store
+        self.pool = sweeper.pool
+        self._usage = {}  # server -> {key_id: KeyUsage}
+
+    async def poll_server(self, server) -> float:
+        """Опрашивает сервер и возвращает, через сколько секунд опросить его снова."""
+        transfer = (await server.client.get_transferred_data())['bytesTransferredByUserId']
+        now = time.monotonic()
+        previous_usage = self._usage.get(server.name, {})
+        usage = {}
+        interval = config.USAGE_POLL_MAX_INTERVAL
+        low_traffic, depleted = [], []
+
+        for key_id, outline_key in server.cache.snapshot.items():
+            limit = outline_key.data_limit
+            if not limit:
+                continue
+            record = self.store.get_expiration(server.name, key_id)
+            if record is None: # ключ не выдан пользователю
+                continue
+
+            used = transfer.get(key_id, outline_key.used_bytes or 0)
+            previous = previous_usage.get(key_id)
+            rate = previous.rate if previous else 0.0
+            if previous and now > previous.observed_at:
+                rate = (rate + max(used - previous.used_bytes, 0) / (now - previous.observed_at)) / 2
+            usage[key_id] = KeyUsage(used, now, rate)
+
+            if used >= limit:
+                depleted.append(record)
+                continue
+
+            warning_at = limit * (1 - config.LOW_TRAFFIC_THRESHOLD)
+            notified = self.store.is_notified(server.name, key_id)
+            if used >= warning_at and not notified:
+                low_traffic.append(record)
+                notified = True
+
+            next_threshold = limit if notified or used >= warning_at else warning_at
+            if rate > 0:
+                interval = min(interval, (next_threshold - used) / rate / 2)
+
+        self._usage[server.name] = usage
+        if low_traffic or depleted:
+            await self._handle(server, low_traffic, depleted)
+        return max(interval, config.USAGE_POLL_MIN_INTERVAL)
+
+    async def _handle(self, server, low_traffic, depleted):
+        report = SweepReport(checked=len(low_traffic) + len(depleted))
+        depleted_text = self.sweeper.text(config.NOTIFY_DEPLETED_FILE)
+        results = await asyncio.gather(
+            *(self.sweeper._delete(record, "лимит трафика исчерпан", True, report, text=depleted_text) for record in depleted),
+            *(self.sweeper._notify(record, config.NOTIFY_LOW_TRAFFIC_FILE, report) for record in low_traffic))
+
+        deleted = [ref for ref in results[:len(depleted)] if ref]
+        await self.sweeper.finish_deletions(deleted)
+        for _, key_id in deleted:
+            self._usage[server.name].pop(key_id, None)
+        logger.info(f"Сервер {server.name}: исчерпано {report.deleted} ключей (ошибок {report.delete_failed}), "
+                    f"предупреждений о трафике {report.notified} (ошибок {report.notify_failed})")
+
+    async def _run_server(self, server):
+        while True:
+            try:
+                interval = await self.poll_server(server)
+            except Exception as e:
+                logger.error(f"Не удалось получить расход трафика с сервера {server.name}: {e}")
+                interval = config.USAGE_POLL_MAX_INTERVAL
+            await asyncio.sleep(interval)
+
+    async def run(self):
+        await asyncio.gather(*(self._run_server(server) for server in self.pool.servers.values()))
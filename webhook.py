@@ -0,0 +1,93 @@
+import asyncio
+import logging
+import secrets
+
+from aiogram import Bot, Dispatcher, types
+from aiohttp import web
+
+import config
+
+logger = logging.getLogger(__name__)
+
+SECRET_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+
+
+class WebhookServer:
+    """Прием обновлений через вебхук на aiohttp вместо long polling.
+
+    Обновление подтверждается Telegram сразу, а обрабатывается в отдельной задаче. При остановке
+    сервер перестает принимать запросы и дожидается уже запущенных обработчиков. Вебхук при
+    остановке не снимается: обновления, пришедшие во время перезапуска, Telegram доставит позже.
+    """
+
+    def __init__(self, dispatcher: Dispatcher, on_startup=None, on_shutdown=None):
+        self.dispatcher = dispatcher
+        self.on_startup = on_startup
+        self.on_shutdown = on_shutdown
+        self.secret = config.WEBHOOK_SECRET or secrets.token_urlsafe(32)
+        self._tasks = set()
+        self._closing = False
+
+        self.app = web.Application()
+        self.app.router.add_post(config.WEBHOOK_PATH, self.handle_update)
+        self.app.on_startup.append(self._startup)
+        self.app.on_shutdown.append(self._shutdown)
+
+    async def handle_update(self, request: web.Request):
+        if not secrets.compare_digest(request.headers.get(SECRET_HEADER, ''), self.secret):
+            logger.warning(f"Отклонен запрос к вебхуку с неверным секретом от {request.remote}")
+            return web.Response(status=403)
+        if self._closing: # Telegram повторит доставку после перезапуска
+            return web.Response(status=503)
+
+        try:
+            data = await request.json()
+        except ValueError:
+            return web.Response(status=400)
+        if not isinstance(data, dict): # массив или строка вместо объекта обновления
+            logger.warning(f"Отклонен запрос к вебхуку с телом не-объектом от {request.remote}")
+            return web.Response(status=400)
+        try:
+            update = types.Update(**data)
+        except (ValueError, TypeError) as e:
+            logger.warning(f"Отклонено некорректное обновление от {request.remote}: {e}")
+            return web.Response(status=400)
+
+        task = asyncio.create_task(self._process_update(update))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return web.Response()
+
+    async def _process_update(self, update: types.Update):
+        Bot.set_current(self.dispatcher.bot)
+        Dispatcher.set_current(self.dispatcher)
+        try:
+            await self.dispatcher.process_update(update)
+        except Exception as e:
+            logger.error(f"Ошибка при обработке обновления {update.update_id}: {e}")
+
+    async def _startup(self, app: web.Application):
+        Bot.set_current(self.dispatcher.bot)
+        Dispatcher.set_current(self.dispatcher)
+        if self.on_startup:
+            await self.on_startup(self.dispatcher)
+        url = config.WEBHOOK_HOST.rstrip('/') + config.WEBHOOK_PATH
+        await self.dispatcher.bot.set_webhook(url, secret_token=self.secret, drop_pending_updates=False,
+                                              max_connections=config.WEBHOOK_MAX_CONNECTIONS)
+        logger.info(f"Вебхук зарегистрирован: {url}")
+
+    async def _shutdown(self, app: web.Application):
+        self._closing = True
+        if self._tasks:
+            logger.info(f"Ожидание завершения {len(self._tasks)} обработчиков...")
+            _, pending = await asyncio.wait(set(self._tasks), timeout=config.WEBHOOK_DRAIN_TIMEOUT)
+            if pending:
+                logger.warning(f"Не дождались {len(pending)} обработчиков за {config.WEBHOOK_DRAIN_TIMEOUT} с")
+        if self.on_shutdown:
+            await self.on_shutdown(self.dispatcher)
+        await self.dispatcher.storage.close()
+        await self.dispatcher.storage.wait_closed()
+        await (await self.dispatcher.bot.get_session()).close()
+
+    def run(self):
+        web.run_app(self.app, host=config.WEBAPP_HOST, port=config.WEBAPP_PORT)